@@ -0,0 +1,144 @@
+"""
+Semantic answer cache - reuse RAG answers for repeated or near-duplicate questions
+
+两级匹配：先按规范化后的问题文本精确匹配，再按问题向量的余弦相似度匹配近似问题。
+所有条目都带有知识库指纹，知识库重建或增删来源后指纹变化，旧答案自动失效。
+按 LRU 淘汰，并在 TTL 到期后失效。进程级共享，所有会话共用。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL_SECONDS
+
+_TRAILING_PUNCT = re.compile(r"[\s?？!！。.,，;；]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化问题文本：小写、合并空白、去掉结尾标点"""
+    text = _WHITESPACE.sub(" ", prompt.strip().lower())
+    return _TRAILING_PUNCT.sub("", text)
+
+
+def _unit(vector) -> np.ndarray:
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(arr))
+    return arr / norm if norm > 0 else arr
+
+
+class SemanticAnswerCache:
+    """线程安全的语义答案缓存"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return now - entry["created"] > self.ttl_seconds
+
+    def lookup(
+        self,
+        kb_fingerprint: str,
+        prompt: str,
+        embed: Optional[Callable[[str], List[float]]] = None,
+    ) -> tuple:
+        """
+        查找缓存的答案；精确匹配未命中时才计算问题向量做近似匹配
+
+        Args:
+            kb_fingerprint: 当前知识库指纹
+            prompt: 用户问题
+            embed: 问题向量化函数（可选，提供时启用近似匹配）
+
+        Returns:
+            (命中结果 {"answer", "sources", "similarity"} 或 None,
+             计算出的问题向量或 None —— 未命中时可直接复用于检索)
+        """
+        key = (kb_fingerprint, normalize_prompt(prompt))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, time.monotonic()):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                return self._hit(entry, 1.0), None
+
+        query_vector = embed(prompt) if embed is not None else None
+        with self._lock:
+            entry, similarity = None, 0.0
+            if query_vector is not None:
+                entry, similarity = self._nearest(kb_fingerprint, _unit(query_vector), time.monotonic())
+            if entry is None:
+                self.misses += 1
+                return None, query_vector
+            return self._hit(entry, similarity), query_vector
+
+    def _hit(self, entry: Dict[str, Any], similarity: float) -> Dict[str, Any]:
+        """记录命中并刷新 LRU 顺序（需持有锁）"""
+        self._entries.move_to_end(entry["key"])
+        self.hits += 1
+        return {"answer": entry["answer"], "sources": entry["sources"], "similarity": similarity}
+
+    def _nearest(self, kb_fingerprint: str, unit_vector: np.ndarray, now: float) -> tuple:
+        """在同一知识库的条目中找相似度最高且超过阈值的一条（需持有锁）"""
+        best, best_sim = None, self.similarity_threshold
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if key[0] != kb_fingerprint or entry["vector"] is None:
+                continue
+            if self._expired(entry, now):
+                del self._entries[key]
+                continue
+            sim = float(np.dot(entry["vector"], unit_vector))
+            if sim >= best_sim:
+                best, best_sim = entry, sim
+        return best, best_sim
+
+    def store(
+        self,
+        kb_fingerprint: str,
+        prompt: str,
+        answer: str,
+        sources: List[str],
+        query_vector=None,
+    ) -> None:
+        """写入答案，超出容量时淘汰最久未使用的条目"""
+        key = (kb_fingerprint, normalize_prompt(prompt))
+        entry = {
+            "key": key,
+            "answer": answer,
+            "sources": list(sources),
+            "vector": _unit(query_vector) if query_vector is not None else None,
+            "created": time.monotonic(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 进程级单例
+answer_cache = SemanticAnswerCache(
+    ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY
+)
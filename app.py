@@ -1,13 +1,45 @@
+import time
+
 import streamlit as st
 
-from rag_pipeline import build_knowledge_base
-from chat import run_chat, generate_housing_plan
-from utils import get_feedback_stats, init_session_state
-from config import EXAMPLE_QUESTIONS, DEFAULT_API_KEY
+from rag_pipeline import (
+    build_knowledge_base,
+    compact_knowledge_base,
+    detach_knowledge_base,
+    remove_knowledge_sources,
+)
+from chat import run_chat
+from housing import get_housing_plan, is_housing_kb, precompute_progress, start_housing_precompute
+from utils import get_feedback_stats, init_session_state, log_feedback, rerun_region
+from config import (
+    EXAMPLE_QUESTIONS,
+    DEFAULT_API_KEY,
+    HOUSING_BUDGET_OPTIONS,
+    HOUSING_PRECOMPUTE,
+    HOUSING_PRIVACY_OPTIONS,
+    HOUSING_STAY_OPTIONS,
+    USE_RERANK,
+)
+from rag_chain import start_ranker_warmup
+from kb_registry import registry as kb_registry
+import embedding_service
+from answer_cache import answer_cache
+from vector_index import describe_index
+from telemetry import latency, span
+from feedback_store import get_feedback_store
+
+# 整页运行耗时（只统计完整跑完的整页运行，fragment 重跑单独计时）
+script_start = time.perf_counter()
 
 # --- 1. Page Configuration ---
 st.set_page_config(page_title="NTU Genie", page_icon="🏫", layout="wide")
 
+# Load and warm up the shared embedding model in the background (once per process)
+embedding_service.start_warmup()
+if USE_RERANK and "rerank_warmup_started" not in st.session_state:
+    st.session_state["rerank_warmup_started"] = True
+    start_ranker_warmup()
+
 # Initialize session state
 init_session_state()
 
@@ -54,8 +86,14 @@ with st.sidebar:
     else:
         kb_status = "⚠️ KB Not Loaded"
 
+    # Embedding model status
+    if embedding_service.is_ready():
+        model_status = "✅ Model Ready"
+    else:
+        model_status = "⏳ Model Warming Up"
+
     # Compact status line
-    st.caption(f"{api_status} | {kb_status}")
+    st.caption(f"{api_status} | {kb_status} | {model_status}")
 
     st.divider()
 
@@ -78,10 +116,7 @@ with st.sidebar:
             # KB loaded - show reset option
             st.success("✅ Knowledge Base Loaded")
             if st.button("🔄 Reset KB", use_container_width=True):
-                if "vectorstore" in st.session_state:
-                    del st.session_state["vectorstore"]
-                if "doc_stats" in st.session_state:
-                    del st.session_state["doc_stats"]
+                detach_knowledge_base()
                 st.rerun()
 
         st.divider()
@@ -104,56 +139,133 @@ with st.sidebar:
         )
         urls = [line.strip() for line in url_input.split('\n') if line.strip()]
 
-        # Build button
+        # Build button: add to the loaded KB incrementally, or build a new one
         if uploaded_files or urls:
-            if st.button("🔄 Build Custom KB", use_container_width=True):
+            kb_loaded = "vectorstore" in st.session_state
+            build_label = "➕ Add to KB" if kb_loaded else "🔄 Build Custom KB"
+            if st.button(build_label, use_container_width=True):
                 if not deepseek_api_key:
                     st.error("❌ Enter API Key first!")
                 else:
-                    build_knowledge_base(uploaded_files=uploaded_files, urls=urls)
+                    build_knowledge_base(uploaded_files=uploaded_files, urls=urls, incremental=kb_loaded)
 
         # Show data sources
         if "doc_stats" in st.session_state and st.session_state["doc_stats"]:
             st.divider()
             with st.expander("📊 Data Sources", expanded=False):
-                for stat in st.session_state["doc_stats"]:
-                    st.caption(f"• {stat['type']} **{stat['name']}** ({stat['chars']:,} chars)")
+                for i, stat in enumerate(st.session_state["doc_stats"]):
+                    src_col, rm_col = st.columns([5, 1])
+                    with src_col:
+                        st.caption(f"• {stat['type']} **{stat['name']}** ({stat['chars']:,} chars)")
+                    with rm_col:
+                        if st.button("🗑️", key=f"rm_source_{i}", help=f"Remove {stat['name']}"):
+                            remove_knowledge_sources([stat.get("source", stat["name"])])
+                            st.rerun()
 
-    # === Section 4: Diagnostics (default collapsed) ===
-    with st.expander("🔧 Diagnostics", expanded=False):
-        st.caption("**Feedback Statistics:**")
-        stats = get_feedback_stats()
+                if st.button("🧹 Compact Index", use_container_width=True, key="compact_kb"):
+                    compact_knowledge_base()
+                    st.toast("Index compacted", icon="🧹")
+
+    # === Section 4: Diagnostics (default hidden) ===
+    # 用开关而不是 expander：折叠的 expander 内容在每次 rerun 时仍会执行，
+    # 开关关闭时这里的统计（索引、延迟、反馈）完全不计算
+    if st.toggle("🔧 Diagnostics", value=False, key="show_diagnostics"):
+        with st.container(border=True):
+            st.caption("**Embedding Model:**")
+            model_info = embedding_service.get_status()
+            if model_info["ready"]:
+                st.caption(f"• `{model_info['source']}` loaded in {model_info['load_seconds']:.1f}s")
+            elif model_info["error"]:
+                st.caption(f"• ❌ Load failed: {model_info['error']}")
+            else:
+                st.caption("• Loading...")
+
+            st.caption("**Shared Indexes:**")
+            shared = kb_registry.stats()
+            if not shared:
+                st.caption("No index loaded in this process")
+            for entry in shared:
+                current = " (this session)" if entry["key"] == st.session_state.get("kb_key") else ""
+                st.caption(
+                    f"• `{entry['key'][:12]}`{current} | {entry['sessions']} session(s) | "
+                    f"{entry['chunks']:,} chunks | {entry['mb']:.1f} MB"
+                )
 
-        if stats["total"] == 0:
-            st.caption("No feedback yet")
-        else:
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.metric("Total", stats["total"])
-            with col2:
-                st.metric("👍", stats["ups"])
-            with col3:
-                st.metric("👎", stats["downs"])
-
-            if stats["recent"]:
-                st.caption("**Recent 5:**")
-                for r in stats["recent"]:
-                    q = (r.get("question") or "")[:40]
-                    st.caption(f"• {q}... | `{r.get('label')}`")
-
-            # Download button
-            import os
-            from config import FEEDBACK_LOG_FILE
-            if os.path.exists(FEEDBACK_LOG_FILE):
-                with open(FEEDBACK_LOG_FILE, "r", encoding="utf-8") as f:
-                    csv_data = f.read()
+            st.caption("**Vector Index:**")
+            if "vectorstore" not in st.session_state:
+                st.caption("No knowledge base loaded")
+            else:
+                info = describe_index(st.session_state["vectorstore"].index)
+                params = " | ".join(
+                    f"{k}={v}" for k, v in info.items() if k not in ("index_type", "ntotal", "mb")
+                )
+                st.caption(
+                    f"• `{info['index_type']}` | {info['ntotal']:,} vectors | {info['mb']:.1f} MB"
+                    + (f" | {params}" if params else "")
+                )
+                report = st.session_state.get("index_report")
+                if report and report.get("quantization", "none") != "none":
+                    saving = 1 - report["index_bytes"] / max(report["full_bytes"], 1)
+                    st.caption(
+                        f"• {report['quantization']}: {report['index_bytes'] / 1048576:.1f} MB vs "
+                        f"{report['full_bytes'] / 1048576:.1f} MB float32 (−{saving:.0%}) | "
+                        f"recall without re-scoring {report['recall_no_rescore']:.1%}"
+                    )
+                if report and report.get("ann_ms") is not None:
+                    st.caption(
+                        f"• recall@{report['k']} {report['recall']:.1%} vs exact | "
+                        f"{report['ann_ms']:.3f} ms/query (exact {report['exact_ms']:.3f} ms)"
+                    )
+                    for point in report.get("curve", []):
+                        setting = " ".join(f"{k}={v}" for k, v in point.items() if k not in ("recall", "ann_ms"))
+                        st.caption(f"  ◦ {setting}: recall {point['recall']:.1%}, {point['ann_ms']:.3f} ms")
+
+            st.caption("**Answer Cache:**")
+            cache_stats = answer_cache.stats()
+            st.caption(
+                f"• {cache_stats['entries']} cached answers | "
+                f"hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})"
+            )
+
+            st.caption("**Latency (rolling p50 / p95 / p99):**")
+            spans = latency.snapshot()
+            if not spans:
+                st.caption("No timings recorded yet")
+            for row in spans:
+                st.caption(
+                    f"• `{row['stage']}` {row['p50_ms']:.0f} / {row['p95_ms']:.0f} / {row['p99_ms']:.0f} ms "
+                    f"(n={row['count']})"
+                )
+
+            st.caption("**Feedback Statistics:**")
+            stats = get_feedback_stats()
+
+            if stats["total"] == 0:
+                st.caption("No feedback yet")
+            else:
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Total", stats["total"])
+                with col2:
+                    st.metric("👍", stats["ups"])
+                with col3:
+                    st.metric("👎", stats["downs"])
+
+                if stats["recent"]:
+                    st.caption("**Recent 5:**")
+                    for r in stats["recent"]:
+                        q = (r.get("question") or "")[:40]
+                        st.caption(f"• {q}... | `{r.get('label')}`")
+
+                # Download button：点击时才导出，不随每次 rerun 读取全部反馈
                 st.download_button(
                     label="📥 Download CSV",
-                    data=csv_data,
+                    data=get_feedback_store().export_csv,
                     file_name="feedback.csv",
                     mime="text/csv",
                     use_container_width=True,
-                    key="sidebar_download_feedback"
+                    key="sidebar_download_feedback",
+                    on_click="ignore",
                 )
 
 # --- 3. Main Content Area ---
@@ -177,154 +289,188 @@ if "vectorstore" not in st.session_state:
     st.caption("Or configure custom knowledge base in the sidebar →")
     st.stop()
 
-# === Tabs: Separate functional areas ===
-tab1, tab2 = st.tabs(["💬 Chat", "🏠 Housing Wizard"])
-
-# --- Tab 1: Chat (Main Stage) ---
-with tab1:
-    # Quick Start Questions - Show first 3 inline, rest in expander
-    st.caption("**Quick Start:**")
-
-    # Show first 3 questions as inline chips
-    cols = st.columns(3)
-    for i in range(min(3, len(EXAMPLE_QUESTIONS))):
-        with cols[i]:
-            question = EXAMPLE_QUESTIONS[i]
-            short_q = question[:35] + "..." if len(question) > 35 else question
-            if st.button(
-                short_q,
-                key=f"chip_inline_{i}",
-                use_container_width=True,
-                help=question
-            ):
-                st.session_state["prefill"] = question
-                st.rerun()
+# === Chat & Housing Wizard fragments ===
+# 两个区域各自是独立的 fragment：提问、点示例问题、反馈、生成住房方案时
+# 只重跑所在区域，不重跑侧边栏、统计面板和另一个标签页
+
+
+@st.fragment
+def chat_panel(deepseek_api_key: str) -> None:
+    """聊天区：示例问题 + 对话"""
+    with span("app.chat_fragment"):
+        # Quick Start Questions - Show first 3 inline, rest in expander
+        st.caption("**Quick Start:**")
+
+        # Show first 3 questions as inline chips
+        cols = st.columns(3)
+        for i in range(min(3, len(EXAMPLE_QUESTIONS))):
+            with cols[i]:
+                question = EXAMPLE_QUESTIONS[i]
+                short_q = question[:35] + "..." if len(question) > 35 else question
+                if st.button(
+                    short_q,
+                    key=f"chip_inline_{i}",
+                    use_container_width=True,
+                    help=question
+                ):
+                    st.session_state["prefill"] = question
+                    rerun_region()
+
+        # Rest in expander
+        if len(EXAMPLE_QUESTIONS) > 3:
+            with st.expander("➕ More Questions", expanded=False):
+                cols = st.columns(2)
+                for i in range(3, len(EXAMPLE_QUESTIONS)):
+                    col = cols[(i - 3) % 2]
+                    with col:
+                        question = EXAMPLE_QUESTIONS[i]
+                        short_q = question[:40] + "..." if len(question) > 40 else question
+                        if st.button(
+                            short_q,
+                            key=f"chip_more_{i}",
+                            use_container_width=True,
+                            help=question
+                        ):
+                            st.session_state["prefill"] = question
+                            rerun_region()
+
+        # Chat Interface
+        st.divider()
+        run_chat(deepseek_api_key)
 
-    # Rest in expander
-    if len(EXAMPLE_QUESTIONS) > 3:
-        with st.expander("➕ More Questions", expanded=False):
-            cols = st.columns(2)
-            for i in range(3, len(EXAMPLE_QUESTIONS)):
-                col = cols[(i - 3) % 2]
-                with col:
-                    question = EXAMPLE_QUESTIONS[i]
-                    short_q = question[:40] + "..." if len(question) > 40 else question
-                    if st.button(
-                        short_q,
-                        key=f"chip_more_{i}",
-                        use_container_width=True,
-                        help=question
-                    ):
-                        st.session_state["prefill"] = question
-                        st.rerun()
-
-    # Chat Interface
-    st.divider()
-    run_chat(deepseek_api_key)
 
-# --- Tab 2: Housing Wizard ---
-with tab2:
-    if "vectorstore" not in st.session_state:
-        st.warning("⚠️ Please load the knowledge base first from the sidebar.")
-    else:
-        # 标题和选项卡融合在一起
-        st.caption("🏠 Housing Recommendation Wizard")
-        col_a, col_b, col_c = st.columns(3)
-
-        with col_a:
-            budget = st.selectbox(
-                "💰 Budget",
-                ["Budget-friendly", "Moderate", "Premium comfort"],
-                index=0,
-                key="wizard_budget"
-            )
+@st.fragment
+def housing_panel(deepseek_api_key: str) -> None:
+    """住房推荐向导"""
+    with span("app.housing_fragment"):
+        if "vectorstore" not in st.session_state:
+            st.warning("⚠️ Please load the knowledge base first from the sidebar.")
+        else:
+            # 默认知识库：后台预计算所有偏好组合的方案（同一知识库同时只有一个任务；
+            # 每次重跑都会检查，失败后按退避时间重试，超过次数上限后不再自动启动）。
+            # 自定义知识库不预计算，点击按钮时实时生成
+            kb_fingerprint = st.session_state.get("kb_fingerprint")
+            precompute = HOUSING_PRECOMPUTE and is_housing_kb(kb_fingerprint)
+            if precompute and deepseek_api_key:
+                start_housing_precompute(st.session_state["vectorstore"], kb_fingerprint, deepseek_api_key)
+
+            # 标题和选项卡融合在一起
+            st.caption("🏠 Housing Recommendation Wizard")
+            col_a, col_b, col_c = st.columns(3)
+
+            with col_a:
+                budget = st.selectbox(
+                    "💰 Budget",
+                    HOUSING_BUDGET_OPTIONS,
+                    index=0,
+                    key="wizard_budget"
+                )
 
-        with col_b:
-            privacy = st.selectbox(
-                "🚪 Privacy",
-                ["Not important", "Nice to have", "Very important"],
-                index=1,
-                key="wizard_privacy"
-            )
+            with col_b:
+                privacy = st.selectbox(
+                    "🚪 Privacy",
+                    HOUSING_PRIVACY_OPTIONS,
+                    index=1,
+                    key="wizard_privacy"
+                )
 
-        with col_c:
-            stay_term = st.selectbox(
-                "📅 Duration",
-                ["One semester", "Full academic year"],
-                index=1,
-                key="wizard_stay"
-            )
+            with col_c:
+                stay_term = st.selectbox(
+                    "📅 Duration",
+                    HOUSING_STAY_OPTIONS,
+                    index=1,
+                    key="wizard_stay"
+                )
 
-        st.divider()
+            if precompute:
+                progress = precompute_progress(kb_fingerprint, deepseek_api_key)
+                if progress["done"] < progress["total"]:
+                    state = "preparing" if progress["running"] else "paused"
+                    st.caption(f"⚡ Instant plans {state}: {progress['done']}/{progress['total']} ready")
+                    if progress["error"] and not progress["running"]:
+                        retry = "will retry later" if progress["retrying"] else "stopped retrying"
+                        st.caption(f"⚠️ Last precompute attempt failed ({retry}): {progress['error']}")
 
-        if st.button("🎓 Generate Recommendations", type="primary", use_container_width=True):
-            if not deepseek_api_key:
-                st.error("❌ Enter API Key in sidebar first")
-            else:
-                with st.spinner("🤔 Generating personalized plan..."):
-                    plan = generate_housing_plan(
-                        {
-                            "budget": budget,
-                            "privacy": privacy,
-                            "stay_term": stay_term,
-                        },
-                        deepseek_api_key,
-                    )
+            st.divider()
 
-                st.success("✅ Recommendations generated!")
+            if st.button("🎓 Generate Recommendations", type="primary", use_container_width=True):
+                if not deepseek_api_key:
+                    st.error("❌ Enter API Key in sidebar first")
+                else:
+                    with st.spinner("🤔 Generating personalized plan..."):
+                        plan, precomputed = get_housing_plan(
+                            {
+                                "budget": budget,
+                                "privacy": privacy,
+                                "stay_term": stay_term,
+                            },
+                            deepseek_api_key,
+                        )
+
+                    st.success("✅ Recommendations generated!" + (" (instant)" if precomputed else ""))
+                    st.markdown("---")
+                    st.markdown(plan)
+
+                    # 保存到 session_state 以便反馈
+                    st.session_state["housing_plan"] = plan
+                    st.session_state["housing_preferences"] = {
+                        "budget": budget,
+                        "privacy": privacy,
+                        "stay_term": stay_term,
+                    }
+
+            # 显示反馈按钮（如果有生成的推荐）
+            if "housing_plan" in st.session_state and st.session_state.get("housing_plan"):
                 st.markdown("---")
-                st.markdown(plan)
-
-                # 保存到 session_state 以便反馈
-                st.session_state["housing_plan"] = plan
-                st.session_state["housing_preferences"] = {
-                    "budget": budget,
-                    "privacy": privacy,
-                    "stay_term": stay_term,
-                }
-
-        # 显示反馈按钮（如果有生成的推荐）
-        if "housing_plan" in st.session_state and st.session_state.get("housing_plan"):
-            st.markdown("---")
-            st.caption("Was this recommendation helpful?")
-
-            # 检查是否已有反馈
-            if "housing_feedback" not in st.session_state:
-                st.session_state["housing_feedback"] = None
-
-            if st.session_state["housing_feedback"] is None:
-                fb_col1, fb_col2 = st.columns(2)
-                with fb_col1:
-                    if st.button("👍 Helpful", key="housing_fb_up"):
-                        from utils import log_feedback
-                        interaction = {
-                            "question": f"Housing Wizard: {st.session_state.get('housing_preferences', {})}",
-                            "answer": st.session_state["housing_plan"],
-                            "used_rag": True,
-                            "sources": ["Housing Wizard"],
-                        }
-                        if log_feedback("up", interaction):
-                            st.session_state["housing_feedback"] = "up"
-                            st.toast("Thank you for your feedback!", icon="👍")
-                            st.rerun()
-                with fb_col2:
-                    if st.button("👎 Not Helpful", key="housing_fb_down"):
-                        from utils import log_feedback
-                        interaction = {
-                            "question": f"Housing Wizard: {st.session_state.get('housing_preferences', {})}",
-                            "answer": st.session_state["housing_plan"],
-                            "used_rag": True,
-                            "sources": ["Housing Wizard"],
-                        }
-                        if log_feedback("down", interaction):
-                            st.session_state["housing_feedback"] = "down"
-                            st.toast("Feedback recorded!", icon="👎")
-                            st.rerun()
-            else:
-                if st.session_state["housing_feedback"] == "up":
-                    st.caption("✅ You found this helpful")
+                st.caption("Was this recommendation helpful?")
+
+                # 检查是否已有反馈
+                if "housing_feedback" not in st.session_state:
+                    st.session_state["housing_feedback"] = None
+
+                if st.session_state["housing_feedback"] is None:
+                    fb_col1, fb_col2 = st.columns(2)
+                    with fb_col1:
+                        if st.button("👍 Helpful", key="housing_fb_up"):
+                            interaction = {
+                                "question": f"Housing Wizard: {st.session_state.get('housing_preferences', {})}",
+                                "answer": st.session_state["housing_plan"],
+                                "used_rag": True,
+                                "sources": ["Housing Wizard"],
+                            }
+                            if log_feedback("up", interaction):
+                                st.session_state["housing_feedback"] = "up"
+                                st.toast("Thank you for your feedback!", icon="👍")
+                                rerun_region()
+                    with fb_col2:
+                        if st.button("👎 Not Helpful", key="housing_fb_down"):
+                            interaction = {
+                                "question": f"Housing Wizard: {st.session_state.get('housing_preferences', {})}",
+                                "answer": st.session_state["housing_plan"],
+                                "used_rag": True,
+                                "sources": ["Housing Wizard"],
+                            }
+                            if log_feedback("down", interaction):
+                                st.session_state["housing_feedback"] = "down"
+                                st.toast("Feedback recorded!", icon="👎")
+                                rerun_region()
                 else:
-                    st.caption("✅ Feedback recorded")
+                    if st.session_state["housing_feedback"] == "up":
+                        st.caption("✅ You found this helpful")
+                    else:
+                        st.caption("✅ Feedback recorded")
+
+
+# === Tabs: Separate functional areas ===
+tab1, tab2 = st.tabs(["💬 Chat", "🏠 Housing Wizard"])
+
+# --- Tab 1: Chat (Main Stage) ---
+with tab1:
+    chat_panel(deepseek_api_key)
+
+# --- Tab 2: Housing Wizard ---
+with tab2:
+    housing_panel(deepseek_api_key)
 
 # --- Fixed Footer ---
 st.markdown(
@@ -354,3 +500,5 @@ st.markdown(
     """,
     unsafe_allow_html=True
 )
+
+latency.record("app.script", time.perf_counter() - script_start)
@@ -1,23 +1,32 @@
 """
 Main chat functionality - run_chat entry point
+
+回答（RAG 与无知识库时的直接回答）逐 token 流式写入占位消息，
+每条回答记录首 token 时间和总生成时间，显示在消息下方。
 """
+import time
+from typing import Callable, Iterable, Optional
+
 import streamlit as st
 
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
 
 from config import (
-    DEEPSEEK_MODEL,
-    DEEPSEEK_BASE_URL,
     DEFAULT_RETRIEVAL_K,
     SYSTEM_PROMPT_CHAT,
     USE_RERANK,
     RERANK_TOP_K,
+    CONTEXT_PACKING,
 )
-from utils import init_session_state
-from rag_chain import rerank_documents
+from utils import init_session_state, rerun_region
+from rag_chain import get_ranker, rerank_documents
+from answer_cache import answer_cache
+from llm_client import lease_llm_client
+from incremental_index import index_fingerprint
+from retrieval import embed_query, is_keyword_confident, lexical_search, routed_search
+from vector_index import cosine_similarities
+from context_packer import pack_context
+from telemetry import latency, span, stream_with_spans
 from chat_ui import scroll_to_bottom, render_chat_history
 
 # Re-export for backward compatibility
@@ -30,6 +39,9 @@ def run_chat(deepseek_api_key: str) -> None:
 
     Phase A: On new input, immediately add placeholder message and rerun
     Phase B: Process the question, generate answer, update message and rerun
+
+    Called from the chat fragment in app.py, so both reruns only re-execute
+    the chat region (see utils.rerun_region).
     """
     # 1. 初始化会话
     init_session_state()
@@ -41,8 +53,8 @@ def run_chat(deepseek_api_key: str) -> None:
     # 创建一个固定容器来放置所有对话内容
     chat_area = st.container()
 
-    # 2. 展示历史消息（带反馈按钮）
-    render_chat_history(chat_area)
+    # 2. 展示历史消息（带反馈按钮），占位消息返回可流式写入的输出槽
+    stream_slot = render_chat_history(chat_area)
 
     # 3. 获取用户输入
     user_input = st.chat_input("Type your question here...")
@@ -72,7 +84,7 @@ def run_chat(deepseek_api_key: str) -> None:
         })
         st.session_state["pending_prompt"] = prompt
         scroll_to_bottom()
-        st.rerun()
+        rerun_region()
 
     # ========== 阶段 B：处理待处理的问题，生成真正的回答 ==========
     pending = st.session_state.get("pending_prompt")
@@ -80,25 +92,38 @@ def run_chat(deepseek_api_key: str) -> None:
         prompt = pending
         st.session_state["pending_prompt"] = None
 
-        try:
-            # 初始化 LLM
-            llm = ChatOpenAI(
-                model=DEEPSEEK_MODEL,
-                openai_api_key=deepseek_api_key,
-                base_url=DEEPSEEK_BASE_URL,
-            )
+        # 记录首字延迟（从开始处理问题到第一个 token）和总生成时间
+        start = time.perf_counter()
+        timings = {"ttft_s": None, "total_s": None}
+
+        def on_token(partial_answer: str) -> None:
+            if timings["ttft_s"] is None:
+                timings["ttft_s"] = time.perf_counter() - start
+            if stream_slot is not None:
+                stream_slot.markdown(partial_answer + "▌")
 
+        try:
             used_rag = False
+            from_cache = False
             source_names = []
 
-            # 如果有向量知识库 → 使用 RAG
-            if "vectorstore" in st.session_state:
-                answer, source_names = _generate_rag_answer(llm, prompt)
-                used_rag = True
-            else:
-                # fallback to general chat
-                response = llm.invoke([HumanMessage(content=prompt)])
-                answer = response.content
+            # 共享的 LLM 客户端（复用连接池和预编译 chain）；生成期间持有租约，避免被淘汰时关闭
+            with lease_llm_client(deepseek_api_key) as client:
+                # 如果有向量知识库 → 使用 RAG（先查语义答案缓存）
+                if "vectorstore" in st.session_state:
+                    answer, source_names, from_cache = _cached_rag_answer(client, prompt, on_token=on_token)
+                    used_rag = True
+                else:
+                    # fallback to general chat
+                    answer = _collect_stream(
+                        (chunk.content for chunk in client.llm.stream([HumanMessage(content=prompt)])),
+                        on_token,
+                    )
+
+            timings["total_s"] = time.perf_counter() - start
+            latency.record("chat.total", timings["total_s"], cached=from_cache, rag=used_rag)
+            if timings["ttft_s"] is not None:
+                latency.record("chat.ttft", timings["ttft_s"], cached=from_cache, rag=used_rag)
 
             # 更新占位消息为真正的回答
             st.session_state.messages[-1] = {
@@ -106,6 +131,8 @@ def run_chat(deepseek_api_key: str) -> None:
                 "content": answer,
                 "used_rag": used_rag,
                 "sources": source_names,
+                "timings": timings,
+                "cached": from_cache,
             }
 
             # Record last interaction
@@ -114,10 +141,11 @@ def run_chat(deepseek_api_key: str) -> None:
                 "answer": answer,
                 "used_rag": used_rag,
                 "sources": source_names,
+                "timings": timings,
             }
 
             scroll_to_bottom()
-            st.rerun()
+            rerun_region()
 
         except Exception as e:
             import traceback
@@ -128,21 +156,95 @@ def run_chat(deepseek_api_key: str) -> None:
                 "used_rag": False,
                 "sources": [],
             }
-            st.rerun()
+            rerun_region()
 
 
-def _generate_rag_answer(llm, prompt: str) -> tuple[str, list]:
+def _collect_stream(chunks: Iterable, on_token: Optional[Callable[[str], None]] = None) -> str:
     """
-    Generate answer using RAG pipeline.
+    Accumulate streamed text chunks, reporting the partial answer after each one.
+
+    Args:
+        chunks: iterable of text chunks (non-string chunks are ignored)
+        on_token: callback receiving the answer accumulated so far
 
     Returns:
-        tuple of (answer_text, source_names_list)
+        The full answer text
+    """
+    parts = []
+    for chunk in chunks:
+        if not isinstance(chunk, str) or not chunk:
+            continue
+        parts.append(chunk)
+        if on_token is not None:
+            on_token("".join(parts))
+    return "".join(parts)
+
+
+def _cached_rag_answer(
+    client, prompt: str, on_token: Optional[Callable[[str], None]] = None
+) -> tuple[str, list, bool]:
+    """
+    Answer from the semantic answer cache when possible, otherwise run RAG and cache the result.
+
+    Exact (normalized) repeats skip embedding entirely; near-duplicates are matched by
+    query embedding, which is then reused for retrieval on a miss. Keyword queries that
+    the lexical index answers confidently skip embedding (and the near-duplicate lookup).
+
+    Returns:
+        tuple of (answer_text, source_names_list, served_from_cache)
     """
     vectorstore = st.session_state["vectorstore"]
+    kb_fingerprint = st.session_state.get("kb_fingerprint") or index_fingerprint(vectorstore)
+
+    lexical_hits = lexical_search(vectorstore, prompt, max(DEFAULT_RETRIEVAL_K * 3, 20))
+    keyword_only = is_keyword_confident(vectorstore, prompt, lexical_hits)
+    embed = None if keyword_only else (lambda text: embed_query(vectorstore, text))
+
+    hit, query_vector = answer_cache.lookup(kb_fingerprint, prompt, embed=embed)
+    if hit is not None:
+        if on_token is not None:
+            on_token(hit["answer"])
+        return hit["answer"], hit["sources"], True
+
+    answer, source_names = _generate_rag_answer(
+        client, prompt, on_token=on_token, query_vector=query_vector, lexical_hits=lexical_hits
+    )
+    if answer.strip():
+        answer_cache.store(kb_fingerprint, prompt, answer, source_names, query_vector=query_vector)
+    return answer, source_names, False
+
+
+def _generate_rag_answer(
+    client,
+    prompt: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    query_vector: Optional[list] = None,
+    lexical_hits: Optional[list] = None,
+    vectorstore=None,
+) -> tuple[str, list]:
+    """
+    Generate answer using RAG pipeline, streaming tokens as they arrive.
+
+    Args:
+        client: shared LLMClient for the user's API key
+        prompt: user question
+        on_token: optional callback receiving the partial answer after each token
+        query_vector: precomputed query embedding (skips re-embedding the prompt;
+            also enables the context similarity cut-off)
+        lexical_hits: precomputed BM25 hits (skips re-running keyword search)
+        vectorstore: knowledge base to search (defaults to the session's; lets it run headless)
+
+    Returns:
+        tuple of (answer_text, source_names_list)
+    """
+    if vectorstore is None:
+        vectorstore = st.session_state["vectorstore"]
 
-    # Retrieve documents
-    retriever = vectorstore.as_retriever(search_kwargs={"k": DEFAULT_RETRIEVAL_K})
-    raw_docs = retriever.get_relevant_documents(prompt)
+    # Retrieve documents from the routed topic shards (BM25 + vector, fused by rank)
+    raw_docs = routed_search(
+        vectorstore, prompt, DEFAULT_RETRIEVAL_K,
+        query_vector=query_vector, lexical_hits=lexical_hits,
+    )
 
     # Ensure return value is a list
     if not isinstance(raw_docs, list):
@@ -155,22 +257,28 @@ def _generate_rag_answer(llm, prompt: str) -> tuple[str, list]:
 
     # Rerank if enabled
     if USE_RERANK and len(retrieved_docs) > 0:
-        docs = rerank_documents(prompt, retrieved_docs, top_k=RERANK_TOP_K)
+        with span("chat.rerank", candidates=len(retrieved_docs)):
+            docs = rerank_documents(prompt, retrieved_docs, top_k=RERANK_TOP_K, ranker=get_ranker())
     else:
         docs = retrieved_docs[:RERANK_TOP_K]
 
     # Final filter
     docs = [d for d in docs if hasattr(d, "page_content")]
 
-    # Generate answer
-    prompt_tmpl = ChatPromptTemplate.from_template(SYSTEM_PROMPT_CHAT)
-    doc_chain = create_stuff_documents_chain(llm, prompt_tmpl)
-    result = doc_chain.invoke({"context": docs, "input": prompt})
+    # Pack context: drop low-similarity hits, merge same-source overlaps, fit the token budget
+    if CONTEXT_PACKING and docs:
+        pack_start = time.perf_counter()
+        similarities = None
+        if query_vector is not None:
+            similarities = cosine_similarities(
+                vectorstore, query_vector, [d.metadata.get("chunk_id") for d in docs]
+            )
+        docs, pack_stats = pack_context(docs, similarities)
+        latency.record("chat.pack", time.perf_counter() - pack_start, **pack_stats)
 
-    if isinstance(result, dict):
-        answer = result.get("output_text") or result.get("answer") or str(result)
-    else:
-        answer = str(result)
+    # Generate answer
+    doc_chain = client.stuff_chain(SYSTEM_PROMPT_CHAT)
+    answer = stream_with_spans(doc_chain, {"context": docs, "input": prompt}, "chat", on_token=on_token)
 
     # Extract sources
     source_names = []
@@ -184,8 +292,10 @@ def _generate_rag_answer(llm, prompt: str) -> tuple[str, list]:
                 break
         if not src:
             src = "Unknown source"
-        if src not in seen:
-            seen.add(src)
-            source_names.append(src)
+        # Near-duplicate chunks merged at build time carry every source they came from
+        for name in [src] + list(meta.get("sources") or []):
+            if name not in seen:
+                seen.add(name)
+                source_names.append(name)
 
     return answer, source_names
@@ -1,10 +1,15 @@
 """
 Chat UI utilities - scroll, message rendering, feedback buttons
+
+长对话每次重跑都渲染全部消息和反馈按钮会越来越慢：只渲染最近 CHAT_HISTORY_WINDOW 条消息，
+更早的消息收在 "Show earlier messages" 开关后面，打开之前不渲染。
+反馈结果保存在消息自身（msg["feedback"]），不再为每条消息占用一个会话键。
 """
 import streamlit as st
 import streamlit.components.v1 as components
 
-from utils import log_feedback
+from config import CHAT_HISTORY_WINDOW
+from utils import log_feedback, rerun_region
 
 
 def scroll_to_bottom():
@@ -29,24 +34,47 @@ def render_chat_anchor():
     st.markdown('<div id="chat-bottom"></div>', unsafe_allow_html=True)
 
 
-def render_message_with_feedback(msg: dict, idx: int):
+def render_message_with_feedback(msg: dict, idx: int, interactive: bool = True):
     """
     渲染单条消息及其反馈按钮
 
     Args:
-        msg: 消息字典，包含 role, content, is_placeholder, used_rag, sources 等
+        msg: 消息字典，包含 role, content, is_placeholder, used_rag, sources, feedback 等
         idx: 消息在列表中的索引
+        interactive: 是否渲染反馈按钮（归档区的旧消息只显示已有的反馈状态）
+
+    Returns:
+        占位消息的输出槽（用于流式写入回答），其他消息返回 None
     """
+    slot = None
     with st.chat_message(msg["role"]):
         # 检查是否是占位消息（正在生成中）
         if msg.get("is_placeholder"):
-            st.caption("🔍 Searching knowledge base...")
+            slot = st.empty()
+            slot.caption("🔍 Searching knowledge base...")
         else:
             st.write(msg["content"])
+            render_timings(msg)
 
         # 为每条助手消息添加反馈按钮（跳过欢迎消息和占位消息）
         if msg["role"] == "assistant" and idx > 0 and not msg.get("is_placeholder"):
-            render_feedback_buttons(msg, idx)
+            if interactive:
+                render_feedback_buttons(msg, idx)
+            else:
+                render_feedback_status(msg)
+
+    return slot
+
+
+def render_timings(msg: dict):
+    """显示回答的首字延迟和总生成时间"""
+    timings = msg.get("timings")
+    if not timings or timings.get("total_s") is None:
+        return
+    ttft = timings.get("ttft_s")
+    ttft_text = f"first token {ttft:.1f}s · " if ttft is not None else ""
+    cached_text = " · ⚡ cached" if msg.get("cached") else ""
+    st.caption(f"⏱️ {ttft_text}total {timings['total_s']:.1f}s{cached_text}")
 
 
 def render_feedback_buttons(msg: dict, idx: int):
@@ -57,13 +85,8 @@ def render_feedback_buttons(msg: dict, idx: int):
         msg: 消息字典
         idx: 消息索引
     """
-    # 检查是否已经有反馈记录
-    feedback_key = f"feedback_{idx}"
-    if feedback_key not in st.session_state:
-        st.session_state[feedback_key] = None
-
-    # 如果还没有反馈，显示按钮
-    if st.session_state[feedback_key] is None:
+    # 反馈状态直接保存在消息字典中（msg["feedback"]），不为每条消息单独占用一个 session key
+    if msg.get("feedback") is None:
         fb_col1, fb_col2 = st.columns(2)
         with fb_col1:
             if st.button("👍 Helpful", key=f"fb_up_{idx}"):
@@ -77,9 +100,9 @@ def render_feedback_buttons(msg: dict, idx: int):
                     "sources": msg.get("sources", []),
                 }
                 if log_feedback("up", interaction):
-                    st.session_state[feedback_key] = "up"
+                    msg["feedback"] = "up"
                     st.toast("Thank you for your feedback!", icon="👍")
-                    st.rerun()
+                    rerun_region()
         with fb_col2:
             if st.button("👎 Not Helpful", key=f"fb_down_{idx}"):
                 question = st.session_state.messages[idx - 1]["content"] if idx > 0 else ""
@@ -91,30 +114,71 @@ def render_feedback_buttons(msg: dict, idx: int):
                     "sources": msg.get("sources", []),
                 }
                 if log_feedback("down", interaction):
-                    st.session_state[feedback_key] = "down"
+                    msg["feedback"] = "down"
                     st.toast("Feedback recorded!", icon="👎")
-                    st.rerun()
+                    rerun_region()
     else:
-        # 已经有反馈，显示状态
-        if st.session_state[feedback_key] == "up":
-            st.caption("✅ You found this helpful")
-        else:
-            st.caption("✅ Feedback recorded")
+        render_feedback_status(msg)
+
+
+def render_feedback_status(msg: dict):
+    """显示已有的反馈状态（没有反馈时不显示）"""
+    if msg.get("feedback") == "up":
+        st.caption("✅ You found this helpful")
+    elif msg.get("feedback") == "down":
+        st.caption("✅ Feedback recorded")
+
+
+def _window_start(messages: list, window: int) -> int:
+    """
+    完整渲染区的起始索引：最近 window 条消息，且不把一问一答拆到两边
+    """
+    start = max(0, len(messages) - window)
+    if 0 < start < len(messages) and messages[start]["role"] == "assistant":
+        start -= 1
+    return start
+
+
+def _is_visible(msg: dict) -> bool:
+    # 跳过空的欢迎消息（占位消息内容为空但需要渲染）
+    return bool(msg["content"].strip()) or bool(msg.get("is_placeholder"))
 
 
 def render_chat_history(chat_area):
     """
     渲染聊天历史记录
 
+    只完整渲染最近 CHAT_HISTORY_WINDOW 条消息（带反馈按钮）；更早的消息收进归档区，
+    用开关按需展开（关闭时不渲染），每次 rerun 的开销不随对话长度增长。
+
     Args:
         chat_area: Streamlit container for chat messages
+
+    Returns:
+        占位消息的输出槽（如有），供流式生成时逐步写入回答
     """
+    messages = st.session_state.messages
+    start = _window_start(messages, CHAT_HISTORY_WINDOW)
+
+    stream_slot = None
     with chat_area:
-        for idx, msg in enumerate(st.session_state.messages):
-            # 跳过空的欢迎消息
-            if not msg["content"].strip():
+        if start > 0:
+            archived = sum(1 for msg in messages[:start] if _is_visible(msg))
+            if st.toggle(f"🗂️ Show {archived} earlier messages", value=False, key="show_chat_archive"):
+                with st.container(border=True):
+                    for idx in range(start):
+                        if _is_visible(messages[idx]):
+                            render_message_with_feedback(messages[idx], idx, interactive=False)
+
+        for idx in range(start, len(messages)):
+            msg = messages[idx]
+            if not _is_visible(msg):
                 continue
-            render_message_with_feedback(msg, idx)
+            slot = render_message_with_feedback(msg, idx)
+            if slot is not None:
+                stream_slot = slot
 
         # 在聊天区底部放置锚点
         render_chat_anchor()
+
+    return stream_slot
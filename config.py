@@ -6,6 +6,14 @@ Configuration file - Application constants and settings
 DEEPSEEK_MODEL = "deepseek-chat"
 DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
 
+# LLM Connection Pooling
+# One client (keep-alive HTTP pool + compiled chains) per API key, shared by all sessions
+LLM_MAX_CONNECTIONS = 20
+LLM_MAX_KEEPALIVE_CONNECTIONS = 10
+LLM_KEEPALIVE_EXPIRY_SECONDS = 60
+LLM_TIMEOUT_SECONDS = 120
+LLM_CLIENT_MAX_KEYS = 32  # Least recently used clients are evicted beyond this and closed once idle
+
 # Default API Key (for testing/demo purposes)
 # Reads from Streamlit secrets (both local .streamlit/secrets.toml and cloud)
 import os
@@ -24,16 +32,147 @@ DEFAULT_API_KEY = get_api_key()
 # Embedding Configuration
 # Use multilingual model to support both Chinese and English queries
 EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# Local model bundle (created by scripts/download_embedding_model.py).
+# When present, the model is loaded from here with no network access.
+EMBEDDING_MODEL_DIR = "models/paraphrase-multilingual-MiniLM-L12-v2"
 
 # RAG Configuration
 DEFAULT_CHUNK_SIZE = 500  # Reduced: smaller chunks = more focused semantic matching
 DEFAULT_CHUNK_OVERLAP = 100  # Reduced proportionally
-DEFAULT_RETRIEVAL_K = 10  # Increased: retrieve more candidates to avoid missing answers
+SPLITTER_MODE = "structured"  # "structured" (heading/FAQ sections) or "recursive" (see Document Splitting)
+# Structured chunks are whole sections, so fewer are needed per answer
+DEFAULT_RETRIEVAL_K = 6 if SPLITTER_MODE == "structured" else 10
 USE_RERANK = False  # Disabled: rerank model has poor Chinese support
-RERANK_TOP_K = 10  # Increased to match retrieval_k
+RERANK_TOP_K = DEFAULT_RETRIEVAL_K  # Match retrieval_k
+RERANK_MODEL = "ms-marco-MiniLM-L-12-v2"
+RERANK_CACHE_DIR = ".cache/flashrank"  # Model files, resolved once per process
+RERANK_BATCH_WINDOW_MS = 5  # Collect concurrent queries' passages into one batch
+RERANK_MAX_BATCH = 64  # Max (query, passage) pairs per model call
+RERANK_SCORE_CACHE_SIZE = 20000  # Memoized (query, chunk id) scores
+
+# Document Splitting (SPLITTER_MODE is set under RAG Configuration)
+# "structured": files organised by headings (#/##/###, "=== part ===", Q&A blocks,
+# 【labels】) are split at section boundaries, keeping each section whole up to
+# STRUCTURED_CHUNK_SIZE characters and recording metadata["heading_path"].
+# Documents with fewer than STRUCTURED_MIN_HEADINGS headings use the recursive
+# character splitter (DEFAULT_CHUNK_SIZE / DEFAULT_CHUNK_OVERLAP).
+STRUCTURED_CHUNK_SIZE = 1500
+STRUCTURED_MIN_HEADINGS = 3
+
+# Hybrid Retrieval
+# BM25 keyword hits (Chinese bigrams + English words) are fused with vector hits
+# by Reciprocal Rank Fusion. Short keyword queries whose terms all appear in the
+# top BM25 hit skip query embedding and vector search entirely.
+HYBRID_RETRIEVAL = True
+RRF_K = 60  # Standard RRF damping constant
+LEXICAL_FAST_PATH = True
+LEXICAL_FAST_PATH_MAX_TOKENS = 6  # Only keyword-style queries take the fast path
+
+# Topic Routing
+# Each chunk is tagged with one topic (by section heading, source file name, then
+# content keywords) and every topic gets its own sub-index. Queries are routed by
+# keywords, or by the nearest topic centroid when no keyword matches; ambiguous
+# routes, shards with fewer than k chunks and weak shard hits (best cosine below
+# TOPIC_FALLBACK_MIN_SIMILARITY) fall back to searching the whole knowledge base.
+# The Housing Wizard always searches the housing shard.
+TOPIC_ROUTING = True
+TOPICS = ["housing", "visa", "academics", "transport", "campus_life"]
+TOPIC_ROUTER_MAX_SHARDS = 2  # More matching topics than this counts as ambiguous
+TOPIC_CENTROID_MARGIN = 0.05  # Nearest centroid must beat the runner-up by this cosine
+TOPIC_FALLBACK_MIN_SIMILARITY = 0.3
+
+# Near-Duplicate Chunk Removal
+# After splitting, chunks whose MinHash-estimated Jaccard similarity (character
+# shingles) is at least NEAR_DUP_THRESHOLD are collapsed into one chunk that keeps
+# the union of their sources in metadata["sources"].
+NEAR_DUP_DEDUP = True
+NEAR_DUP_THRESHOLD = 0.8
+NEAR_DUP_NUM_PERM = 64
+NEAR_DUP_BANDS = 16  # 16 bands x 4 rows: pairs above ~0.5 similarity become candidates
+NEAR_DUP_SHINGLE = 5  # Characters per shingle
+
+# Context Packing
+# Before generation, retrieved chunks below CONTEXT_MIN_SIMILARITY (query cosine) are
+# dropped, adjacent/overlapping chunks from the same source are merged, and the rest are added
+# in rank order until CONTEXT_TOKEN_BUDGET prompt tokens (tiktoken) are used.
+CONTEXT_PACKING = True
+CONTEXT_TOKEN_BUDGET = 3000  # cl100k counts ~1 token per Chinese character
+CONTEXT_MIN_SIMILARITY = 0.3
+CONTEXT_MIN_OVERLAP_CHARS = 20  # Chunks without start_index: shorter shared edges are not overlap
+CONTEXT_ADJACENT_GAP_CHARS = 4  # Chunks with start_index: merge across gaps up to this many chars
+CONTEXT_TOKENIZER = "cl100k_base"  # Falls back to a character estimate if unavailable offline
+
+# Vector Index Type
+# "flat" (exact), "hnsw", "ivf", or "auto" (chosen by chunk count). ANN search
+# parameters (HNSW efSearch / IVF nprobe) are tuned at build time against the
+# exact index until recall@k reaches ANN_TARGET_RECALL.
+VECTOR_INDEX_TYPE = "auto"
+ANN_AUTO_FLAT_MAX = 20000  # "auto": exact search up to this many chunks
+ANN_AUTO_HNSW_MAX = 500000  # "auto": HNSW up to this many chunks, IVF above
+ANN_TARGET_RECALL = 0.95
+ANN_EVAL_QUERIES = 200  # Perturbed corpus vectors used as recall-report queries
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+# Vector Quantization
+# "none", "fp16" (2 bytes/dim) or "int8" (1 byte/dim) scalar quantization of the
+# index. Full-precision vectors stay on disk (memory-mapped) and re-score the
+# top k * RESCORE_CANDIDATES_FACTOR candidates of each search.
+VECTOR_QUANTIZATION = "none"
+RESCORE_CANDIDATES_FACTOR = 4
+VECTOR_STORE_DIR = ".cache/vectors"
+
+# Semantic Answer Cache
+# Exact (normalized) prompt matches, plus near-duplicate questions whose
+# embedding cosine similarity is at least ANSWER_CACHE_SIMILARITY.
+# Entries are keyed by the KB fingerprint, so rebuilding the KB invalidates them.
+ANSWER_CACHE_MAX_ENTRIES = 512
+ANSWER_CACHE_TTL_SECONDS = 6 * 3600
+ANSWER_CACHE_SIMILARITY = 0.95
+
+# Document Loading Configuration
+LOADER_MAX_THREADS = 8  # Concurrent URL fetches / text file reads
+PDF_MAX_PROCESSES = 4  # PDF parsing worker processes (capped by CPU count)
+# PDFs are parsed in the worker processes PDF_PAGE_BATCH pages per task; each batch is
+# split, deduplicated and embedded (EMBED_BATCH_SIZE chunks at a time) as soon as it
+# arrives, so transient memory does not grow with document length.
+PDF_PAGE_BATCH = 16
+EMBED_BATCH_SIZE = 256
+
+# Index Cache Configuration
+# Default KB index is cached on disk, keyed by file hashes + model + chunk params
+INDEX_CACHE_DIR = ".cache/faiss_index"
+INDEX_CACHE_MAX_ENTRIES = 3  # Keep only the most recently used builds
+
+# Chunk-level embedding cache (content hash + EMBEDDING_MODEL -> vector)
+EMBEDDING_CACHE_DIR = ".cache/embeddings"
+
+# Shared Index Registry
+# Built indexes are shared read-only by all sessions in the process.
+# Idle indexes are evicted (LRU) above this ceiling; indexes in use never are.
+KB_REGISTRY_MAX_MB = 1024
+
+# Latency Telemetry
+# Per-stage spans (build.*, retrieval.*, chat.*, housing.*) keep the last
+# TELEMETRY_WINDOW samples for rolling percentiles and are appended as JSON lines
+# by a background writer; the log rotates to .1 ... .N once it reaches TELEMETRY_LOG_MAX_MB.
+TELEMETRY_ENABLED = True
+TELEMETRY_WINDOW = 500
+TELEMETRY_LOG_FILE = "telemetry_log.jsonl"
+TELEMETRY_LOG_MAX_MB = 10
+TELEMETRY_LOG_BACKUPS = 3
+TELEMETRY_FLUSH_INTERVAL_SECONDS = 1.0
+
+# Chat History Rendering
+# Only the most recent CHAT_HISTORY_WINDOW messages are rendered with feedback buttons;
+# older ones are collapsed into an archive that is rendered only when expanded.
+CHAT_HISTORY_WINDOW = 20
 
 # File Configuration
-FEEDBACK_LOG_FILE = "feedback_log.csv"
+FEEDBACK_LOG_FILE = "feedback_log.csv"  # Legacy log, imported into FEEDBACK_DB_FILE on first start
+FEEDBACK_DB_FILE = "feedback.sqlite"
+FEEDBACK_BATCH_SIZE = 50  # Pending feedback rows written in one transaction
+FEEDBACK_FLUSH_INTERVAL_SECONDS = 1.0
 SUPPORTED_FILE_TYPES = ["pdf", "txt"]
 
 # Default Example Questions (English)
@@ -46,6 +185,21 @@ EXAMPLE_QUESTIONS = [
     "What is NTU's grading system and GPA calculation?",
 ]
 
+# Housing Wizard Options (every combination is precomputed for the default KB)
+HOUSING_BUDGET_OPTIONS = ["Budget-friendly", "Moderate", "Premium comfort"]
+HOUSING_PRIVACY_OPTIONS = ["Not important", "Nice to have", "Very important"]
+HOUSING_STAY_OPTIONS = ["One semester", "Full academic year"]
+HOUSING_PLAN_CACHE_DIR = ".cache/housing_plans"
+# Generate all 18 plans in the background with the visitor's API key once the
+# default KB is loaded; custom KBs always generate live. Only the current
+# default KB's plans are kept on disk.
+HOUSING_PRECOMPUTE = True
+# A failed precompute run stops at its first error and is retried after
+# HOUSING_PRECOMPUTE_RETRY_SECONDS, doubling each time, at most
+# HOUSING_PRECOMPUTE_MAX_ATTEMPTS times per knowledge base and API key.
+HOUSING_PRECOMPUTE_RETRY_SECONDS = 60
+HOUSING_PRECOMPUTE_MAX_ATTEMPTS = 4
+
 # Default Knowledge Base File Paths
 DEFAULT_KNOWLEDGE_FILES = [
     "data/ntu_housing_extended.txt",  # Housing application guide
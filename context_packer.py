@@ -0,0 +1,237 @@
+"""
+Context packer - fits retrieved chunks into a prompt token budget
+
+检索结果直接塞进 prompt 时，同一文件中相邻片段的重叠部分（最多 DEFAULT_CHUNK_OVERLAP 个字符）
+会重复发送，且低相关片段也会占用 token。这里在生成前：
+1. 去掉与查询余弦相似度低于 CONTEXT_MIN_SIMILARITY 的片段（至少保留排名第一的片段）；
+2. 把同一原文中相邻、重叠或互相包含的片段合并成一段；
+3. 按检索排名依次放入，直到 CONTEXT_TOKEN_BUDGET（用 tiktoken 计数）用完。
+"""
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from config import (
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_MIN_SIMILARITY,
+    CONTEXT_MIN_OVERLAP_CHARS,
+    CONTEXT_ADJACENT_GAP_CHARS,
+    CONTEXT_TOKENIZER,
+    DEFAULT_CHUNK_OVERLAP,
+)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_failed = False
+
+
+def _get_encoding():
+    """加载 tiktoken 编码（首次使用时可能需要下载词表）；不可用时返回 None"""
+    global _encoding, _encoding_failed
+    if _encoding is not None or _encoding_failed:
+        return _encoding
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER)
+            except Exception:
+                # 离线且没有缓存词表时退回字符估算，不影响问答
+                _encoding_failed = True
+    return _encoding
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算：中日韩字符约 1 token / 字，其余约 4 字符 / token"""
+    cjk = sum(1 for ch in text if "\u3400" <= ch <= "\u9fff" or "\uf900" <= ch <= "\ufaff")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    """文本的 token 数"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截断到不超过 max_tokens 个 token"""
+    encoding = _get_encoding()
+    if encoding is None:
+        while text and _estimate_tokens(text) > max_tokens:
+            text = text[: int(len(text) * 0.9)]
+        return text
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def _group_of(doc: Document) -> Optional[Tuple[str, object]]:
+    """同一原文的片段归为一组：(来源, 页码)；没有来源的片段不参与合并"""
+    meta = doc.metadata or {}
+    for key in ("source", "file_path", "url"):
+        if meta.get(key):
+            return meta[key], meta.get("page")
+    return None
+
+
+def _merge_by_position(a: Dict, b: Dict) -> bool:
+    """
+    按 start_index 合并：两段在原文中重叠或间隔不超过 CONTEXT_ADJACENT_GAP_CHARS 时，把 b 并入 a
+
+    间隔处（切分时去掉的空白）以等长换行补齐，使合并后的文本长度与原文区间一致。
+    """
+    first, second = (a, b) if a["start"] <= b["start"] else (b, a)
+    gap = second["start"] - first["end"]
+    if gap > CONTEXT_ADJACENT_GAP_CHARS:
+        return False
+    if second["end"] <= first["end"]:
+        text = first["text"]
+    elif gap >= 0:
+        text = first["text"] + "\n" * gap + second["text"]
+    else:
+        text = first["text"] + second["text"][-gap:]
+    a.update(text=text, start=first["start"], end=max(first["end"], second["end"]))
+    return True
+
+
+def _merge_by_text(a: Dict, b: Dict) -> bool:
+    """
+    没有位置信息时按文本合并：互相包含，或一段的结尾与另一段的开头重叠
+    """
+    x, y = a["text"], b["text"]
+    if y in x:
+        return True
+    if x in y:
+        a["text"] = y
+        return True
+    max_overlap = min(len(x), len(y), max(DEFAULT_CHUNK_OVERLAP * 2, CONTEXT_MIN_OVERLAP_CHARS))
+    for size in range(max_overlap, CONTEXT_MIN_OVERLAP_CHARS - 1, -1):
+        if x.endswith(y[:size]):
+            a["text"] = x + y[size:]
+            return True
+        if y.endswith(x[:size]):
+            a["text"] = y + x[size:]
+            return True
+    return False
+
+
+def _try_merge(a: Dict, b: Dict) -> bool:
+    if a["start"] is not None and b["start"] is not None:
+        merged = _merge_by_position(a, b)
+    else:
+        merged = _merge_by_text(a, b)
+        if merged:
+            # 拼接后的文本不再对应原文中的一段连续位置
+            a["start"] = a["end"] = None
+    if merged:
+        a["count"] += b["count"]
+    return merged
+
+
+def merge_overlapping(docs: List[Document]) -> List[Document]:
+    """
+    合并同一原文中相邻或重叠的片段，结果保持原排名顺序（合并块位于其中排名最高的片段处）
+
+    片段带有 start_index（切分时记录）时按位置合并，否则按文本重叠合并。
+    合并块的 metadata 沿用排名最高的片段，并记录 merged_chunks（合并的片段数）。
+    """
+    blocks: List[Dict] = []
+    by_group: Dict[Tuple[str, object], List[Dict]] = {}
+    for doc in docs:
+        meta = doc.metadata or {}
+        start = meta.get("start_index")
+        block = {
+            "text": doc.page_content,
+            "metadata": dict(meta),
+            "count": 1,
+            "start": start,
+            "end": start + len(doc.page_content) if start is not None else None,
+        }
+        group = _group_of(doc)
+        if group is None:
+            blocks.append(block)
+            continue
+
+        # 并入已有的同组块；合并后该块可能与组内其他块相连，继续吸收
+        siblings = by_group.setdefault(group, [])
+        target = next((other for other in siblings if _try_merge(other, block)), None)
+        if target is None:
+            blocks.append(block)
+            siblings.append(block)
+            continue
+        changed = True
+        while changed:
+            changed = False
+            for other in siblings:
+                if other is not target and _try_merge(target, other):
+                    by_group[group] = siblings = [b for b in siblings if b is not other]
+                    blocks = [b for b in blocks if b is not other]
+                    changed = True
+                    break
+
+    packed = []
+    for block in blocks:
+        metadata = block["metadata"]
+        if block["count"] > 1:
+            metadata["merged_chunks"] = block["count"]
+        packed.append(Document(page_content=block["text"], metadata=metadata))
+    return packed
+
+
+def pack_context(
+    docs: List[Document],
+    similarities: Optional[List[Optional[float]]] = None,
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    min_similarity: float = CONTEXT_MIN_SIMILARITY,
+    token_counter: Callable[[str], int] = count_tokens,
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    按相似度阈值、重叠合并和 token 预算整理检索结果
+
+    Args:
+        docs: 按相关性排序的检索结果
+        similarities: 与 docs 对应的查询余弦相似度（None 表示未知，不参与阈值过滤）
+        token_budget: 放入 prompt 的上下文 token 上限
+        min_similarity: 相似度阈值
+        token_counter: token 计数函数
+
+    Returns:
+        (packed_docs, stats)，stats 包含 chunks_in / chunks_out / tokens_in / tokens_out
+    """
+    stats = {
+        "chunks_in": len(docs),
+        "tokens_in": sum(token_counter(d.page_content) for d in docs),
+    }
+
+    # 1. 相似度阈值（排名第一的片段总是保留）
+    if similarities is not None:
+        docs = [
+            doc for rank, (doc, sim) in enumerate(zip(docs, similarities))
+            if rank == 0 or sim is None or sim >= min_similarity
+        ]
+
+    # 2. 合并同源重叠片段
+    blocks = merge_overlapping(docs)
+
+    # 3. 按排名填充 token 预算；放不下的块跳过（后面更短的块可能放得下）
+    packed: List[Document] = []
+    used = 0
+    for block in blocks:
+        tokens = token_counter(block.page_content)
+        if used + tokens > token_budget:
+            if packed:
+                continue
+            # 排名第一的块本身超出预算：截断后放入
+            block = Document(
+                page_content=truncate_to_tokens(block.page_content, token_budget),
+                metadata=block.metadata,
+            )
+            tokens = token_counter(block.page_content)
+        packed.append(block)
+        used += tokens
+
+    stats.update(chunks_out=len(packed), tokens_out=used)
+    return packed, stats
@@ -0,0 +1,187 @@
+"""
+Document loading stage - load default files, uploads and URLs concurrently
+
+网页抓取是网络密集型任务，放在线程池中并发执行；PDF 解析是 CPU 密集型任务，放在进程池中执行。
+每个数据源独立加载，单个来源失败不会影响其他来源。
+大 PDF 由 iter_pdf_pages 按页码区间拆成多个任务交给进程池并行解析，按页码顺序逐批产出，
+调用方可以边解析边切分、向量化，内存占用与总页数无关。
+
+本模块不依赖 Streamlit，进度与警告通过回调和返回值交给调用方（主线程）处理。
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import LOADER_MAX_THREADS, PDF_MAX_PROCESSES, PDF_PAGE_BATCH
+
+# 伪装成浏览器，防止 403 错误
+BROWSER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36"
+}
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def load_text_file(file_path: str) -> list:
+    """加载 UTF-8 文本文件"""
+    from langchain_community.document_loaders import TextLoader
+
+    return TextLoader(file_path, encoding="utf-8").load()
+
+
+def load_pdf_file(file_path: str) -> list:
+    """解析 PDF 文件（在子进程中运行，必须是模块级函数以便序列化）"""
+    from langchain_community.document_loaders import PyPDFLoader
+
+    return PyPDFLoader(file_path).load()
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """PDF 总页数（在子进程中运行）"""
+    from pypdf import PdfReader
+
+    return len(PdfReader(file_path).pages)
+
+
+def load_pdf_pages(file_path: str, source: str, start: int, stop: int) -> list:
+    """
+    解析 PDF 的第 [start, stop) 页（在子进程中运行，必须是模块级函数以便序列化）
+
+    每个任务单独打开文件，只解析自己的页面，子进程内存与总页数无关。空白页不产出文档。
+
+    Returns:
+        Document 列表，metadata 含 source / page（从 0 开始）/ total_pages
+    """
+    from langchain_core.documents import Document
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    total_pages = len(reader.pages)
+    docs = []
+    for number in range(start, min(stop, total_pages)):
+        text = reader.pages[number].extract_text() or ""
+        if text.strip():
+            docs.append(Document(
+                page_content=text,
+                metadata={"source": source, "page": number, "total_pages": total_pages},
+            ))
+    return docs
+
+
+def iter_pdf_pages(file_path: str, source: str, batch_pages: int = PDF_PAGE_BATCH) -> Iterator[list]:
+    """
+    在进程池中并行解析 PDF，每 batch_pages 页一批，按页码顺序产出
+
+    同时最多只有（进程数 + 1）批在解析或等待取走，调用方处理得慢时不会堆积已解析的页面；
+    调用方提前结束迭代（如出错）时取消尚未开始的任务。
+
+    Yields:
+        Document 列表（空白批次跳过）
+    """
+    pool = _get_pdf_pool()
+    total_pages = pool.submit(count_pdf_pages, file_path).result()
+    ranges = iter(range(0, total_pages, batch_pages))
+    pending: deque = deque()
+    try:
+        while True:
+            while len(pending) <= _pdf_workers():
+                start = next(ranges, None)
+                if start is None:
+                    break
+                pending.append(pool.submit(load_pdf_pages, file_path, source, start, start + batch_pages))
+            if not pending:
+                return
+            docs = pending.popleft().result()
+            if docs:
+                yield docs
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def load_url(url: str) -> list:
+    """抓取网页内容"""
+    from langchain_community.document_loaders import WebBaseLoader
+
+    return WebBaseLoader(url, header_template=BROWSER_HEADERS).load()
+
+
+def _pdf_workers() -> int:
+    """PDF 解析进程数"""
+    return max(1, min(PDF_MAX_PROCESSES, os.cpu_count() or 1))
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    进程级共享的 PDF 解析进程池（首次使用时创建，避免每次构建都重新启动子进程）
+
+    Streamlit 进程中有多个线程，直接 fork 可能在子进程中继承被占用的锁而死锁，
+    因此使用 forkserver（不支持时用 spawn）启动子进程。
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pdf_pool = ProcessPoolExecutor(max_workers=_pdf_workers(), mp_context=context)
+        return _pdf_pool
+
+
+def _valid_documents(docs) -> tuple:
+    """确保结果是列表，并过滤掉没有 page_content 的条目；返回 (有效文档, 跳过数量)"""
+    if not isinstance(docs, list):
+        docs = [docs] if docs else []
+    valid = [d for d in docs if hasattr(d, "page_content")]
+    return valid, len(docs) - len(valid)
+
+
+def load_sources(
+    sources: List[Dict[str, Any]],
+    on_complete: Optional[Callable[[int, int, Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    并发加载所有数据源
+
+    Args:
+        sources: 数据源描述列表，每项包含
+            - kind: "text" / "pdf" / "url"
+            - location: 本地文件路径或 URL
+            - name / source / type: 用于统计和展示的信息
+        on_complete: 每个数据源完成时在调用线程中回调 (已完成数, 总数, 数据源)
+
+    Returns:
+        与 sources 顺序一致的结果列表，每项为
+        {"spec": 数据源, "docs": 有效文档列表, "skipped": 跳过的无效条目数, "error": 异常或 None}
+    """
+    results: List[Dict[str, Any]] = [
+        {"spec": spec, "docs": [], "skipped": 0, "error": None} for spec in sources
+    ]
+    if not sources:
+        return results
+
+    loaders = {"text": load_text_file, "url": load_url}
+
+    with ThreadPoolExecutor(max_workers=LOADER_MAX_THREADS) as thread_pool:
+        futures = {}
+        for i, spec in enumerate(sources):
+            if spec["kind"] == "pdf":
+                future = _get_pdf_pool().submit(load_pdf_file, spec["location"])
+            else:
+                future = thread_pool.submit(loaders[spec["kind"]], spec["location"])
+            futures[future] = i
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = results[futures[future]]
+            try:
+                result["docs"], result["skipped"] = _valid_documents(future.result())
+            except Exception as e:
+                result["error"] = e
+
+            if on_complete is not None:
+                on_complete(done, len(sources), result["spec"])
+
+    return results
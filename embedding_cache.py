@@ -0,0 +1,131 @@
+"""
+Chunk-level embedding cache - persistent text hash -> vector store in SQLite
+
+按片段文本的 SHA-256 和向量模型名称缓存向量（float32 二进制存入 SQLite BLOB 列，WAL 模式）。
+重新切分或增量添加来源时，内容完全相同的片段直接复用已有向量，只对未命中的片段调用模型。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import EMBEDDING_CACHE_DIR, EMBEDDING_MODEL
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    text_hash TEXT NOT NULL,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (model, text_hash)
+)
+"""
+
+
+def text_hash(text: str) -> str:
+    """片段文本的内容哈希"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """线程安全的 SQLite 向量缓存"""
+
+    def __init__(self, db_path: str, model_name: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """批量查询，返回命中的 {hash: vector}"""
+        found: Dict[str, np.ndarray] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite 单条语句的参数数量有限，分批查询
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model_name, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        """批量写入 {hash: vector}"""
+        rows = []
+        for h, vector in vectors.items():
+            arr = np.asarray(vector, dtype=np.float32)
+            rows.append((self.model_name, h, int(arr.shape[0]), arr.tobytes()))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    包装任意 Embeddings：文档向量先查缓存，只对未命中的文本调用底层模型
+
+    hits / misses 记录本实例的累计命中情况，用于报告命中率。
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        cached = self.cache.get_many(hashes)
+
+        # 同一批次中的重复文本只向量化一次
+        missing: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = t
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), new_vectors))
+            self.cache.put_many(fresh)
+            cached.update({h: np.asarray(v, dtype=np.float32) for h, v in fresh.items()})
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [cached[h].tolist() for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """进程级共享的向量缓存（按 EMBEDDING_MODEL 区分条目）"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(os.path.join(EMBEDDING_CACHE_DIR, "embeddings.sqlite"), EMBEDDING_MODEL)
+        return _cache
@@ -0,0 +1,88 @@
+"""
+Embedding model service - one pre-warmed embedding model per process
+
+模型在服务启动时由后台线程加载一次（优先使用本地模型包 EMBEDDING_MODEL_DIR，
+不在请求时联网下载），并执行一次预热编码；之后所有会话和所有构建共用同一个实例。
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from config import EMBEDDING_MODEL, EMBEDDING_MODEL_DIR
+
+_lock = threading.Lock()
+_ready = threading.Event()
+_embeddings = None
+_status: Dict[str, Any] = {"source": None, "load_seconds": None, "error": None}
+_warmup_thread: Optional[threading.Thread] = None
+
+
+def _resolve_model_source() -> tuple:
+    """返回 (模型路径或名称, 是否本地模型包)"""
+    if os.path.isdir(EMBEDDING_MODEL_DIR):
+        return EMBEDDING_MODEL_DIR, True
+    return EMBEDDING_MODEL, False
+
+
+def _load_embeddings():
+    """加载模型并预热（调用方需持有 _lock）"""
+    global _embeddings
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    source, is_local = _resolve_model_source()
+    start = time.perf_counter()
+    try:
+        model_kwargs = {"local_files_only": True} if is_local else {}
+        embeddings = HuggingFaceEmbeddings(model_name=source, model_kwargs=model_kwargs)
+        # 预热：触发权重加载与首次推理的初始化开销
+        embeddings.embed_query("NTU campus warm-up 预热")
+    except Exception as e:
+        _status.update(source=source, error=str(e))
+        raise
+
+    _embeddings = embeddings
+    _status.update(source=source, load_seconds=time.perf_counter() - start, error=None)
+    _ready.set()
+
+
+def get_embeddings():
+    """
+    获取进程级共享的向量模型；尚未加载完成时阻塞等待
+
+    Returns:
+        HuggingFaceEmbeddings 实例
+    """
+    if _ready.is_set():
+        return _embeddings
+    with _lock:
+        if not _ready.is_set():
+            _load_embeddings()
+    return _embeddings
+
+
+def _warmup() -> None:
+    try:
+        get_embeddings()
+    except Exception:
+        pass  # 错误已记录在 _status 中，下次 get_embeddings() 会重试
+
+
+def start_warmup() -> None:
+    """在后台线程中加载并预热模型（每个进程只会启动一次）"""
+    global _warmup_thread
+    with _lock:
+        if _ready.is_set() or (_warmup_thread is not None and _warmup_thread.is_alive()):
+            return
+        _warmup_thread = threading.Thread(target=_warmup, name="embedding-warmup", daemon=True)
+        _warmup_thread.start()
+
+
+def is_ready() -> bool:
+    """模型是否已加载并完成预热"""
+    return _ready.is_set()
+
+
+def get_status() -> Dict[str, Any]:
+    """模型加载状态，用于 Diagnostics 展示"""
+    return {"ready": is_ready(), **_status}
@@ -0,0 +1,237 @@
+"""
+Feedback store - SQLite (WAL) log of 👍 / 👎 feedback with maintained counters
+
+反馈按批写入 SQLite：点击时只放入内存队列，后台线程每隔 FEEDBACK_FLUSH_INTERVAL_SECONDS
+或攒够 FEEDBACK_BATCH_SIZE 条时在一个事务中写入。timestamp / label 列建有索引，
+各标签的计数由触发器维护在 feedback_counters 表中，统计查询不随反馈数量增长。
+首次启动时自动导入旧的 feedback_log.csv（导入后重命名为 .migrated）。
+"""
+import atexit
+import csv
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import (
+    FEEDBACK_DB_FILE,
+    FEEDBACK_LOG_FILE,
+    FEEDBACK_BATCH_SIZE,
+    FEEDBACK_FLUSH_INTERVAL_SECONDS,
+)
+
+# 与旧 CSV 一致的列顺序（导出时沿用）
+FIELDNAMES = ["timestamp", "label", "question", "answer", "used_rag", "sources"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    label TEXT NOT NULL,
+    question TEXT,
+    answer TEXT,
+    used_rag INTEGER,
+    sources TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_feedback_timestamp ON feedback (timestamp);
+CREATE INDEX IF NOT EXISTS idx_feedback_label ON feedback (label);
+
+CREATE TABLE IF NOT EXISTS feedback_counters (
+    label TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS feedback_count_insert AFTER INSERT ON feedback
+BEGIN
+    INSERT INTO feedback_counters (label, count) VALUES (NEW.label, 1)
+    ON CONFLICT (label) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS feedback_count_delete AFTER DELETE ON feedback
+BEGIN
+    UPDATE feedback_counters SET count = count - 1 WHERE label = OLD.label;
+END;
+
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_INSERT = (
+    "INSERT INTO feedback (timestamp, label, question, answer, used_rag, sources) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+def _to_params(row: Dict[str, Any]) -> tuple:
+    used_rag = row.get("used_rag")
+    if isinstance(used_rag, str):
+        used_rag = used_rag.strip().lower() == "true"
+    return (
+        row.get("timestamp") or "",
+        row.get("label") or "",
+        row.get("question") or "",
+        row.get("answer") or "",
+        1 if used_rag else 0,
+        row.get("sources") or "",
+    )
+
+
+class FeedbackStore:
+    """线程安全、支持多进程并发访问的反馈存储"""
+
+    def __init__(self, db_path: str, legacy_csv: Optional[str] = None):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+        if legacy_csv:
+            self._migrate_csv(legacy_csv)
+
+        self._pending: "queue.Queue[tuple]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="feedback-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    # === 写入 ===
+
+    def add(self, row: Dict[str, Any]) -> None:
+        """加入写入队列（不阻塞点击处理）"""
+        self._pending.put(_to_params(row))
+        if self._pending.qsize() >= FEEDBACK_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """把队列中的反馈在一个事务中写入"""
+        batch: List[tuple] = []
+        while True:
+            try:
+                batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return
+        with self._lock:
+            try:
+                self._conn.executemany(_INSERT, batch)
+                self._conn.commit()
+            except sqlite3.Error:
+                # 写入失败（如其他进程长时间持有写锁）：放回队列，下一轮重试
+                self._conn.rollback()
+                for params in batch:
+                    self._pending.put(params)
+                raise
+
+    def _write_loop(self) -> None:
+        while True:
+            time.sleep(FEEDBACK_FLUSH_INTERVAL_SECONDS)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass
+
+    def _migrate_csv(self, csv_path: str) -> None:
+        """
+        一次性导入旧 CSV 日志；多进程同时启动时由 BEGIN IMMEDIATE 保证只导入一次
+        """
+        if not os.path.exists(csv_path):
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._conn.execute(
+                    "SELECT value FROM store_meta WHERE key = 'csv_migrated'"
+                ).fetchone()
+                if done is None:
+                    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+                        reader = csv.DictReader(f)
+                        batch: List[tuple] = []
+                        for row in reader:
+                            batch.append(_to_params(row))
+                            if len(batch) >= 1000:
+                                self._conn.executemany(_INSERT, batch)
+                                batch = []
+                        if batch:
+                            self._conn.executemany(_INSERT, batch)
+                    self._conn.execute(
+                        "INSERT INTO store_meta (key, value) VALUES ('csv_migrated', ?)", (csv_path,)
+                    )
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        try:
+            os.replace(csv_path, csv_path + ".migrated")
+        except OSError:
+            pass
+
+    # === 读取 ===
+
+    def counts(self) -> Dict[str, int]:
+        """各标签的反馈数（读取计数表，不扫描反馈表）"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT label, count FROM feedback_counters").fetchall()
+        return {label: count for label, count in rows}
+
+    def recent(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """最近 limit 条反馈（按写入顺序，旧的在前）"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(FIELDNAMES)} FROM feedback ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(zip(FIELDNAMES, row)) for row in reversed(rows)]
+
+    def iter_csv(self, batch_size: int = 5000) -> Iterator[str]:
+        """按批导出为 CSV 文本块（含表头），不一次性读入全部反馈"""
+        self.flush()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FIELDNAMES)
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, {', '.join(FIELDNAMES)} FROM feedback WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for row in rows:
+                values = list(row[1:])
+                values[4] = "True" if values[4] else "False"
+                writer.writerow(values)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.getvalue():
+            yield buffer.getvalue()
+
+    def export_csv(self) -> bytes:
+        """
+        导出全部反馈为 UTF-8 CSV（供 st.download_button(data=callable) 在点击时调用）
+
+        Streamlit 会把下载内容整体读入内存再发送，因此直接返回 bytes；读取数据库时仍按批进行。
+        """
+        return b"".join(chunk.encode("utf-8") for chunk in self.iter_csv())
+
+
+_store: Optional[FeedbackStore] = None
+_store_lock = threading.Lock()
+
+
+def get_feedback_store() -> FeedbackStore:
+    """进程级共享的反馈存储（首次调用时导入旧 CSV）"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FeedbackStore(FEEDBACK_DB_FILE, legacy_csv=FEEDBACK_LOG_FILE)
+        return _store
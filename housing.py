@@ -1,18 +1,87 @@
 """
 Housing plan generation functionality
+
+Housing Wizard 只有 18 种偏好组合（预算 × 隐私 × 入住时长）。默认知识库挂载后，
+HOUSING_PRECOMPUTE 开启时后台用访客的 API Key 生成全部组合并按知识库指纹保存，之后直接返回；
+自定义知识库不预计算（避免为每次上传消耗访客的 LLM 调用），只在点击时实时生成。
+预计算失败时停在第一个错误，按 HOUSING_PRECOMPUTE_RETRY_SECONDS 指数退避重试，
+最多 HOUSING_PRECOMPUTE_MAX_ATTEMPTS 次。
 """
-import streamlit as st
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
 
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
+import streamlit as st
 
 from config import (
-    DEEPSEEK_MODEL,
-    DEEPSEEK_BASE_URL,
     DEFAULT_RETRIEVAL_K,
+    HOUSING_BUDGET_OPTIONS,
+    HOUSING_PRIVACY_OPTIONS,
+    HOUSING_STAY_OPTIONS,
+    HOUSING_PLAN_CACHE_DIR,
+    HOUSING_PRECOMPUTE,
+    HOUSING_PRECOMPUTE_RETRY_SECONDS,
+    HOUSING_PRECOMPUTE_MAX_ATTEMPTS,
 )
-from rag_chain import create_retrieval_chain
+from retrieval import routed_search
+from telemetry import span, stream_with_spans
+from llm_client import lease_llm_client
+
+logger = logging.getLogger(__name__)
+
+# 使用带偏好信息的 prompt 模板
+HOUSING_PROMPT = """
+You are an expert assistant familiar with NTU graduate housing.
+Below are a student's housing preferences. Please provide recommendations based on the [Context Information].
+
+Required output structure (respond in both English and Chinese):
+1. Summarize their needs in 2-3 sentences (both in English and Chinese)
+2. Recommend 1-2 specific housing options (e.g., Graduate Hall 1 twin sharing / North Hill single room),
+   explaining why they are suitable (considering price, room type, private bathroom, etc.)
+3. Provide a clear application checklist with bullet points, including:
+   - When to submit the application in the system
+   - Fees to pay (if mentioned in documents)
+   - Important dates to check for housing results
+If certain details are not mentioned in the documents, please clearly state "Not mentioned in the documents".
+
+Please respond in both English and Chinese (中英双语回答).
+
+[Context Information]:
+{context}
+
+[Question]:
+{input}
+"""
+
+
+def _generate_plan(vectorstore, preferences: dict, deepseek_api_key: str) -> str:
+    """
+    Run retrieval + LLM generation for one set of preferences (no Streamlit calls).
+
+    Raises:
+        Exception: on any retrieval / LLM failure, so callers can decide whether to store the result
+    """
+    # 把偏好转成一段自然语言描述，作为检索查询
+    pref_text = (
+        f"预算倾向：{preferences.get('budget')}\n"
+        f"隐私 / 独立卫生间：{preferences.get('privacy')}\n"
+        f"预计入住时长：{preferences.get('stay_term')}\n"
+    )
+
+    # Pass preferences as input
+    query = f"Based on the following preferences, recommend suitable housing:\n{pref_text}\nPlease provide a detailed housing recommendation plan."
+    # 只检索住房分片（混合检索；知识库中没有住房内容时退回全局检索）
+    # 共享客户端上预编译好的 chain；生成期间持有租约，避免客户端被淘汰时关闭
+    with span("housing.total"), lease_llm_client(deepseek_api_key) as client:
+        doc_chain = client.stuff_chain(HOUSING_PROMPT)
+        docs = routed_search(vectorstore, query, DEFAULT_RETRIEVAL_K, topics=["housing"])
+        return stream_with_spans(doc_chain, {"context": docs, "input": query}, "housing")
 
 
 def generate_housing_plan(preferences: dict, deepseek_api_key: str) -> str:
@@ -32,59 +101,254 @@ def generate_housing_plan(preferences: dict, deepseek_api_key: str) -> str:
     if not deepseek_api_key:
         return "DeepSeek API Key not set. Please enter it in the sidebar first."
 
-    # 初始化 LLM
-    llm = ChatOpenAI(
-        model=DEEPSEEK_MODEL,
-        openai_api_key=deepseek_api_key,
-        base_url=DEEPSEEK_BASE_URL,
-    )
+    try:
+        answer = _generate_plan(st.session_state["vectorstore"], preferences, deepseek_api_key)
+        return answer or "Failed to generate recommendations. Please try again."
+    except Exception as e:
+        import traceback
+        error_msg = f"Error generating housing recommendations: {e}\n\nDetails:\n{traceback.format_exc()}"
+        return error_msg
 
-    vectorstore = st.session_state["vectorstore"]
-    retriever = vectorstore.as_retriever(search_kwargs={"k": DEFAULT_RETRIEVAL_K})
 
-    # 把偏好转成一段自然语言描述，作为检索查询
-    pref_text = (
-        f"预算倾向：{preferences.get('budget')}\n"
-        f"隐私 / 独立卫生间：{preferences.get('privacy')}\n"
-        f"预计入住时长：{preferences.get('stay_term')}\n"
-    )
+# === 预计算：每个知识库指纹下，所有偏好组合的推荐方案 ===
 
-    # 使用带偏好信息的 prompt 模板
-    simplified_prompt = """
-You are an expert assistant familiar with NTU graduate housing.
-Below are a student's housing preferences. Please provide recommendations based on the [Context Information].
+def all_preference_combinations() -> list:
+    """Housing Wizard 全部偏好组合（预算 × 隐私 × 入住时长）"""
+    return [
+        {"budget": budget, "privacy": privacy, "stay_term": stay_term}
+        for budget, privacy, stay_term in itertools.product(
+            HOUSING_BUDGET_OPTIONS, HOUSING_PRIVACY_OPTIONS, HOUSING_STAY_OPTIONS
+        )
+    ]
 
-Required output structure (respond in both English and Chinese):
-1. Summarize their needs in 2-3 sentences (both in English and Chinese)
-2. Recommend 1-2 specific housing options (e.g., Graduate Hall 1 twin sharing / North Hill single room),
-   explaining why they are suitable (considering price, room type, private bathroom, etc.)
-3. Provide a clear application checklist with bullet points, including:
-   - When to submit the application in the system
-   - Fees to pay (if mentioned in documents)
-   - Important dates to check for housing results
-If certain details are not mentioned in the documents, please clearly state "Not mentioned in the documents".
 
-Please respond in both English and Chinese (中英双语回答).
+def _preference_key(preferences: dict) -> str:
+    return "|".join(str(preferences.get(k)) for k in ("budget", "privacy", "stay_term"))
 
-[Context Information]:
-{context}
 
-[Question]:
-{input}
-"""
+class HousingPlanStore:
+    """
+    按知识库指纹保存预计算方案（每个指纹一个 JSON 文件，内存中同时缓存）
+
+    只保存当前默认知识库的方案：set_current 切换指纹时删除其他指纹的文件和缓存，
+    其他指纹的读写直接忽略，缓存目录不会随知识库更新或自定义上传而增长。
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._plans: Dict[str, Dict[str, str]] = {}
+        self._current: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _path(self, kb_fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, f"{kb_fingerprint}.json")
+
+    def _load(self, kb_fingerprint: str) -> Dict[str, str]:
+        """读取某个指纹的全部方案（需持有锁；非当前指纹返回空字典）"""
+        if kb_fingerprint != self._current:
+            return {}
+        if kb_fingerprint not in self._plans:
+            plans: Dict[str, str] = {}
+            try:
+                with open(self._path(kb_fingerprint), "r", encoding="utf-8") as f:
+                    plans = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+            self._plans[kb_fingerprint] = plans
+        return self._plans[kb_fingerprint]
+
+    def set_current(self, kb_fingerprint: str) -> None:
+        """切换当前指纹，删除其他指纹的方案文件（包括写到一半的临时文件）和内存缓存"""
+        with self._lock:
+            self._current = kb_fingerprint
+            self._plans = {fp: plans for fp, plans in self._plans.items() if fp == kb_fingerprint}
+            try:
+                names = os.listdir(self.cache_dir)
+            except FileNotFoundError:
+                return
+            keep = os.path.basename(self._path(kb_fingerprint))
+            for name in names:
+                if name != keep and name.endswith((".json", ".tmp")):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        logger.warning("Failed to remove stale housing plans %s", name, exc_info=True)
+
+    @property
+    def current(self) -> Optional[str]:
+        return self._current
+
+    def get(self, kb_fingerprint: str, preferences: dict) -> Optional[str]:
+        with self._lock:
+            return self._load(kb_fingerprint).get(_preference_key(preferences))
+
+    def put(self, kb_fingerprint: str, preferences: dict, plan: str) -> None:
+        with self._lock:
+            if kb_fingerprint != self._current:
+                return
+            plans = self._load(kb_fingerprint)
+            plans[_preference_key(preferences)] = plan
+
+            # 先写临时文件再原子替换，避免并发读到半个文件
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(plans, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(kb_fingerprint))
+
+    def count(self, kb_fingerprint: str) -> int:
+        with self._lock:
+            return len(self._load(kb_fingerprint))
+
+
+plan_store = HousingPlanStore(HOUSING_PLAN_CACHE_DIR)
+_precompute_threads: Dict[str, threading.Thread] = {}
+_precompute_lock = threading.Lock()
+# (知识库指纹, API Key 哈希) -> {"attempts": 连续失败次数, "retry_at": 下次允许启动的时刻, "error": 最近的错误}
+_precompute_failures: Dict[Tuple[str, str], dict] = {}
+
+
+def _key_hash(deepseek_api_key: str) -> str:
+    # 与 llm_client 一致，只保存 Key 的哈希
+    return hashlib.sha256(deepseek_api_key.encode("utf-8")).hexdigest()
+
+
+def _precompute_all(vectorstore, kb_fingerprint: str, deepseek_api_key: str) -> None:
+    """
+    后台线程：依次生成并保存尚未缓存的组合（指纹被 set_housing_kb 替换后停止）
+
+    任一组合失败时记录错误并结束本轮（Key 无效、限流、断网时后续调用同样会失败），
+    由 start_housing_precompute 按退避时间决定何时重试。
+    """
+    failure_key = (kb_fingerprint, _key_hash(deepseek_api_key))
+    for preferences in all_preference_combinations():
+        with _precompute_lock:
+            # 默认知识库已更新：本任务的指纹不再是当前指纹，停止生成
+            if _precompute_threads.get(kb_fingerprint) is not threading.current_thread():
+                return
+        if plan_store.get(kb_fingerprint, preferences) is not None:
+            continue
+        try:
+            plan = _generate_plan(vectorstore, preferences, deepseek_api_key)
+        except Exception as e:
+            logger.warning("Housing precompute failed for %s", kb_fingerprint, exc_info=True)
+            with _precompute_lock:
+                if _precompute_threads.get(kb_fingerprint) is not threading.current_thread():
+                    return
+                failure = _precompute_failures.setdefault(failure_key, {"attempts": 0})
+                failure["attempts"] += 1
+                failure["retry_at"] = time.monotonic() + HOUSING_PRECOMPUTE_RETRY_SECONDS * 2 ** (failure["attempts"] - 1)
+                failure["error"] = f"{type(e).__name__}: {e}"
+            return
+        if plan:
+            plan_store.put(kb_fingerprint, preferences, plan)
+
+    with _precompute_lock:
+        _precompute_failures.pop(failure_key, None)
 
-    try:
-        prompt_tmpl = ChatPromptTemplate.from_template(simplified_prompt)
-        doc_chain = create_stuff_documents_chain(llm, prompt_tmpl)
-        rag_chain = create_retrieval_chain(retriever, doc_chain)
 
-        # Pass preferences as input
-        query = f"Based on the following preferences, recommend suitable housing:\n{pref_text}\nPlease provide a detailed housing recommendation plan."
-        result = rag_chain.invoke({"input": query})
-        answer = result.get("answer") or "Failed to generate recommendations. Please try again."
+def set_housing_kb(kb_fingerprint: str) -> None:
+    """
+    登记当前默认知识库的指纹（挂载默认知识库时调用）
+
+    删除其他指纹的方案文件，并清除它们的预计算任务和失败记录；仍在运行的旧任务在下一个组合前退出。
+    """
+    plan_store.set_current(kb_fingerprint)
+    with _precompute_lock:
+        for fp in [fp for fp in _precompute_threads if fp != kb_fingerprint]:
+            del _precompute_threads[fp]
+        for key in [key for key in _precompute_failures if key[0] != kb_fingerprint]:
+            del _precompute_failures[key]
+
+
+def is_housing_kb(kb_fingerprint: Optional[str]) -> bool:
+    """该指纹是否为当前默认知识库（方案会被预计算和保存）"""
+    return kb_fingerprint is not None and kb_fingerprint == plan_store.current
+
+
+def start_housing_precompute(vectorstore, kb_fingerprint: str, deepseek_api_key: str) -> None:
+    """
+    为默认知识库启动后台预计算（会用访客的 API Key 调用 LLM 生成全部组合）
+
+    只处理 set_housing_kb 登记的指纹，自定义知识库不预计算；HOUSING_PRECOMPUTE 关闭时不启动。
+    同一指纹只会有一个任务在运行，全部完成后不再启动；上一轮失败时等到退避时间过后才重试，
+    连续失败 HOUSING_PRECOMPUTE_MAX_ATTEMPTS 次后不再自动重试（Wizard 中仍可实时生成）。
+
+    Args:
+        vectorstore: 当前知识库（只读使用）
+        kb_fingerprint: 知识库指纹，知识库变化时会重新预计算
+        deepseek_api_key: 用于生成方案的 API Key
+    """
+    if not HOUSING_PRECOMPUTE or not deepseek_api_key or not is_housing_kb(kb_fingerprint):
+        return
+    if precompute_progress(kb_fingerprint)["done"] >= len(all_preference_combinations()):
+        return
+
+    with _precompute_lock:
+        thread = _precompute_threads.get(kb_fingerprint)
+        if thread is not None and thread.is_alive():
+            return
+        failure = _precompute_failures.get((kb_fingerprint, _key_hash(deepseek_api_key)))
+        if failure is not None and (
+            failure["attempts"] >= HOUSING_PRECOMPUTE_MAX_ATTEMPTS or time.monotonic() < failure["retry_at"]
+        ):
+            return
+        thread = threading.Thread(
+            target=_precompute_all,
+            args=(vectorstore, kb_fingerprint, deepseek_api_key),
+            name=f"housing-precompute-{kb_fingerprint}",
+            daemon=True,
+        )
+        _precompute_threads[kb_fingerprint] = thread
+        thread.start()
+
+
+def precompute_progress(kb_fingerprint: str, deepseek_api_key: Optional[str] = None) -> dict:
+    """
+    预计算进度
+
+    Returns:
+        {"done": 已完成组合数, "total": 组合总数, "running": 是否在运行,
+         "error": 该 Key 最近一次失败的错误（没有时为 None）, "retrying": 之后是否还会自动重试}
+    """
+    thread = _precompute_threads.get(kb_fingerprint)
+    failure = None
+    if deepseek_api_key:
+        with _precompute_lock:
+            failure = _precompute_failures.get((kb_fingerprint, _key_hash(deepseek_api_key)))
+    return {
+        "done": plan_store.count(kb_fingerprint),
+        "total": len(all_preference_combinations()),
+        "running": thread is not None and thread.is_alive(),
+        "error": failure["error"] if failure else None,
+        "retrying": failure is None or failure["attempts"] < HOUSING_PRECOMPUTE_MAX_ATTEMPTS,
+    }
 
-        return answer
+
+def get_housing_plan(preferences: dict, deepseek_api_key: str) -> tuple:
+    """
+    Housing Wizard 入口：优先返回预计算方案，未命中时实时生成（默认知识库的方案同时保存）
+
+    Returns:
+        tuple of (plan_text, served_from_precompute)
+    """
+    kb_fingerprint = st.session_state.get("kb_fingerprint")
+    if kb_fingerprint:
+        stored = plan_store.get(kb_fingerprint, preferences)
+        if stored is not None:
+            return stored, True
+
+    if "vectorstore" not in st.session_state or not deepseek_api_key:
+        return generate_housing_plan(preferences, deepseek_api_key), False
+
+    try:
+        plan = _generate_plan(st.session_state["vectorstore"], preferences, deepseek_api_key)
     except Exception as e:
         import traceback
-        error_msg = f"Error generating housing recommendations: {e}\n\nDetails:\n{traceback.format_exc()}"
-        return error_msg
+        return f"Error generating housing recommendations: {e}\n\nDetails:\n{traceback.format_exc()}", False
+
+    if not plan:
+        return "Failed to generate recommendations. Please try again.", False
+    if kb_fingerprint:
+        plan_store.put(kb_fingerprint, preferences, plan)
+    return plan, False
@@ -0,0 +1,296 @@
+"""
+Incremental index maintenance - upsert / delete chunks by source without re-embedding the corpus
+
+每个切分片段都有一个由 (来源, 内容) 决定的稳定 chunk_id，保存在 metadata["chunk_id"] 中，
+并作为 FAISS docstore 的 ID。更新某个来源时，只需对比新旧 ID 集合：
+新出现的片段才需要向量化，消失的片段从索引中删除，未变化的片段保持不动。
+"""
+import hashlib
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from config import EMBED_BATCH_SIZE
+from vector_index import all_vectors, apply_index_type, build_index, make_mutable
+
+
+def chunk_source(doc) -> str:
+    """片段所属的来源键（文件路径 / 上传文件名 / URL）"""
+    meta = getattr(doc, "metadata", {}) or {}
+    return str(meta.get("source") or "Unknown source")
+
+
+def chunk_sources(doc) -> List[str]:
+    """片段的全部来源：近似重复合并后的片段有多个来源（metadata["sources"]），第一个为主来源"""
+    meta = getattr(doc, "metadata", {}) or {}
+    return [str(src) for src in meta.get("sources") or []] or [chunk_source(doc)]
+
+
+def _release_sources(vectorstore, doc_ids: List[str], sources: set) -> List[str]:
+    """
+    从片段中移除指定来源：没有剩余来源的片段返回待删除；仍被其他来源共享的片段保留，
+    并把主来源改为剩余来源中的第一个（替换 docstore 中的文档，不修改共享的原对象）
+
+    Returns:
+        需要删除的 chunk ID
+    """
+    from langchain_core.documents import Document
+
+    to_delete = []
+    for doc_id in doc_ids:
+        doc = vectorstore.docstore.search(doc_id)
+        remaining = [src for src in chunk_sources(doc) if src not in sources]
+        if not remaining:
+            to_delete.append(doc_id)
+            continue
+        metadata = {**doc.metadata, "source": remaining[0], "sources": remaining}
+        vectorstore.docstore._dict[doc_id] = Document(page_content=doc.page_content, metadata=metadata)
+    return to_delete
+
+
+def assign_chunk_ids(docs: list, seen: Optional[Dict[str, int]] = None) -> List[str]:
+    """
+    为切分后的片段生成稳定 ID，写入 metadata["chunk_id"]
+
+    同一来源中内容完全相同的片段按出现顺序追加序号，保证 ID 唯一。
+
+    Args:
+        docs: 片段列表
+        seen: 分批调用时在各批之间共享的序号表（默认只在本次调用内保证唯一）
+
+    Returns:
+        与 docs 一一对应的 ID 列表
+    """
+    seen = defaultdict(int) if seen is None else seen
+    ids = []
+    for doc in docs:
+        base = hashlib.sha1(
+            f"{chunk_source(doc)}\x00{doc.page_content}".encode("utf-8")
+        ).hexdigest()[:24]
+        ordinal = seen.get(base, 0)
+        seen[base] = ordinal + 1
+        chunk_id = base if ordinal == 0 else f"{base}-{ordinal}"
+        doc.metadata["chunk_id"] = chunk_id
+        ids.append(chunk_id)
+    return ids
+
+
+def source_manifest(vectorstore) -> Dict[str, List[str]]:
+    """按来源汇总当前索引中的 chunk ID（近似重复合并的片段计入它的每个来源）"""
+    manifest: Dict[str, List[str]] = defaultdict(list)
+    for doc_id in vectorstore.index_to_docstore_id.values():
+        for source in chunk_sources(vectorstore.docstore.search(doc_id)):
+            manifest[source].append(doc_id)
+    return dict(manifest)
+
+
+def _id_hash(doc_id: str) -> int:
+    return int.from_bytes(hashlib.sha1(doc_id.encode("utf-8")).digest()[:8], "big")
+
+
+def index_fingerprint(vectorstore) -> str:
+    """
+    知识库版本指纹：由全部 chunk ID（即来源 + 内容）决定
+
+    内容不变时指纹不变；任何增删改都会得到新的指纹，可用作下游缓存的失效键。
+    指纹是各 ID 哈希的异或，与顺序无关，增量更新时用 update_fingerprint 只处理增删的 ID。
+    """
+    return update_fingerprint(f"{0:016x}", vectorstore.index_to_docstore_id.values(), [])
+
+
+def update_fingerprint(fingerprint: str, added_ids: Iterable[str], removed_ids: Iterable[str]) -> str:
+    """由旧指纹和增删的 chunk ID 得到新指纹（与重新计算 index_fingerprint 的结果相同）"""
+    value = int(fingerprint, 16)
+    for doc_id in added_ids:
+        value ^= _id_hash(doc_id)
+    for doc_id in removed_ids:
+        value ^= _id_hash(doc_id)
+    return f"{value:016x}"
+
+
+def clone_vectorstore(vectorstore) -> FAISS:
+    """
+    复制一份可写的向量库（共享注册表中的索引是只读的，修改前必须先复制）
+
+    只复制已有向量和文档引用，不重新向量化。
+    """
+    import faiss
+
+    index = faiss.clone_index(vectorstore.index)
+    docstore = InMemoryDocstore(dict(vectorstore.docstore._dict))
+    clone = FAISS(
+        vectorstore.embedding_function,
+        index,
+        docstore,
+        dict(vectorstore.index_to_docstore_id),
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy,
+    )
+    make_mutable(clone, source=vectorstore)
+    return clone
+
+
+class SourceUpsert:
+    """
+    按来源分批增量更新索引：add_batch() 逐批写入新增 / 变化的片段，
+    finish() 在全部批次写入后删除本次更新的各来源中已不存在的旧片段
+
+    流式构建时每批片段到达即向量化写入，不需要先收齐整个来源的片段。
+    片段可以有多个来源（近似重复合并）：每个来源分别判断片段是否仍属于它，
+    近似去重并入已有片段的内容通过 keep() 登记，同样不会被当作过期片段。
+    """
+
+    def __init__(self, vectorstore):
+        self.vectorstore = vectorstore
+        self._manifest = {source: set(ids) for source, ids in source_manifest(vectorstore).items()}
+        self._incoming: Dict[str, Set[str]] = defaultdict(set)
+        self._unchanged: Dict[str, Set[str]] = defaultdict(set)
+        # 各来源本次新归入的片段（新写入的，或原本不属于该来源的已有片段），撤销来源时据此回退
+        self._joined: Dict[str, List[str]] = defaultdict(list)
+        self._added: Dict[str, None] = {}
+        self._abandoned: Set[str] = set()
+
+    def _claim(self, chunk_id: str, sources: List[str]) -> None:
+        """登记片段属于本次更新的这些来源"""
+        for source in sources:
+            if source in self._abandoned or chunk_id in self._incoming[source]:
+                continue
+            self._incoming[source].add(chunk_id)
+            if chunk_id in self._manifest.get(source, ()):
+                self._unchanged[source].add(chunk_id)
+            else:
+                self._joined[source].append(chunk_id)
+
+    def add_batch(self, docs: list) -> List[str]:
+        """
+        写入一批片段中的新片段（分批向量化）
+
+        Args:
+            docs: 已调用 assign_chunk_ids 的片段列表（可包含多个来源）
+
+        Returns:
+            本批新增的 chunk ID
+        """
+        new_docs = []
+        for doc in docs:
+            chunk_id, sources = doc.metadata["chunk_id"], chunk_sources(doc)
+            # chunk ID 由主来源和内容决定：主来源中已有（或本次已写入）该 ID 时无需向量化
+            known = chunk_id in self._incoming[sources[0]] or chunk_id in self._manifest.get(sources[0], ())
+            self._claim(chunk_id, sources)
+            if not known:
+                new_docs.append(doc)
+        # 分批向量化，避免大文件一次性生成全部向量
+        for start in range(0, len(new_docs), EMBED_BATCH_SIZE):
+            batch = new_docs[start:start + EMBED_BATCH_SIZE]
+            self.vectorstore.add_documents(batch, ids=[d.metadata["chunk_id"] for d in batch])
+        for doc in new_docs:
+            self._added[doc.metadata["chunk_id"]] = None
+        return [d.metadata["chunk_id"] for d in new_docs]
+
+    def keep(self, chunk_id: str, sources: List[str]) -> None:
+        """近似去重把这些来源的内容并入了索引中的片段：该片段仍属于（或新归入）这些来源"""
+        self._claim(chunk_id, sources)
+
+    @property
+    def added_ids(self) -> List[str]:
+        """本次写入的全部 chunk ID"""
+        return list(self._added)
+
+    def forget_source(self, source: str) -> List[str]:
+        """
+        放弃某个来源的本次更新（如解析中途失败）：finish() 不再删除它的旧片段
+
+        Returns:
+            本次新归入该来源的 chunk ID（由调用方移除该来源，没有其他来源的片段删除后调用 discard）
+        """
+        self._abandoned.add(source)
+        self._incoming.pop(source, None)
+        self._unchanged.pop(source, None)
+        return self._joined.pop(source, [])
+
+    def discard(self, chunk_ids: Iterable[str]) -> None:
+        """调用方已从索引中删除的片段不再计入本次新增"""
+        for chunk_id in chunk_ids:
+            self._added.pop(chunk_id, None)
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        删除本次更新的来源中已不存在的旧片段
+
+        Returns:
+            {"added": 新增片段数, "removed": 删除片段数, "unchanged": 未变化片段数,
+             "added_ids" / "removed_ids": 新增 / 删除的 chunk ID（用于增量更新关键词索引、主题分片和指纹）}
+        """
+        stale: Dict[str, Set[str]] = defaultdict(set)
+        for source, chunk_ids in self._incoming.items():
+            for chunk_id in self._manifest.get(source, set()) - chunk_ids:
+                stale[chunk_id].add(source)
+        # 过期片段只移除不再包含它的来源；仍被其他来源共享（近似重复合并）时保留
+        stale_ids: List[str] = []
+        for chunk_id, sources in stale.items():
+            stale_ids += _release_sources(self.vectorstore, [chunk_id], sources)
+        if stale_ids:
+            self.vectorstore.delete(stale_ids)
+        return {
+            "added": len(self._added),
+            "removed": len(stale_ids),
+            "unchanged": len(set().union(*self._unchanged.values())),
+            "added_ids": self.added_ids,
+            "removed_ids": stale_ids,
+        }
+
+
+def replace_metadata(vectorstore, doc) -> None:
+    """把片段的最新 metadata（如近似重复合并后的来源）写回 docstore（替换文档对象，不修改共享的原对象）"""
+    from langchain_core.documents import Document
+
+    chunk_id = doc.metadata["chunk_id"]
+    if chunk_id in vectorstore.docstore._dict:
+        vectorstore.docstore._dict[chunk_id] = Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+
+def delete_sources(vectorstore, sources: List[str]) -> int:
+    """
+    删除指定来源的全部片段（与其他来源共享的近似重复片段保留，归属改为剩余来源）
+
+    Returns:
+        删除的片段数
+    """
+    manifest = source_manifest(vectorstore)
+    ids = [chunk_id for source in sources for chunk_id in manifest.get(source, [])]
+    ids = _release_sources(vectorstore, ids, set(sources))
+    if ids:
+        vectorstore.delete(ids)
+    return len(ids)
+
+
+def compact_vectorstore(vectorstore) -> tuple:
+    """
+    压缩索引：用现有向量重建一个连续的新索引（按配置的索引类型），并清理 docstore 中的孤立文档
+
+    多次增删之后调用；只读取已保存的向量，不重新向量化。
+
+    Returns:
+        (新向量库, 索引构建报告)
+    """
+    index = vectorstore.index
+    positions = sorted(vectorstore.index_to_docstore_id)
+    # 量化索引优先取全精度副本，避免用解码后的近似向量重建
+    vectors = all_vectors(vectorstore)[positions] if positions else np.zeros((0, index.d), dtype=np.float32)
+
+    new_index, _ = build_index(vectors, index.metric_type, "flat")
+
+    ids = [vectorstore.index_to_docstore_id[i] for i in positions]
+    docstore = InMemoryDocstore({doc_id: vectorstore.docstore.search(doc_id) for doc_id in ids})
+    compacted = FAISS(
+        vectorstore.embedding_function,
+        new_index,
+        docstore,
+        {i: doc_id for i, doc_id in enumerate(ids)},
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy,
+    )
+    return compacted, apply_index_type(compacted)
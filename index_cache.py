@@ -0,0 +1,208 @@
+"""
+FAISS index cache - persist built knowledge bases on disk, keyed by content
+
+缓存键由默认文件的 SHA-256、EMBEDDING_MODEL、chunk_size / chunk_overlap 和缓存格式版本决定，
+任一项变化都会重新构建；"Load Default KB" 命中缓存时以内存映射方式读取索引，不再重新向量化。
+只保留最近使用的 INDEX_CACHE_MAX_ENTRIES 个条目。
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    INDEX_CACHE_DIR,
+    INDEX_CACHE_MAX_ENTRIES,
+    VECTOR_INDEX_TYPE,
+    VECTOR_QUANTIZATION,
+    NEAR_DUP_DEDUP,
+    NEAR_DUP_THRESHOLD,
+    NEAR_DUP_NUM_PERM,
+    NEAR_DUP_BANDS,
+    NEAR_DUP_SHINGLE,
+    SPLITTER_MODE,
+    STRUCTURED_CHUNK_SIZE,
+    STRUCTURED_MIN_HEADINGS,
+)
+from topic_router import topic_config_digest
+from vector_index import attach_full_precision, full_precision_vectors
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.pkl"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"  # 量化索引的全精度向量
+
+# 缓存内容格式版本：片段 metadata / doc_stats 结构变化时递增，使旧缓存自动失效
+CACHE_FORMAT_VERSION = 4  # 3: 片段带 start_index，近似重复片段带 sources；4: 片段带 topic
+
+
+def _file_sha256(file_path: str) -> str:
+    """按块计算文件内容的 SHA-256，避免一次性读入大文件"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compute_cache_key(
+    file_paths: List[str],
+    embedding_model: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    splitter: str = SPLITTER_MODE,
+    structured_chunk_size: int = STRUCTURED_CHUNK_SIZE,
+    index_type: str = VECTOR_INDEX_TYPE,
+    quantization: str = VECTOR_QUANTIZATION,
+    near_dup_threshold: Optional[float] = NEAR_DUP_THRESHOLD if NEAR_DUP_DEDUP else None,
+) -> str:
+    """
+    计算知识库缓存键：文件内容哈希 + 向量模型 + 切分参数 + 近似去重参数 + 主题配置 + 索引类型 / 量化方式
+
+    Args:
+        file_paths: 参与构建的本地文件路径
+        embedding_model: 向量模型名称
+        chunk_size: 文档切分大小
+        chunk_overlap: 文档切分重叠
+        splitter: 切分方式（"structured" / "recursive"）
+        structured_chunk_size: 结构化切分的片段上限（STRUCTURED_MIN_HEADINGS 取自配置，一并计入）
+        index_type: 向量索引类型配置
+        quantization: 向量量化方式配置
+        near_dup_threshold: 近似重复片段合并阈值（None 表示不去重）；
+            MinHash 排列数、LSH 分带数和 shingle 长度取自配置，一并计入
+
+    缓存的片段带有 topic 标签，主题配置（topic_router.topic_config_digest）也计入键中。
+
+    Returns:
+        十六进制缓存键，任一输入变化都会得到新的键
+    """
+    payload = {
+        "format": CACHE_FORMAT_VERSION,
+        "files": sorted(
+            (os.path.basename(p), _file_sha256(p)) for p in file_paths
+        ),
+        "embedding_model": embedding_model,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        # 标题数下限决定每个文件走结构化还是递归切分
+        "splitter": (
+            [splitter, structured_chunk_size, STRUCTURED_MIN_HEADINGS]
+            if splitter == "structured" else [splitter, None]
+        ),
+        "index_type": index_type,
+        "quantization": quantization,
+        # MinHash / LSH 参数同样决定哪些片段被合并
+        "near_dup": (
+            [near_dup_threshold, NEAR_DUP_NUM_PERM, NEAR_DUP_BANDS, NEAR_DUP_SHINGLE]
+            if near_dup_threshold is not None else None
+        ),
+        "topics": topic_config_digest(),
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+def _entry_dir(cache_key: str) -> str:
+    return os.path.join(INDEX_CACHE_DIR, cache_key)
+
+
+def _read_index(index_path: str):
+    """优先以只读内存映射方式加载索引，不支持时退回普通读取"""
+    import faiss
+
+    try:
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except Exception:
+        return faiss.read_index(index_path)
+
+
+def load_cached_index(cache_key: str, embeddings) -> Optional[Tuple[Any, List[Dict[str, Any]]]]:
+    """
+    从磁盘加载已缓存的 FAISS 索引
+
+    Args:
+        cache_key: compute_cache_key 计算出的缓存键
+        embeddings: 查询时使用的向量模型
+
+    Returns:
+        (vectorstore, doc_stats)；未命中或缓存损坏时返回 None
+    """
+    entry = _entry_dir(cache_key)
+    index_path = os.path.join(entry, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        from langchain_community.vectorstores import FAISS
+
+        index = _read_index(index_path)
+        with open(os.path.join(entry, DOCSTORE_FILE), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        with open(os.path.join(entry, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        # 刷新访问时间，供淘汰策略使用
+        os.utime(entry, None)
+
+        vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+        vectors_path = os.path.join(entry, VECTORS_FILE)
+        if os.path.exists(vectors_path):
+            attach_full_precision(vectorstore, vectors_path)
+        return vectorstore, meta.get("doc_stats", [])
+    except Exception:
+        # 缓存损坏：删除后按未命中处理
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+
+def save_index_to_cache(cache_key: str, vectorstore, doc_stats: List[Dict[str, Any]]) -> None:
+    """
+    将构建好的索引写入缓存（先写临时目录再原子替换）
+
+    Args:
+        cache_key: compute_cache_key 计算出的缓存键
+        vectorstore: 构建好的 FAISS 向量库
+        doc_stats: 数据源统计信息，命中缓存时原样恢复
+    """
+    import faiss
+
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=INDEX_CACHE_DIR)
+    try:
+        faiss.write_index(vectorstore.index, os.path.join(tmp_dir, INDEX_FILE))
+        full = full_precision_vectors(vectorstore)
+        if full is not None:
+            import numpy as np
+
+            np.asarray(full, dtype=np.float32).tofile(os.path.join(tmp_dir, VECTORS_FILE))
+        with open(os.path.join(tmp_dir, DOCSTORE_FILE), "wb") as f:
+            pickle.dump((vectorstore.docstore, vectorstore.index_to_docstore_id), f)
+        with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"cache_key": cache_key, "doc_stats": doc_stats}, f, ensure_ascii=False)
+
+        entry = _entry_dir(cache_key)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_dir, entry)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _prune_cache()
+
+
+def _prune_cache() -> None:
+    """只保留最近使用的 INDEX_CACHE_MAX_ENTRIES 个缓存条目"""
+    try:
+        entries = [
+            os.path.join(INDEX_CACHE_DIR, name)
+            for name in os.listdir(INDEX_CACHE_DIR)
+            if not name.startswith(".")
+        ]
+    except FileNotFoundError:
+        return
+
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for stale in entries[INDEX_CACHE_MAX_ENTRIES:]:
+        shutil.rmtree(stale, ignore_errors=True)
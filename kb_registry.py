@@ -0,0 +1,139 @@
+"""
+Process-wide knowledge base registry - share read-only indexes across sessions
+
+同一个进程内的所有 Streamlit 会话共享已构建的 FAISS 索引，而不是每个会话各存一份。
+会话通过 attach() 获得一个租约（lease），租约被释放或随会话状态一起被回收时引用计数减一。
+
+内存上限（KB_REGISTRY_MAX_MB）：
+    登记新索引时若总占用超过上限，先按最近最少使用的顺序淘汰没有会话引用的索引；
+    仍然放不下时该索引不进入注册表，只由当前会话私有持有。
+    正在被会话引用的索引永远不会被淘汰。
+
+注册表中的索引是只读的：需要修改时必须先复制一份再登记为新的条目。
+"""
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import KB_REGISTRY_MAX_MB
+from retrieval import auxiliary_index_bytes
+from vector_index import index_bytes
+
+
+def estimate_index_bytes(vectorstore) -> int:
+    """粗略估算向量库占用的内存：向量索引 + 文档文本 + 关键词索引和主题分片（与向量库一同共享）"""
+    index = getattr(vectorstore, "index", None)
+    vector_bytes = index_bytes(index) if index is not None else 0
+
+    text_bytes = 0
+    docs = getattr(getattr(vectorstore, "docstore", None), "_dict", {}) or {}
+    for doc in docs.values():
+        text_bytes += len(getattr(doc, "page_content", "").encode("utf-8"))
+    aux_bytes = auxiliary_index_bytes(vectorstore) if index is not None else 0
+    return vector_bytes + text_bytes + aux_bytes
+
+
+class KBLease:
+    """会话对某个共享索引的引用；释放或被垃圾回收时自动归还"""
+
+    def __init__(self, registry: "KnowledgeBaseRegistry", key: str, session_id: str):
+        self.key = key
+        self.session_id = session_id
+        self._finalizer = weakref.finalize(self, registry._release, key, session_id)
+
+    def release(self) -> None:
+        self._finalizer()
+
+
+class _Entry:
+    def __init__(self, vectorstore, doc_stats: List[Dict[str, Any]], nbytes: int):
+        self.vectorstore = vectorstore
+        self.doc_stats = doc_stats
+        self.nbytes = nbytes
+        self.sessions: set = set()
+        self.last_used = time.monotonic()
+
+
+class KnowledgeBaseRegistry:
+    """线程安全、带引用计数和内存上限的索引注册表"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[Any, List[Dict[str, Any]]]]:
+        """查找已登记的索引，返回 (vectorstore, doc_stats) 或 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.last_used = time.monotonic()
+            return entry.vectorstore, entry.doc_stats
+
+    def register(self, key: str, vectorstore, doc_stats: List[Dict[str, Any]]) -> bool:
+        """
+        登记一个构建好的索引
+
+        Returns:
+            bool: 是否进入注册表（超出内存上限时为 False）
+        """
+        nbytes = estimate_index_bytes(vectorstore)
+        with self._lock:
+            if key in self._entries:
+                return True
+
+            self._evict_idle(nbytes)
+            if self._total_bytes() + nbytes > self.max_bytes:
+                return False
+
+            self._entries[key] = _Entry(vectorstore, doc_stats, nbytes)
+            return True
+
+    def attach(self, key: str, session_id: str) -> Optional[KBLease]:
+        """会话挂载到已登记的索引，返回租约；索引不存在时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.sessions.add(session_id)
+            entry.last_used = time.monotonic()
+        return KBLease(self, key, session_id)
+
+    def _release(self, key: str, session_id: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.sessions.discard(session_id)
+
+    def _total_bytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    def _evict_idle(self, incoming_bytes: int) -> None:
+        """按 LRU 淘汰无人引用的索引，直到能容纳新索引或没有可淘汰项（需持有锁）"""
+        idle = sorted(
+            (k for k, e in self._entries.items() if not e.sessions),
+            key=lambda k: self._entries[k].last_used,
+        )
+        for key in idle:
+            if self._total_bytes() + incoming_bytes <= self.max_bytes:
+                break
+            del self._entries[key]
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """每个共享索引的会话数和内存估算，用于 Diagnostics 展示"""
+        with self._lock:
+            return [
+                {
+                    "key": key,
+                    "sessions": len(entry.sessions),
+                    "mb": entry.nbytes / (1024 * 1024),
+                    "chunks": int(entry.vectorstore.index.ntotal),
+                }
+                for key, entry in self._entries.items()
+            ]
+
+
+# 进程级单例：模块只会被导入一次，所有会话共用
+registry = KnowledgeBaseRegistry(KB_REGISTRY_MAX_MB * 1024 * 1024)
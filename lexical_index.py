@@ -0,0 +1,205 @@
+"""
+Lexical index - BM25 inverted index with mixed Chinese / English tokenization
+
+知识库文本是中英混排的：英文按单词切分（并为 "Hall 11" 这类"单词 + 编号"额外生成组合词，
+保证宿舍号、表格编号等精确匹配），中文没有空格，按相邻字符二元组（bigram）切分。
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+_ASCII_TOKEN = re.compile(r"[a-z0-9]+")
+_WORD_NUMBER = re.compile(r"\b([a-z]+)\s?(\d+)\b")
+_CJK_RUN = re.compile(r"[㐀-䶿一-鿿]+")
+
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "how", "i", "in", "is", "it", "my", "of", "on", "or", "s", "the", "to", "what",
+    "when", "where", "which", "who", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中英混合分词
+
+    - 英文 / 数字：小写单词，去掉常见停用词
+    - "单词 + 数字"（如 Hall 11、GH 1、Form 16）：额外生成 "hall#11" 组合词
+    - 中文：连续汉字按二元组切分，单字串保留单字
+    """
+    text = text.lower()
+    tokens = [w for w in _ASCII_TOKEN.findall(text) if w not in _STOPWORDS]
+    tokens.extend(f"{word}#{number}" for word, number in _WORD_NUMBER.findall(text))
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    内存倒排索引 + BM25 打分
+
+    idf 在查询时按当前片段数计算，增删片段（updated）后无需重算全部词的 idf。
+    """
+
+    def __init__(self, doc_ids: List[str], texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # 删除的片段在 doc_ids 中留空位（None），倒排记录中的下标保持不变
+        self.doc_ids: List[Optional[str]] = list(doc_ids)
+        self.doc_lengths: List[int] = []
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+
+        for doc_idx, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.doc_lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                postings[token].append((doc_idx, tf))
+
+        self.postings: Dict[str, List[Tuple[int, int]]] = dict(postings)
+        self.n_docs = len(texts)
+        self.total_length = sum(self.doc_lengths)
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    @property
+    def avg_length(self) -> float:
+        return self.total_length / self.n_docs if self.n_docs else 0.0
+
+    def _idf(self, token: str) -> Optional[float]:
+        postings = self.postings.get(token)
+        if not postings:
+            return None
+        return math.log(1 + (self.n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float, float]]:
+        """
+        BM25 检索
+
+        Returns:
+            [(doc_id, bm25 分数, 查询词覆盖率)]，按分数降序；覆盖率为命中的不同查询词占比
+        """
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens or not self.n_docs:
+            return []
+
+        avg_length = self.avg_length or 1
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, int] = defaultdict(int)
+        for token in query_tokens:
+            idf = self._idf(token)
+            if idf is None:
+                continue
+            for doc_idx, tf in self.postings[token]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_idx] / avg_length)
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[doc_idx] += 1
+
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            (self.doc_ids[doc_idx], score, matched[doc_idx] / len(query_tokens))
+            for doc_idx, score in top
+        ]
+
+    def known_fraction(self, query: str) -> float:
+        """查询词中在语料里出现过的比例（比例低说明是语义改写，需要向量检索）"""
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return 0.0
+        return sum(1 for t in query_tokens if self.postings.get(t)) / len(query_tokens)
+
+    def updated(
+        self,
+        added_ids: List[str],
+        added_texts: List[str],
+        removed_ids: List[str],
+        removed_texts: List[str],
+    ) -> "BM25Index":
+        """
+        返回增删片段后的新索引，本索引保持不变（共享注册表中的索引是只读的）
+
+        只对增删的片段分词；未涉及的词的倒排列表与本索引共用。删除留下的空位多于有效片段时压缩下标。
+
+        Args:
+            added_ids / added_texts: 新增片段
+            removed_ids / removed_texts: 删除的片段（文本用于定位它们的倒排记录）
+        """
+        new = object.__new__(BM25Index)
+        new.k1, new.b = self.k1, self.b
+        new.doc_ids = list(self.doc_ids)
+        new.doc_lengths = list(self.doc_lengths)
+        new.postings = dict(self.postings)
+        new.n_docs, new.total_length = self.n_docs, self.total_length
+
+        removed: set = set()
+        touched: set = set()
+        for doc_id, text in zip(removed_ids, removed_texts):
+            tokens = set(tokenize(text))
+            doc_idx = self._locate(doc_id, tokens)
+            if doc_idx is None or doc_idx in removed:
+                continue
+            removed.add(doc_idx)
+            touched.update(tokens)
+            new.doc_ids[doc_idx] = None
+            new.total_length -= new.doc_lengths[doc_idx]
+            new.doc_lengths[doc_idx] = 0
+            new.n_docs -= 1
+        for token in touched:
+            remaining = [entry for entry in new.postings[token] if entry[0] not in removed]
+            if remaining:
+                new.postings[token] = remaining
+            else:
+                del new.postings[token]
+
+        copied: set = set()
+        for doc_id, text in zip(added_ids, added_texts):
+            doc_idx = len(new.doc_ids)
+            counts = Counter(tokenize(text))
+            new.doc_ids.append(doc_id)
+            new.doc_lengths.append(sum(counts.values()))
+            new.total_length += new.doc_lengths[-1]
+            new.n_docs += 1
+            for token, tf in counts.items():
+                # 第一次修改某个词时复制它的倒排列表，不改动本索引
+                if token not in copied:
+                    new.postings[token] = list(new.postings.get(token, ()))
+                    copied.add(token)
+                new.postings[token].append((doc_idx, tf))
+
+        if len(new.doc_ids) - new.n_docs > new.n_docs:
+            new._compact()
+        return new
+
+    def _locate(self, doc_id: str, tokens: set) -> Optional[int]:
+        """片段的下标：在它包含的最短倒排列表中查找（没有词的片段逐个比较）"""
+        candidates = [self.postings[t] for t in tokens if t in self.postings]
+        if candidates:
+            entries = (doc_idx for doc_idx, _ in min(candidates, key=len))
+        else:
+            entries = iter(range(len(self.doc_ids)))
+        return next((doc_idx for doc_idx in entries if self.doc_ids[doc_idx] == doc_id), None)
+
+    def _compact(self) -> None:
+        """去掉删除留下的空位并重排下标（只改写倒排记录，不重新分词）"""
+        remap: Dict[int, int] = {}
+        doc_ids, doc_lengths = [], []
+        for doc_idx, doc_id in enumerate(self.doc_ids):
+            if doc_id is not None:
+                remap[doc_idx] = len(doc_ids)
+                doc_ids.append(doc_id)
+                doc_lengths.append(self.doc_lengths[doc_idx])
+        self.doc_ids, self.doc_lengths = doc_ids, doc_lengths
+        self.postings = {
+            token: [(remap[doc_idx], tf) for doc_idx, tf in postings]
+            for token, postings in self.postings.items()
+        }
+
+    def memory_bytes(self) -> int:
+        """粗略估算占用的内存（按 CPython 对象开销：每条倒排记录约 64 字节，每个词约 200 字节，每个片段约 100 字节）"""
+        n_postings = sum(len(p) for p in self.postings.values())
+        return n_postings * 64 + len(self.postings) * 200 + len(self.doc_ids) * 100
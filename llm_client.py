@@ -0,0 +1,146 @@
+"""
+LLM client registry - one pooled DeepSeek client per API key, shared by all sessions
+
+每个 API Key 对应一个 LLMClient：内部持有带 keep-alive 连接池的 httpx 客户端，
+以及按 prompt 模板预先编译好的 stuff-documents chain。各会话复用同一组已建立的 TLS 连接，
+不再为每次提问重新握手。
+
+调用方通过 lease_llm_client() 获得租约，在租约有效期间使用客户端；客户端被 LRU 淘汰时
+若仍有租约未归还（如另一个会话正在流式生成），等最后一个租约归还后才关闭连接池。
+"""
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict
+
+import httpx
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from config import (
+    DEEPSEEK_MODEL,
+    DEEPSEEK_BASE_URL,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY_SECONDS,
+    LLM_TIMEOUT_SECONDS,
+    LLM_CLIENT_MAX_KEYS,
+)
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+class LLMClient:
+    """某个 API Key 的 LLM 客户端：连接池 + 预编译 chain"""
+
+    def __init__(self, api_key: str):
+        self._http_client = httpx.Client(limits=_pool_limits(), timeout=LLM_TIMEOUT_SECONDS)
+        self.llm = ChatOpenAI(
+            model=DEEPSEEK_MODEL,
+            openai_api_key=api_key,
+            base_url=DEEPSEEK_BASE_URL,
+            http_client=self._http_client,
+        )
+        self._chains: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._leases = 0
+        self._retired = False
+
+    def stuff_chain(self, prompt_template: str):
+        """按 prompt 模板返回（首次调用时编译）stuff-documents chain"""
+        with self._lock:
+            chain = self._chains.get(prompt_template)
+            if chain is None:
+                prompt_tmpl = ChatPromptTemplate.from_template(prompt_template)
+                chain = create_stuff_documents_chain(self.llm, prompt_tmpl)
+                self._chains[prompt_template] = chain
+            return chain
+
+    def close(self) -> None:
+        """关闭连接池"""
+        self._http_client.close()
+
+    def _acquire(self) -> None:
+        with self._lock:
+            self._leases += 1
+
+    def _release(self) -> None:
+        with self._lock:
+            self._leases -= 1
+            close_now = self._retired and self._leases == 0
+        if close_now:
+            self.close()
+
+    def retire(self) -> None:
+        """被注册表淘汰：空闲时立即关闭，否则等最后一个租约归还后关闭"""
+        with self._lock:
+            self._retired = True
+            close_now = self._leases == 0
+        if close_now:
+            self.close()
+
+
+class LLMLease:
+    """对某个 LLMClient 的使用权；release()、退出 with 块或被垃圾回收时归还"""
+
+    def __init__(self, client: LLMClient):
+        self.client = client
+        self._finalizer = weakref.finalize(self, client._release)
+
+    def release(self) -> None:
+        self._finalizer()
+
+    def __enter__(self) -> LLMClient:
+        return self.client
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class LLMClientRegistry:
+    """进程级客户端注册表，按 API Key 的哈希索引，超出上限时淘汰最久未用的客户端"""
+
+    def __init__(self, max_clients: int):
+        self.max_clients = max_clients
+        self._clients: "OrderedDict[str, LLMClient]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lease(self, api_key: str) -> LLMLease:
+        """取得（必要时创建）某个 API Key 的客户端租约"""
+        # 只保存 Key 的哈希，避免在内存结构中以明文作为键
+        key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = LLMClient(api_key)
+                self._clients[key] = client
+            else:
+                self._clients.move_to_end(key)
+            # 在注册表锁内登记租约，淘汰时才能看到它
+            client._acquire()
+            lease = LLMLease(client)
+            while len(self._clients) > self.max_clients:
+                _, evicted = self._clients.popitem(last=False)
+                evicted.retire()
+            return lease
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+
+llm_registry = LLMClientRegistry(LLM_CLIENT_MAX_KEYS)
+
+
+def lease_llm_client(api_key: str) -> LLMLease:
+    """获取某个 API Key 的共享客户端租约：with lease_llm_client(key) as client: ..."""
+    return llm_registry.lease(api_key)
+
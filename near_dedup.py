@@ -0,0 +1,291 @@
+"""
+Near-duplicate chunk removal - MinHash + LSH over character shingles
+
+同一事实常在多个文件中重复出现（如住房价格同时出现在 housing 和 campus life 文件中，
+抓取 / Reddit 内容重复更多）。切分之后、向量化之前，用 MinHash 估计片段之间的 Jaccard 相似度，
+通过 LSH 分桶只比较候选对；相似度不低于 NEAR_DUP_THRESHOLD 的片段合并为一个，
+保留内容最长的片段，metadata["sources"] 记录所有重复片段的来源（并集）。
+
+流式构建（如逐批解析的大 PDF）使用 NearDupIndex：每批内部按上述规则合并，
+再与之前批次已写入索引的片段比较，重复时并入已有片段（已向量化的片段不再替换）。
+增量更新时先用 seed 登记已有知识库的片段，重新上传的内容会并入已有片段而不是重复写入。
+"""
+import re
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from config import NEAR_DUP_THRESHOLD, NEAR_DUP_NUM_PERM, NEAR_DUP_BANDS, NEAR_DUP_SHINGLE
+
+_PRIME = np.uint64(4294967311)  # 大于 2^32 的素数
+_MASK32 = np.uint64(0xFFFFFFFF)
+_BASE = np.uint64(1000003)
+
+_rng = np.random.RandomState(20240601)  # 固定种子：同一语料每次得到相同的签名
+_PERM_A = _rng.randint(1, 2 ** 32 - 1, size=NEAR_DUP_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 2 ** 32 - 1, size=NEAR_DUP_NUM_PERM, dtype=np.uint64)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    """小写并压缩空白，只因排版不同的片段视为相同"""
+    return _WHITESPACE.sub(" ", text.lower()).strip()
+
+
+def shingle_hashes(text: str, size: int = NEAR_DUP_SHINGLE) -> np.ndarray:
+    """
+    字符 n-gram 的 32 位哈希集合（中英文通用，不依赖分词）
+
+    Returns:
+        去重后的 uint64 数组（值域为 32 位）
+    """
+    codes = np.frombuffer(_normalize(text).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return codes
+    if len(codes) < size:
+        size = len(codes)
+    # 多项式滚动哈希，逐位累加（size 很小），对每个起点同时计算
+    hashes = np.zeros(len(codes) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        hashes = ((hashes * _BASE) + codes[offset:len(codes) - size + 1 + offset]) & _MASK32
+    return np.unique(hashes)
+
+
+def minhash_signature(shingles: np.ndarray) -> np.ndarray:
+    """NEAR_DUP_NUM_PERM 个哈希排列下的最小值"""
+    if len(shingles) == 0:
+        return np.full(NEAR_DUP_NUM_PERM, _PRIME, dtype=np.uint64)
+    permuted = (_PERM_A[:, None] * shingles[None, :] + _PERM_B[:, None]) % _PRIME
+    return permuted.min(axis=1)
+
+
+def _find(parent: List[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _signatures(docs: list) -> np.ndarray:
+    return np.vstack([minhash_signature(shingle_hashes(d.page_content)) for d in docs])
+
+
+def _band_keys(signature: np.ndarray) -> List[bytes]:
+    """签名在各 LSH 分段上的分桶键"""
+    rows = NEAR_DUP_NUM_PERM // NEAR_DUP_BANDS
+    return [signature[band * rows:(band + 1) * rows].tobytes() for band in range(NEAR_DUP_BANDS)]
+
+
+def _similar(a: np.ndarray, b: np.ndarray, threshold: float) -> bool:
+    return float(np.mean(a == b)) >= threshold
+
+
+def _group(signatures: np.ndarray, threshold: float) -> List[List[int]]:
+    """LSH 候选对 + 并查集，返回各组成员（组内按出现顺序，组按首个成员排序）"""
+    n = len(signatures)
+    rows = NEAR_DUP_NUM_PERM // NEAR_DUP_BANDS
+
+    # LSH：任一分段的签名完全相同即为候选对，再用完整签名估计相似度
+    parent = list(range(n))
+    for band in range(NEAR_DUP_BANDS):
+        buckets: Dict[bytes, List[int]] = {}
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        for i in range(n):
+            buckets.setdefault(block[i].tobytes(), []).append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            # 与桶内已有的每个组比较一次（完全重复时第一次比较即合并）
+            representatives = [members[0]]
+            for other in members[1:]:
+                for rep in representatives:
+                    root_a, root_b = _find(parent, rep), _find(parent, other)
+                    if root_a == root_b:
+                        break
+                    if _similar(signatures[rep], signatures[other], threshold):
+                        parent[root_b] = root_a
+                        break
+                else:
+                    representatives.append(other)
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(n):
+        groups.setdefault(_find(parent, i), []).append(i)
+    return sorted(groups.values(), key=lambda members: members[0])
+
+
+def _doc_sources(doc) -> List[str]:
+    meta = doc.metadata or {}
+    return list(meta.get("sources") or [meta.get("source") or "Unknown source"])
+
+
+def _merged_sources(docs: Iterable) -> List[str]:
+    sources: List[str] = []
+    for doc in docs:
+        for src in _doc_sources(doc):
+            if src not in sources:
+                sources.append(src)
+    return sources
+
+
+def _merge_group(docs: list, members: List[int]):
+    """组内保留内容最长的片段，记录全部来源和合并的片段数"""
+    best = max(members, key=lambda i: (len(docs[i].page_content), -i))
+    kept = docs[best]
+    kept.metadata = {
+        **(kept.metadata or {}),
+        "sources": _merged_sources(docs[i] for i in members),
+        "duplicates": len(members),
+    }
+    return kept
+
+
+def deduplicate_chunks(docs: list, threshold: float = NEAR_DUP_THRESHOLD) -> Tuple[list, Dict[str, float]]:
+    """
+    合并近似重复的片段
+
+    Args:
+        docs: 切分后的 Document 列表（顺序即语料顺序）
+        threshold: 估计的 Jaccard 相似度阈值
+
+    Returns:
+        (kept_docs, stats)：kept_docs 保持原顺序；被合并的组保留内容最长的片段，
+        其 metadata["sources"] 为组内所有来源（按出现顺序），metadata["duplicates"] 为合并的片段数。
+        stats = {"before", "after", "reduction"}
+    """
+    n = len(docs)
+    if n < 2:
+        return list(docs), {"before": n, "after": n, "reduction": 0.0}
+
+    # 代表片段放在组内最早出现的位置
+    kept_docs = [
+        docs[members[0]] if len(members) == 1 else _merge_group(docs, members)
+        for members in _group(_signatures(docs), threshold)
+    ]
+    after = len(kept_docs)
+    return kept_docs, {"before": n, "after": after, "reduction": 1 - after / n}
+
+
+class NearDupIndex:
+    """
+    跨批次的近似去重：保存已保留片段的 MinHash 签名和 LSH 分桶
+    （每个片段约 2 KB；片段文本与向量库 docstore 共用同一字符串，不额外占用）
+
+    add_batch 先在批内合并（保留最长片段），再与之前批次保留的片段比较；
+    与已保留片段重复时并入该片段（合并来源、累加 duplicates），本批中的重复片段不再保留。
+
+    seed 登记的已有片段（增量更新的基础知识库）同样参与匹配，但不计入统计；
+    来源相同而内容有变化的片段是该来源的新版本，不并入旧片段。
+    """
+
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD):
+        self.threshold = threshold
+        self._docs: list = []
+        self._signatures: List[np.ndarray] = []
+        self._alive: List[bool] = []
+        self._buckets: List[Dict[bytes, int]] = [{} for _ in range(NEAR_DUP_BANDS)]
+        self._seeded = 0
+        self.before = 0
+        self.after = 0
+
+    def seed(self, docs: list) -> None:
+        """
+        登记已在索引中的片段（在任何 add_batch 之前调用）
+
+        登记的是副本：合并来源时只修改副本，由调用方写回 docstore，不改动共享知识库中的文档对象。
+        """
+        from langchain_core.documents import Document
+
+        docs = [Document(page_content=d.page_content, metadata=dict(d.metadata or {})) for d in docs]
+        if not docs:
+            return
+        for doc, signature in zip(docs, _signatures(docs)):
+            self._register(doc, signature)
+        self._seeded = len(self._docs)
+
+    def add_batch(self, docs: list) -> Tuple[list, list]:
+        """
+        Returns:
+            (new_docs, merged)：new_docs 为需要写入索引的新片段（保持原顺序）；
+            merged 为 (已保留片段, 并入的来源列表)，已保留片段的 metadata 已更新，需同步到 docstore
+        """
+        self.before += len(docs)
+        if not docs:
+            return [], []
+        signatures = _signatures(docs)
+        new_docs = []
+        merged: Dict[int, List[str]] = {}
+        for members in _group(signatures, self.threshold):
+            doc = docs[members[0]] if len(members) == 1 else _merge_group(docs, members)
+            signature = signatures[members[0]]
+            target = self._lookup(signature, doc)
+            if target is None:
+                self._register(doc, signature)
+                new_docs.append(doc)
+                continue
+            existing = self._docs[target]
+            sources = merged.setdefault(target, [])
+            sources.extend(src for src in _doc_sources(doc) if src not in sources)
+            if target < self._seeded and set(sources) <= set(_doc_sources(existing)):
+                # 重新上传的已有内容：来源不变，不重复累加 duplicates
+                continue
+            existing.metadata = {
+                **existing.metadata,
+                "sources": _merged_sources([existing, doc]),
+                "duplicates": (existing.metadata.get("duplicates") or 1) + (doc.metadata.get("duplicates") or 1),
+            }
+        self.after += len(new_docs)
+        return new_docs, [(self._docs[target], sources) for target, sources in merged.items()]
+
+    def _lookup(self, signature: np.ndarray, doc):
+        candidates = set()
+        for band, key in enumerate(_band_keys(signature)):
+            position = self._buckets[band].get(key)
+            if position is not None and self._alive[position]:
+                candidates.add(position)
+        for position in sorted(candidates):
+            if not _similar(self._signatures[position], signature, self.threshold):
+                continue
+            existing = self._docs[position]
+            if (
+                position < self._seeded
+                and existing.page_content != doc.page_content
+                and set(_doc_sources(existing)) & set(_doc_sources(doc))
+            ):
+                # 同一来源的旧版本：内容有修改时写入新片段，旧片段由增量更新按过期处理
+                continue
+            return position
+        return None
+
+    def _register(self, doc, signature: np.ndarray) -> None:
+        position = len(self._docs)
+        self._docs.append(doc)
+        self._signatures.append(signature)
+        self._alive.append(True)
+        for band, key in enumerate(_band_keys(signature)):
+            self._buckets[band].setdefault(key, position)
+
+    def discard(self, chunk_ids: set) -> None:
+        """不再匹配已从索引中删除的片段（按 metadata["chunk_id"]）"""
+        for position, doc in enumerate(self._docs):
+            if self._alive[position] and doc.metadata.get("chunk_id") in chunk_ids:
+                self._alive[position] = False
+                if position >= self._seeded:
+                    self.after -= 1
+
+    def refresh(self, docs: list) -> None:
+        """用向量库中的最新片段替换同 chunk_id 的已保留片段（如撤销某个来源后 metadata 已改变）"""
+        latest = {doc.metadata.get("chunk_id"): doc for doc in docs}
+        for position, doc in enumerate(self._docs):
+            replacement = latest.get(doc.metadata.get("chunk_id"))
+            if replacement is not None:
+                self._docs[position] = replacement
+
+    def stats(self) -> Dict[str, float]:
+        """与 deduplicate_chunks 相同格式的累计统计"""
+        return {
+            "before": self.before,
+            "after": self.after,
+            "reduction": 1 - self.after / self.before if self.before else 0.0,
+        }
@@ -1,8 +1,26 @@
 """
 RAG Chain utilities - create_retrieval_chain shim and rerank functions
+
+FlashRank 模型每个进程只加载一次（USE_RERANK 开启时在启动时预加载）。
+并发查询的待打分 pair 在 RERANK_BATCH_WINDOW_MS 内合并成批次交给后台线程，
+(query, chunk_id) 的分数缓存在 LRU 中（RERANK_SCORE_CACHE_SIZE），重复提问不再推理。
 """
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+
 import streamlit as st
 
+from config import (
+    RERANK_MODEL,
+    RERANK_CACHE_DIR,
+    RERANK_BATCH_WINDOW_MS,
+    RERANK_MAX_BATCH,
+    RERANK_SCORE_CACHE_SIZE,
+)
+
 # 兼容 shim：若原函数存在就用原函数，否则定义一个与原用法兼容的实现
 try:
     from langchain.chains import create_retrieval_chain  # type: ignore
@@ -116,7 +134,167 @@ except Exception:
         return SimpleRAG(retriever, doc_chain)
 
 
-def rerank_documents(query: str, documents: list, top_k: int = 3):
+# === Rerank: 进程级共享的 FlashRank 模型 + 跨查询批量打分 + 分数记忆化 ===
+
+_ranker = None
+_ranker_lock = threading.Lock()
+
+
+def get_ranker():
+    """
+    获取进程级共享的 FlashRank Ranker（首次调用时加载模型，之后复用）
+
+    模型文件缓存在 RERANK_CACHE_DIR，而不是每次请求都在 /tmp 中重新解析。
+    """
+    global _ranker
+    if _ranker is not None:
+        return _ranker
+    with _ranker_lock:
+        if _ranker is None:
+            from flashrank import Ranker
+
+            _ranker = Ranker(model_name=RERANK_MODEL, cache_dir=RERANK_CACHE_DIR)
+    return _ranker
+
+
+def start_ranker_warmup() -> None:
+    """在后台线程中预加载 Ranker（服务启动时调用，避免首个查询承担模型加载延迟）"""
+    def _warmup():
+        try:
+            get_ranker()
+        except Exception:
+            pass  # 加载失败时首次 rerank 会再次尝试并回退到原始检索结果
+
+    threading.Thread(target=_warmup, name="rerank-warmup", daemon=True).start()
+
+
+def _chunk_key(doc) -> str:
+    """片段的稳定标识：优先使用 chunk_id，否则使用内容哈希"""
+    meta = getattr(doc, "metadata", {}) or {}
+    if meta.get("chunk_id"):
+        return str(meta["chunk_id"])
+    return hashlib.sha1(getattr(doc, "page_content", "").encode("utf-8")).hexdigest()
+
+
+def _score_pairs(ranker, pairs: list) -> list:
+    """
+    对 (query, passage) 对批量打分：同一查询的 passage 合并为一次 Ranker.rerank 调用
+
+    交叉编码器对每个 pair 独立打分，分批方式不影响分数。
+    不返回分数的 ranker（如 listwise 模型）按返回的名次给出 (0, 1] 之间的分数。
+    """
+    from flashrank import RerankRequest
+
+    by_query: "OrderedDict[str, list]" = OrderedDict()
+    for i, (query, text) in enumerate(pairs):
+        by_query.setdefault(query, []).append({"id": i, "text": text})
+
+    scores = [0.0] * len(pairs)
+    for query, passages in by_query.items():
+        ranked = ranker.rerank(RerankRequest(query=query, passages=passages))
+        for rank, passage in enumerate(ranked):
+            score = passage.get("score")
+            scores[passage["id"]] = float(score) if score is not None else 1 - rank / len(ranked)
+    return scores
+
+
+class RerankBatcher:
+    """
+    把并发查询的待打分 pair 合并成批次推理
+
+    调用线程把请求放入队列后等待；后台线程取出第一个请求后，在 RERANK_BATCH_WINDOW_MS 内
+    继续收集其他请求，合并成不超过 RERANK_MAX_BATCH 个 pair 的批次一起打分
+    （同一查询的 pair 在一次模型调用中完成，所有推理都在后台线程中串行进行）。
+    """
+
+    def __init__(self, ranker):
+        self.ranker = ranker
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="rerank-batcher", daemon=True)
+        self._worker.start()
+
+    def score(self, pairs: list) -> list:
+        if not pairs:
+            return []
+        request = {"pairs": pairs, "done": threading.Event(), "scores": None, "error": None}
+        self._queue.put(request)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["scores"]
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0]["pairs"])
+            deadline = time.monotonic() + RERANK_BATCH_WINDOW_MS / 1000
+            while size < RERANK_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request["pairs"])
+
+            try:
+                all_pairs = [pair for request in batch for pair in request["pairs"]]
+                scores = []
+                for start in range(0, len(all_pairs), RERANK_MAX_BATCH):
+                    scores.extend(_score_pairs(self.ranker, all_pairs[start:start + RERANK_MAX_BATCH]))
+                offset = 0
+                for request in batch:
+                    request["scores"] = scores[offset:offset + len(request["pairs"])]
+                    offset += len(request["pairs"])
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            finally:
+                for request in batch:
+                    request["done"].set()
+
+
+class _ScoreCache:
+    """(query, chunk_id) -> score 的 LRU 缓存"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._scores: "OrderedDict[tuple, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list) -> dict:
+        with self._lock:
+            found = {}
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    found[key] = self._scores[key]
+            return found
+
+    def put_many(self, scores: dict) -> None:
+        with self._lock:
+            self._scores.update(scores)
+            for key in scores:
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+
+_batcher = None
+_score_cache = _ScoreCache(RERANK_SCORE_CACHE_SIZE)
+
+
+def _get_batcher(ranker) -> RerankBatcher:
+    global _batcher
+    with _ranker_lock:
+        if _batcher is None or _batcher.ranker is not ranker:
+            _batcher = RerankBatcher(ranker)
+        return _batcher
+
+
+def rerank_documents(query: str, documents: list, top_k: int = 3, ranker=None):
     """
     使用 FlashRank 对检索到的文档进行重排序
 
@@ -124,6 +302,7 @@ def rerank_documents(query: str, documents: list, top_k: int = 3):
         query: 用户查询
         documents: 检索到的文档列表
         top_k: 保留前 k 个文档
+        ranker: 已加载的 Ranker（默认使用 get_ranker() 返回的进程级实例）
 
     Returns:
         重排序后的文档列表
@@ -138,30 +317,21 @@ def rerank_documents(query: str, documents: list, top_k: int = 3):
         return []
 
     try:
-        from flashrank import Ranker, RerankRequest
-
-        ranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2", cache_dir="/tmp")
-
-        passages = []
-        for i, doc in enumerate(clean_docs):
-            passages.append(
-                {
-                    "id": i,
-                    "text": getattr(doc, "page_content", ""),
-                    "meta": getattr(doc, "metadata", {}),
-                }
-            )
-
-        rerank_request = RerankRequest(query=query, passages=passages)
-        results = ranker.rerank(rerank_request)
-
-        reranked_docs = []
-        for result in results[:top_k]:
-            doc_id = result["id"]
-            if 0 <= doc_id < len(clean_docs):
-                reranked_docs.append(clean_docs[doc_id])
-
-        return reranked_docs
+        ranker = ranker or get_ranker()
+
+        # 只对没有记忆分数的 (query, chunk) 打分
+        keys = [(query, _chunk_key(d)) for d in clean_docs]
+        scores = _score_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in scores]
+        if missing:
+            pairs = [(query, clean_docs[i].page_content) for i in missing]
+            new_scores = _get_batcher(ranker).score(pairs)
+            fresh = {keys[i]: score for i, score in zip(missing, new_scores)}
+            _score_cache.put_many(fresh)
+            scores.update(fresh)
+
+        order = sorted(range(len(clean_docs)), key=lambda i: scores[keys[i]], reverse=True)
+        return [clean_docs[i] for i in order[:top_k]]
     except Exception as e:
         # 如果 rerank 失败，返回原始文档
         st.warning(f"⚠️ Rerank 失败，使用原始检索结果: {e}")
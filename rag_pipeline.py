@@ -1,19 +1,91 @@
 import os
+import shutil
 import tempfile
+import uuid
 from typing import List, Dict, Any, Optional
 
 import streamlit as st
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, WebBaseLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
 
 from config import (
     EMBEDDING_MODEL,
     DEFAULT_CHUNK_SIZE,
     DEFAULT_CHUNK_OVERLAP,
     DEFAULT_KNOWLEDGE_FILES,
+    TOPIC_ROUTING,
 )
+from index_cache import compute_cache_key, load_cached_index, save_index_to_cache
+from kb_registry import registry
+from embedding_service import get_embeddings
+from document_loaders import load_sources
+from embedding_cache import CachedEmbeddings, get_embedding_cache
+from housing import set_housing_kb
+from incremental_index import (
+    clone_vectorstore,
+    compact_vectorstore,
+    delete_sources,
+    index_fingerprint,
+    update_fingerprint,
+)
+from kb_builder import KnowledgeBaseBuilder
+from retrieval import derive_auxiliary_indexes, get_lexical_index, prepare_topic_shards
+from telemetry import span
+
+
+def _session_id() -> str:
+    """当前 Streamlit 会话的稳定标识，用于注册表引用计数"""
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+
+def attach_knowledge_base(
+    kb_key: str,
+    vectorstore,
+    doc_stats: List[Dict[str, Any]],
+    fingerprint: Optional[str] = None,
+    is_default: bool = False,
+) -> None:
+    """
+    把索引登记到进程级注册表，并挂载到当前会话
+
+    Args:
+        kb_key: 索引的唯一键（默认知识库使用内容哈希，可在会话间共享）
+        vectorstore: 构建好的 FAISS 向量库（登记后视为只读）
+        doc_stats: 数据源统计信息
+        fingerprint: 已知的内容指纹（增量更新时由旧指纹推导），不传则重新计算
+        is_default: 是否为默认知识库（只有默认知识库预计算并保存住房方案）
+    """
+    detach_knowledge_base()
+
+    # 关键词倒排索引和主题分片与向量库一同建好（计入注册表的内存估算），首次提问时无需再构建
+    get_lexical_index(vectorstore)
+    if TOPIC_ROUTING:
+        prepare_topic_shards(vectorstore)
+
+    lease = None
+    if registry.register(kb_key, vectorstore, doc_stats):
+        lease = registry.attach(kb_key, _session_id())
+    else:
+        st.warning("⚠️ 共享索引已达内存上限，本会话将单独持有该知识库")
+
+    st.session_state["vectorstore"] = vectorstore
+    st.session_state["doc_stats"] = doc_stats
+    st.session_state["kb_key"] = kb_key
+    st.session_state["kb_lease"] = lease
+    # 内容指纹：答案缓存等下游缓存以此判断知识库是否变化
+    st.session_state["kb_fingerprint"] = fingerprint or index_fingerprint(vectorstore)
+    if is_default:
+        # 默认知识库更新后旧指纹的住房方案不再使用，随即删除
+        set_housing_kb(st.session_state["kb_fingerprint"])
+
+
+def detach_knowledge_base() -> None:
+    """释放当前会话对共享索引的引用，并清除会话中的知识库状态"""
+    lease = st.session_state.pop("kb_lease", None)
+    if lease is not None:
+        lease.release()
+    for key in ("vectorstore", "doc_stats", "kb_key", "kb_fingerprint", "index_report"):
+        st.session_state.pop(key, None)
 
 
 def build_knowledge_base(
@@ -22,6 +94,7 @@ def build_knowledge_base(
     chunk_size: int = DEFAULT_CHUNK_SIZE,
     chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
     use_default_files: bool = False,
+    incremental: bool = False,
 ) -> None:
     """
     从上传文件、URL 或默认文件构建向量知识库
@@ -32,6 +105,7 @@ def build_knowledge_base(
         chunk_size: 文档切分大小
         chunk_overlap: 文档切分重叠
         use_default_files: 是否使用 data/ 目录下的默认文件
+        incremental: 是否在当前知识库上增量更新（按来源替换片段，只向量化新增 / 变化的片段）
     """
     # 初始化参数
     uploaded_files = uploaded_files or []
@@ -40,6 +114,9 @@ def build_knowledge_base(
     progress_bar = st.progress(0)
     status_text = st.empty()
 
+    # 增量模式下以当前会话的知识库为基础；没有知识库时退化为全量构建
+    base_vectorstore = st.session_state.get("vectorstore") if incremental else None
+
     try:
         all_documents = []
         file_stats: List[Dict[str, Any]] = []
@@ -54,221 +131,263 @@ def build_knowledge_base(
                     st.warning(f"⚠️ 默认文件不存在: {file_path}")
 
         # 计算总任务数
-        total_items = len(uploaded_files) + len(urls) + len(default_files)
+        total_items = len(uploaded_files) + len([u for u in urls if u.strip()]) + len(default_files)
         if total_items == 0:
             st.warning("⚠️ 请至少上传一个文件、输入一个网址或加载默认知识库")
             return
 
-        current_item = 0
+        # === 仅默认文件时：优先复用进程内共享索引，其次加载磁盘上的索引缓存 ===
+        cache_key = None
+        if default_files and not uploaded_files and not urls and base_vectorstore is None:
+            status_text.text("🗄️ Checking index cache...")
+            cache_key = compute_cache_key(default_files, EMBEDDING_MODEL, chunk_size, chunk_overlap)
+
+            cached = registry.get(cache_key)
+            if cached is None:
+                with span("build.cache_load"):
+                    cached = load_cached_index(cache_key, get_embeddings())
+
+            if cached is not None:
+                vectorstore, cached_stats = cached
+                attach_knowledge_base(cache_key, vectorstore, cached_stats, is_default=True)
+
+                progress_bar.empty()
+                status_text.empty()
+                st.success(f"✅ 知识库已从缓存加载！共包含 {len(cached_stats)} 个数据源。")
+                return
+
+        # === A. 整理数据源（PDF 由进程池按页码区间流式解析，上传文件先写入临时文件供加载器读取） ===
+        sources: List[Dict[str, Any]] = []
+        pdf_sources: List[Dict[str, Any]] = []
+        for file_path in default_files:
+            (pdf_sources if file_path.lower().endswith(".pdf") else sources).append({
+                "kind": "pdf" if file_path.lower().endswith(".pdf") else "text",
+                "location": file_path,
+                "name": os.path.basename(file_path),
+                "source": file_path,
+                "type": "📄 默认文件",
+            })
+
+        temp_paths = []
+        for uploaded_file in uploaded_files:
+            is_pdf = uploaded_file.name.lower().endswith(".pdf")
+            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
+                # 按块复制上传缓冲区，不生成整个文件的 bytes 副本
+                uploaded_file.seek(0)
+                shutil.copyfileobj(uploaded_file, tmp_file)
+                temp_paths.append(tmp_file.name)
+            (pdf_sources if is_pdf else sources).append({
+                "kind": "pdf" if is_pdf else "text",
+                "location": tmp_file.name,
+                "name": uploaded_file.name,
+                # 以上传文件名作为来源键（临时文件路径每次都不同）
+                "source": uploaded_file.name,
+                "type": "📄 上传文件",
+            })
+
+        for url in urls:
+            if not url.strip():
+                continue
+            sources.append({
+                "kind": "url",
+                "location": url,
+                "name": url,
+                "source": url,
+                "type": "🌐 网页",
+            })
+
+        # 片段级向量缓存：内容相同的片段直接复用向量，只对未命中的片段调用模型
+        embeddings = CachedEmbeddings(get_embeddings(), get_embedding_cache())
+        # 增量模式在当前知识库的副本上按来源更新，共享索引保持只读
+        builder = KnowledgeBaseBuilder(
+            embeddings,
+            base_vectorstore=base_vectorstore,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            on_status=status_text.text,
+        )
 
-        # === A0. 处理默认文件 ===
-        if default_files:
-            for file_path in default_files:
-                current_item += 1
-                progress = current_item / (total_items + 1)
-                progress_bar.progress(progress)
-                status_text.text(f"📖 Loading default file: {os.path.basename(file_path)}")
+        try:
+            # === B. 并发加载文本和网页（网页用线程池），进度条由完成事件驱动 ===
+            status_text.text(f"📖 Loading {len(sources)} sources...")
 
-                try:
-                    if file_path.lower().endswith(".pdf"):
-                        loader = PyPDFLoader(file_path)
-                    else:
-                        loader = TextLoader(file_path, encoding="utf-8")
+            def _on_source_loaded(done: int, total: int, spec: Dict[str, Any]) -> None:
+                progress_bar.progress(done / (total + len(pdf_sources) + 1))
+                status_text.text(f"📖 Loaded ({done}/{total}): {spec['name']}")
 
-                    docs = loader.load()
+            with span("build.load", sources=len(sources)):
+                results = load_sources(sources, on_complete=_on_source_loaded)
 
-                    # 调试：打印加载结果的类型
-                    # st.write(f"DEBUG: 加载 {os.path.basename(file_path)}, 类型: {type(docs)}, 是列表: {isinstance(docs, list)}")
+            for result in results:
+                spec = result["spec"]
+                label = "网页" if spec["kind"] == "url" else "文件"
 
-                    # 确保 docs 是列表且所有元素都有 page_content 属性
-                    if not isinstance(docs, list):
-                        docs = [docs] if docs else []
+                if result["error"] is not None:
+                    if spec["kind"] == "url":
+                        st.warning(f"⚠️ 网页爬取失败 ({spec['name']}): {result['error']}")
+                    else:
+                        st.error(f"❌ 文件 {spec['name']} 读取失败: {result['error']}")
+                    continue
 
-                    # 过滤并记录问题文档
-                    valid_docs = []
-                    for i, d in enumerate(docs):
-                        if hasattr(d, "page_content"):
-                            valid_docs.append(d)
-                        else:
-                            st.warning(f"⚠️ 文件 {os.path.basename(file_path)} 的第 {i} 个文档不是标准格式（类型: {type(d)}），已跳过")
+                if result["skipped"]:
+                    st.warning(f"⚠️ {label} {spec['name']} 中有 {result['skipped']} 个文档不是标准格式，已跳过")
 
-                    docs = valid_docs
-                    if not docs:
-                        st.warning(f"⚠️ 文件 {os.path.basename(file_path)} 没有提取到有效文档")
-                        continue
+                docs = result["docs"]
+                if not docs:
+                    st.warning(f"⚠️ {label} {spec['name']} 没有提取到有效文档")
+                    continue
 
-                    all_documents.extend(docs)
+                for d in docs:
+                    d.metadata["source"] = spec["source"]
+                all_documents.extend(docs)
 
-                    file_stats.append({
-                        "name": os.path.basename(file_path),
-                        "type": "📄 默认文件",
-                        "chars": sum(len(d.page_content) for d in docs)
-                    })
-                except Exception as e:
-                    st.error(f"❌ 默认文件 {file_path} 读取失败: {e}")
-                    continue
+                file_stats.append({
+                    "name": spec["name"],
+                    "source": spec["source"],
+                    "type": spec["type"],
+                    "chars": sum(len(d.page_content) for d in docs)
+                })
 
-        # === A. 处理上传的文件 ===
-        if uploaded_files:
-            for uploaded_file in uploaded_files:
-                current_item += 1
-                progress = current_item / (total_items + 1)
-                progress_bar.progress(progress)
-                status_text.text(f"📖 Loading file: {uploaded_file.name}")
-
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-                    tmp_file.write(uploaded_file.getvalue())
-                    temp_filepath = tmp_file.name
-                
-                try:
-                    if uploaded_file.name.lower().endswith(".pdf"):
-                        loader = PyPDFLoader(temp_filepath)
-                    else:
-                        loader = TextLoader(temp_filepath, encoding="utf-8")
-
-                    docs = loader.load()
-
-                    # 确保 docs 是列表且所有元素都有 page_content 属性
-                    if not isinstance(docs, list):
-                        docs = [docs] if docs else []
-
-                    # 过滤并记录问题文档
-                    valid_docs = []
-                    for i, d in enumerate(docs):
-                        if hasattr(d, "page_content"):
-                            valid_docs.append(d)
-                        else:
-                            st.warning(f"⚠️ 文件 {uploaded_file.name} 的第 {i} 个文档不是标准格式（类型: {type(d)}），已跳过")
-
-                    docs = valid_docs
-                    if not docs:
-                        st.warning(f"⚠️ 文件 {uploaded_file.name} 没有提取到有效文档")
-                        continue
-
-                    all_documents.extend(docs)
-
-                    file_stats.append({
-                        "name": uploaded_file.name,
-                        "type": "📄 上传文件",
-                        "chars": sum(len(d.page_content) for d in docs)
-                    })
-                except Exception as e:
-                    st.error(f"❌ 文件 {uploaded_file.name} 读取失败: {e}")
-                    continue
-                finally:
-                    if os.path.exists(temp_filepath):
-                        try:
-                            os.unlink(temp_filepath)
-                        except Exception:
-                            pass  # 静默处理清理失败
-
-        # === B. 处理 URL (带浏览器伪装) ===
-        if urls:
-            for url in urls:
-                if not url.strip(): continue
-                
-                current_item += 1
-                progress = current_item / (total_items + 1)
-                progress_bar.progress(progress)
-                status_text.text(f"🌐 Scraping webpage: {url}")
+            # === C. 切分、去重与向量化：加载的文档整体处理，PDF 每解析一批页面就写入一批 ===
+            # 按标题 / 问答结构切分（识别不到结构的文档按字符切分），片段带 start_index 和 heading_path
+            status_text.text("✂️ Splitting documents...")
+            builder.add_documents(all_documents)
+            del all_documents, results  # 原文不再需要
 
+            for done, spec in enumerate(pdf_sources, start=1):
                 try:
-                    # 伪装成浏览器，防止 403 错误
-                    headers = {
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36"
-                    }
-                    loader = WebBaseLoader(url, header_template=headers)
-                    docs = loader.load()
-
-                    # 确保 docs 是列表且所有元素都有 page_content 属性
-                    if not isinstance(docs, list):
-                        docs = [docs] if docs else []
-
-                    # 过滤并记录问题文档
-                    valid_docs = []
-                    for i, d in enumerate(docs):
-                        if hasattr(d, "page_content"):
-                            valid_docs.append(d)
-                        else:
-                            st.warning(f"⚠️ 网页 {url} 的第 {i} 个文档不是标准格式（类型: {type(d)}），已跳过")
-
-                    docs = valid_docs
-                    if not docs:
-                        st.warning(f"⚠️ 网页 {url} 没有提取到有效文档")
-                        continue
-
-                    all_documents.extend(docs)
-
-                    file_stats.append({
-                        "name": url,
-                        "type": "🌐 网页",
-                        "chars": sum(len(d.page_content) for d in docs)
-                    })
+                    chars = builder.add_pdf(spec["location"], spec["source"], spec["name"])
                 except Exception as e:
-                    st.warning(f"⚠️ 网页爬取失败 ({url}): {e}")
+                    st.error(f"❌ 文件 {spec['name']} 读取失败: {e}")
+                    continue
+                progress_bar.progress((len(sources) + done) / (len(sources) + len(pdf_sources) + 1))
+                if not chars:
+                    st.warning(f"⚠️ 文件 {spec['name']} 没有提取到有效文档")
                     continue
+                file_stats.append({
+                    "name": spec["name"],
+                    "source": spec["source"],
+                    "type": spec["type"],
+                    "chars": chars,
+                })
+        finally:
+            for temp_filepath in temp_paths:
+                try:
+                    os.unlink(temp_filepath)
+                except Exception:
+                    pass  # 静默处理清理失败
 
-        # === C. 切分与向量化 ===
-        if not all_documents:
+        if not builder.chunks:
             progress_bar.empty()
             status_text.empty()
             st.error("❌ 未提取到有效文本")
             return
 
-        # 最后一次检查：确保所有文档都是有效的
-        status_text.text("🔍 Validating documents...")
-        valid_all_documents = []
-        for i, doc in enumerate(all_documents):
-            if hasattr(doc, "page_content"):
-                valid_all_documents.append(doc)
-            else:
-                st.warning(f"⚠️ 检测到第 {i} 个文档格式异常（类型: {type(doc)}），已跳过")
-
-        if not valid_all_documents:
-            progress_bar.empty()
-            status_text.empty()
-            st.error("❌ 所有文档都不是有效格式")
-            return
+        result = builder.finish()
+        vectorstore = result["vectorstore"]
+        # 近似重复片段已合并（保留来源并集），减少向量化耗时和索引内存，避免 top-k 被重复内容占满
+        dedup_stats = result["dedup"]
+        dedup_note = (
+            f"（近似重复合并 {dedup_stats['before']} → {dedup_stats['after']}，"
+            f"减少 {dedup_stats['reduction']:.0%}）"
+            if dedup_stats else ""
+        )
 
-        all_documents = valid_all_documents
+        if base_vectorstore is not None:
+            changes = result["changes"]
+            # 关键词索引、主题分片和指纹只按增删的片段更新，不对整个知识库重建
+            derive_auxiliary_indexes(base_vectorstore, vectorstore, changes["added_ids"], changes["removed_ids"])
+            fingerprint = update_fingerprint(
+                st.session_state.get("kb_fingerprint") or index_fingerprint(base_vectorstore),
+                changes["added_ids"], changes["removed_ids"],
+            )
+            doc_stats = _merge_doc_stats(st.session_state.get("doc_stats") or [], file_stats)
+            attach_knowledge_base(f"custom-{uuid.uuid4().hex[:16]}", vectorstore, doc_stats, fingerprint=fingerprint)
 
-        status_text.text("✂️ Splitting documents...")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        split_docs = text_splitter.split_documents(all_documents)
-
-        # 验证切分后的文档
-        status_text.text("🔍 Validating chunks...")
-        valid_split_docs = []
-        for i, doc in enumerate(split_docs):
-            if hasattr(doc, "page_content"):
-                valid_split_docs.append(doc)
-            else:
-                st.warning(f"⚠️ 切分后第 {i} 个文档格式异常（类型: {type(doc)}），已跳过")
-
-        if not valid_split_docs:
             progress_bar.empty()
             status_text.empty()
-            st.error("❌ 切分后没有有效文档")
+            st.success(
+                f"✅ 知识库已更新！新增 {changes['added']} 个片段，删除 {changes['removed']} 个过期片段，"
+                f"{changes['unchanged']} 个片段未变化{dedup_note}，向量缓存命中率 {result['hit_rate']:.0%}。"
+            )
             return
 
-        split_docs = valid_split_docs
+        index_report = result["index_report"]
 
-        status_text.text("🔢 Generating vector index (first run may download model, please wait)...")
-        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-        vectorstore = FAISS.from_documents(split_docs, embeddings)
+        # 默认知识库写入缓存，下次直接加载（缓存失败不影响本次构建）
+        if cache_key:
+            try:
+                save_index_to_cache(cache_key, vectorstore, file_stats)
+            except Exception as e:
+                st.warning(f"⚠️ 索引缓存写入失败: {e}")
+
+        attach_knowledge_base(
+            cache_key or f"custom-{uuid.uuid4().hex[:16]}", vectorstore, file_stats, is_default=cache_key is not None
+        )
+        st.session_state["index_report"] = index_report
 
-        st.session_state["vectorstore"] = vectorstore
-        st.session_state["doc_stats"] = file_stats 
-        
         progress_bar.empty()
         status_text.empty()
-        st.success(f"✅ 知识库构建完成！共包含 {len(file_stats)} 个数据源。")
+        st.success(
+            f"✅ 知识库构建完成！共包含 {len(file_stats)} 个数据源，"
+            f"{result['chunks']} 个片段{dedup_note}，向量缓存命中率 {result['hit_rate']:.0%}，"
+            f"索引类型 {index_report['index_type']}（召回率 {index_report.get('recall', 1.0):.0%}）"
+            + (
+                f"，{index_report['quantization']} 量化节省 "
+                f"{1 - index_report['index_bytes'] / max(index_report['full_bytes'], 1):.0%} 内存。"
+                if index_report["quantization"] != "none" else "。"
+            )
+        )
 
     except Exception as e:
         progress_bar.empty()
         status_text.empty()
         st.error(f"❌ 构建过程发生错误: {e}")
         st.exception(e)  # 显示完整错误堆栈，便于调试
+
+
+def _merge_doc_stats(
+    existing: List[Dict[str, Any]], updated: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """合并数据源统计：同一来源以新统计为准"""
+    updated_sources = {stat.get("source", stat["name"]) for stat in updated}
+    kept = [stat for stat in existing if stat.get("source", stat["name"]) not in updated_sources]
+    return kept + updated
+
+
+def remove_knowledge_sources(sources: List[str]) -> None:
+    """
+    从当前知识库中删除指定来源的全部片段（不重新向量化其他来源）
+
+    Args:
+        sources: 来源键列表（见 doc_stats 中的 "source"）
+    """
+    base_vectorstore = st.session_state.get("vectorstore")
+    if base_vectorstore is None:
+        return
+
+    vectorstore = clone_vectorstore(base_vectorstore)
+    removed = delete_sources(vectorstore, sources)
+    doc_stats = [
+        stat for stat in st.session_state.get("doc_stats") or []
+        if stat.get("source", stat["name"]) not in sources
+    ]
+
+    if not doc_stats:
+        detach_knowledge_base()
+    else:
+        attach_knowledge_base(f"custom-{uuid.uuid4().hex[:16]}", vectorstore, doc_stats)
+    st.toast(f"已删除 {removed} 个片段", icon="🗑️")
+
+
+def compact_knowledge_base() -> None:
+    """用现有向量重建连续索引，回收多次增删留下的空间"""
+    base_vectorstore = st.session_state.get("vectorstore")
+    if base_vectorstore is None:
+        return
+
+    vectorstore, index_report = compact_vectorstore(base_vectorstore)
+    attach_knowledge_base(
+        f"custom-{uuid.uuid4().hex[:16]}", vectorstore, st.session_state.get("doc_stats") or []
+    )
+    st.session_state["index_report"] = index_report
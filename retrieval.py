@@ -0,0 +1,247 @@
+"""
+Hybrid retrieval - BM25 keyword hits fused with FAISS vector hits
+
+两路检索结果按倒数排名融合（Reciprocal Rank Fusion）。对 "Hall 11 shuttle" 这类短关键词查询，
+如果倒排索引的命中足够确定，则直接返回关键词结果，跳过查询向量化和向量检索。
+routed_search 先把查询路由到相关的主题分片（见 topic_router），只在分片内做混合检索：
+分片的向量检索在原索引上按位置过滤，关键词检索使用分片自己的 BM25 索引。
+"""
+import threading
+import time
+import weakref
+from typing import List, Optional, Tuple
+
+from config import (
+    HYBRID_RETRIEVAL,
+    RRF_K,
+    LEXICAL_FAST_PATH,
+    LEXICAL_FAST_PATH_MAX_TOKENS,
+    TOPIC_ROUTING,
+    TOPIC_FALLBACK_MIN_SIMILARITY,
+)
+from lexical_index import BM25Index, tokenize
+from vector_index import cosine_similarities, vector_search
+from topic_router import TopicShard, derive_topic_shards, get_topic_shards
+from telemetry import latency, span
+
+# 每个向量库对象对应一个倒排索引；向量库被回收后自动释放
+_lexical_indexes: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index(vectorstore) -> BM25Index:
+    """
+    获取（必要时构建）与向量库配套的 BM25 倒排索引
+
+    构建知识库时调用一次即可预先建好；共享注册表中的向量库只读，所以索引也可以跨会话共享。
+    """
+    with _lexical_lock:
+        index = _lexical_indexes.get(vectorstore)
+        if index is None:
+            doc_ids = list(vectorstore.index_to_docstore_id.values())
+            texts = [vectorstore.docstore.search(doc_id).page_content for doc_id in doc_ids]
+            index = BM25Index(doc_ids, texts)
+            _lexical_indexes[vectorstore] = index
+        return index
+
+
+def prepare_topic_shards(vectorstore) -> None:
+    """预先建好主题分片及各分片的关键词索引（构建知识库时调用，首次路由检索无需再构建）"""
+    get_topic_shards(vectorstore)
+
+
+def derive_auxiliary_indexes(base_vectorstore, vectorstore, added_ids: List[str], removed_ids: List[str]) -> None:
+    """
+    增量更新后，由原向量库已建好的关键词索引和主题分片推导出新向量库的（只分词、读取增删的片段）
+
+    原向量库还没有建好的索引不推导，新向量库之后按需全量构建。
+    """
+    with _lexical_lock:
+        base = _lexical_indexes.get(base_vectorstore)
+        if base is not None and vectorstore not in _lexical_indexes:
+            removed = [base_vectorstore.docstore.search(doc_id) for doc_id in removed_ids]
+            _lexical_indexes[vectorstore] = base.updated(
+                added_ids, [vectorstore.docstore.search(doc_id).page_content for doc_id in added_ids],
+                removed_ids, [doc.page_content for doc in removed],
+            )
+    if TOPIC_ROUTING:
+        derive_topic_shards(base_vectorstore, vectorstore, added_ids, removed_ids)
+
+
+def auxiliary_index_bytes(vectorstore) -> int:
+    """关键词倒排索引和主题分片的内存估算（尚未构建时先构建，登记到共享注册表时使用）"""
+    nbytes = get_lexical_index(vectorstore).memory_bytes()
+    if TOPIC_ROUTING:
+        nbytes += get_topic_shards(vectorstore).memory_bytes()
+    return nbytes
+
+
+def embed_query(vectorstore, query: str) -> list:
+    """查询向量化（计入 retrieval.embed_query 耗时）"""
+    with span("retrieval.embed_query"):
+        return vectorstore.embeddings.embed_query(query)
+
+
+def _lexical_index_for(vectorstore, shard: Optional[TopicShard]) -> BM25Index:
+    return shard.lexical_index if shard is not None else get_lexical_index(vectorstore)
+
+
+def lexical_search(
+    vectorstore, query: str, k: int, shard: Optional[TopicShard] = None
+) -> List[Tuple[str, float, float]]:
+    """关键词检索，返回 [(doc_id, bm25 分数, 查询词覆盖率)]；指定 shard 时只检索该分片"""
+    index = _lexical_index_for(vectorstore, shard)
+    with span("retrieval.lexical_search"):
+        return index.search(query, k)
+
+
+def is_keyword_confident(
+    vectorstore, query: str, lexical_hits: list, shard: Optional[TopicShard] = None
+) -> bool:
+    """
+    关键词结果是否足够确定，可以跳过向量检索
+
+    条件：查询很短（关键词式查询）、所有查询词都在语料中出现过、
+    且排名第一的片段包含全部查询词。
+    """
+    if not (HYBRID_RETRIEVAL and LEXICAL_FAST_PATH) or not lexical_hits:
+        return False
+    if len(set(tokenize(query))) > LEXICAL_FAST_PATH_MAX_TOKENS:
+        return False
+    if _lexical_index_for(vectorstore, shard).known_fraction(query) < 1.0:
+        return False
+    return lexical_hits[0][2] >= 1.0
+
+
+def hybrid_search(
+    vectorstore,
+    query: str,
+    k: int,
+    query_vector: Optional[list] = None,
+    lexical_hits: Optional[list] = None,
+    shard: Optional[TopicShard] = None,
+) -> list:
+    """
+    混合检索
+
+    Args:
+        vectorstore: FAISS 向量库
+        query: 用户查询
+        k: 返回的片段数
+        query_vector: 已计算好的查询向量（可选，避免重复向量化）
+        lexical_hits: 已计算好的关键词结果（可选）
+        shard: 只在该主题分片内检索（可选）
+
+    Returns:
+        Document 列表
+    """
+    selector = shard.selector if shard is not None else None
+    if not HYBRID_RETRIEVAL:
+        if query_vector is None:
+            query_vector = embed_query(vectorstore, query)
+        with span("retrieval.vector_search"):
+            return vector_search(vectorstore, query_vector, k, selector=selector)
+
+    fetch_k = max(k * 3, 20)
+    if lexical_hits is None:
+        lexical_hits = lexical_search(vectorstore, query, fetch_k, shard=shard)
+
+    # 快速路径：关键词命中足够确定时，不做查询向量化
+    if query_vector is None and is_keyword_confident(vectorstore, query, lexical_hits, shard=shard):
+        return [vectorstore.docstore.search(doc_id) for doc_id, _, _ in lexical_hits[:k]]
+
+    if query_vector is None:
+        query_vector = embed_query(vectorstore, query)
+    with span("retrieval.vector_search"):
+        vector_hits = vector_search(vectorstore, query_vector, fetch_k, selector=selector)
+
+    # 倒数排名融合：score = Σ 1 / (RRF_K + rank)
+    fused = {}
+    docs_by_id = {}
+    for rank, doc in enumerate(vector_hits):
+        doc_id = doc.metadata.get("chunk_id") or id(doc)
+        docs_by_id[doc_id] = doc
+        fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    for rank, (doc_id, _, _) in enumerate(lexical_hits):
+        if doc_id not in docs_by_id:
+            docs_by_id[doc_id] = vectorstore.docstore.search(doc_id)
+        fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [docs_by_id[doc_id] for doc_id in ranked]
+
+
+def _fuse(result_lists: List[list], k: int) -> list:
+    """多个分片的结果按倒数排名融合"""
+    fused = {}
+    docs_by_id = {}
+    for docs in result_lists:
+        for rank, doc in enumerate(docs):
+            doc_id = doc.metadata.get("chunk_id") or id(doc)
+            docs_by_id[doc_id] = doc
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [docs_by_id[doc_id] for doc_id in ranked]
+
+
+def routed_search(
+    vectorstore,
+    query: str,
+    k: int,
+    query_vector: Optional[list] = None,
+    lexical_hits: Optional[list] = None,
+    topics: Optional[List[str]] = None,
+) -> list:
+    """
+    主题路由检索：只在路由到的分片内做混合检索，路由不确定时退回全局 hybrid_search
+
+    Args:
+        vectorstore: 完整的 FAISS 向量库
+        query / k / query_vector / lexical_hits: 同 hybrid_search（lexical_hits 是全局结果，只用于全局检索）
+        topics: 指定分片（如 Housing Wizard 固定为 ["housing"]），此时不做相关度回退；
+            指定的分片都不存在时使用全局检索
+
+    Returns:
+        Document 列表
+    """
+    def search_global() -> list:
+        return hybrid_search(vectorstore, query, k, query_vector=query_vector, lexical_hits=lexical_hits)
+
+    if not TOPIC_ROUTING:
+        return search_global()
+
+    # 关键词快速路径在全局索引上已足够便宜，不再路由
+    if query_vector is None and lexical_hits and is_keyword_confident(vectorstore, query, lexical_hits):
+        return search_global()
+
+    route_start = time.perf_counter()
+    shards = get_topic_shards(vectorstore)
+    forced = topics is not None
+    if not forced:
+        topics = shards.route(query, query_vector)
+    topics = [t for t in topics if t in shards.shards]
+    # 分片合计不足 k 个片段时，分片检索必然漏召回
+    if not forced and sum(shards.sizes[t] for t in topics) < k:
+        topics = []
+    latency.record("retrieval.route", time.perf_counter() - route_start, topics="+".join(topics) or "global")
+
+    if not topics:
+        return search_global()
+
+    if query_vector is None:
+        query_vector = embed_query(vectorstore, query)
+    with span("retrieval.shard_search", shards=len(topics)):
+        results = [
+            hybrid_search(vectorstore, query, k, query_vector=query_vector, shard=shards.shards[t])
+            for t in topics
+        ]
+    docs = results[0] if len(results) == 1 else _fuse(results, k)
+
+    # 分片内最佳命中仍不相关：多半是路由错了，改用全局检索
+    if not forced and docs:
+        sims = cosine_similarities(vectorstore, query_vector, [d.metadata.get("chunk_id") for d in docs])
+        best = max((sim for sim in sims if sim is not None), default=None)
+        if best is not None and best < TOPIC_FALLBACK_MIN_SIMILARITY:
+            with span("retrieval.route_fallback"):
+                return search_global()
+    return docs
@@ -0,0 +1,380 @@
+"""
+离线基准测试：在不启动 Streamlit 的情况下，测量知识库构建和 RAG 问答随语料规模的变化
+
+对 data/ 中的真实文件，以及将其扩充到 10× / 100× / 1000× 的合成语料，分别测量：
+加载 / 切分 / 近似去重 / 向量化 / 建索引耗时（与应用共用 kb_builder 的构建流程）、峰值内存（RSS）、索引大小、检索延迟分位数，
+以及使用本地桩 LLM 的端到端回答延迟（不调用 DeepSeek）、增量添加一个来源的耗时
+（同时检查关键词索引和主题分片是增量更新而不是重建的）。
+每个规模在独立子进程中运行，峰值内存互不影响；结果写成 JSON，便于跨提交对比。
+
+使用方法（在项目根目录运行）:
+python scripts/benchmark_rag.py                                # 1× / 10× / 100× / 1000×，真实向量模型
+python scripts/benchmark_rag.py --scales 1 10 --embeddings hash   # 用哈希向量快速跑通
+python scripts/benchmark_rag.py --compare benchmark_results/<旧提交>.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from langchain_core.embeddings import Embeddings  # noqa: E402
+
+from config import (  # noqa: E402
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_RETRIEVAL_K,
+    EMBEDDING_MODEL,
+    EXAMPLE_QUESTIONS,
+    VECTOR_INDEX_TYPE,
+    VECTOR_QUANTIZATION,
+)
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+DATA_DIR = PROJECT_ROOT / "data"
+RESULTS_DIR = PROJECT_ROOT / "benchmark_results"
+
+# 关键词式查询（走 BM25 快速路径）和自然语言查询混合
+BENCHMARK_QUERIES = EXAMPLE_QUESTIONS + [
+    "Hall 11 shuttle",
+    "Student's Pass Form 16",
+    "研究生宿舍 申请时间",
+    "学生证 办理",
+]
+
+STUB_ANSWER = "This is a stub answer used for offline benchmarking. 这是离线基准测试使用的桩回答。"
+
+
+# === 合成语料 ===
+
+def make_synthetic_corpus(scale: int, out_dir: str) -> List[str]:
+    """
+    把 data/ 中的文件扩充到 scale 倍：每份副本打乱段落顺序并加上副本标记，
+    保证内容不完全重复（否则切分 ID、向量缓存、BM25 统计都会失真）
+    """
+    paths = []
+    for src in sorted(DATA_DIR.glob("*.txt")):
+        paragraphs = [p for p in src.read_text(encoding="utf-8").split("\n\n") if p.strip()]
+        if scale == 1:
+            paths.append(str(src))
+            continue
+        rng = random.Random(f"{src.name}-{scale}")
+        for copy in range(scale):
+            shuffled = paragraphs[:]
+            rng.shuffle(shuffled)
+            text = "\n\n".join(f"[{src.stem} #{copy}] {p}" for p in shuffled)
+            path = os.path.join(out_dir, f"{src.stem}_{copy:04d}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            paths.append(path)
+    return paths
+
+
+# === 离线组件 ===
+
+class HashEmbeddings(Embeddings):
+    """确定性的哈希词袋向量（不依赖模型下载，用于快速跑通流程；检索质量无意义）"""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        from lexical_index import tokenize
+
+        vector = [0.0] * self.dim
+        for token in tokenize(text):
+            bucket = int(hashlib.md5(token.encode("utf-8")).hexdigest()[:8], 16)
+            vector[bucket % self.dim] += 1.0
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class StubLLMClient:
+    """与 llm_client.LLMClient 接口一致的本地桩客户端：流式返回固定回答"""
+
+    def __init__(self):
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+        self.llm = FakeListChatModel(responses=[STUB_ANSWER])
+        self._chains: Dict[str, Any] = {}
+
+    def stuff_chain(self, prompt_template: str):
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+
+        if prompt_template not in self._chains:
+            self._chains[prompt_template] = create_stuff_documents_chain(
+                self.llm, ChatPromptTemplate.from_template(prompt_template)
+            )
+        return self._chains[prompt_template]
+
+
+def _make_embeddings(kind: str):
+    if kind == "hash":
+        return HashEmbeddings()
+    from embedding_service import get_embeddings
+
+    return get_embeddings()
+
+
+def _peak_rss_mb() -> float:
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    import numpy as np
+
+    values = np.asarray(samples_ms)
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+    }
+
+
+def _measure_incremental_add(vectorstore, embeddings) -> Dict[str, Any]:
+    """
+    在已建好的知识库上增量添加一个来源，测量更新耗时，并检查关键词索引、主题分片和指纹
+    是按增删的片段更新的（只对变化的片段分词），而不是整体重建
+    """
+    from unittest import mock
+
+    from langchain_core.documents import Document
+
+    import lexical_index
+    from incremental_index import index_fingerprint, update_fingerprint
+    from kb_builder import KnowledgeBaseBuilder
+    from retrieval import auxiliary_index_bytes, derive_auxiliary_indexes
+
+    doc = Document(
+        page_content="\n\n".join(
+            f"Hall {90 + i} 宿舍更新：入住时间调整为早上 {8 + i} 点，押金 {200 + i * 50} 新元，shuttle 班次增加。"
+            for i in range(8)
+        ),
+        metadata={"source": "bench-incremental.txt"},
+    )
+    fingerprint = index_fingerprint(vectorstore)
+
+    start = time.perf_counter()
+    builder = KnowledgeBaseBuilder(embeddings, base_vectorstore=vectorstore)
+    builder.add_documents([doc])
+    build = builder.finish()
+    updated, changes = build["vectorstore"], build["changes"]
+    with mock.patch.object(lexical_index, "tokenize", wraps=lexical_index.tokenize) as tokenize:
+        derive_auxiliary_indexes(vectorstore, updated, changes["added_ids"], changes["removed_ids"])
+        auxiliary_index_bytes(updated)  # 登记到注册表时的调用：应直接取到推导出的索引
+        fingerprint = update_fingerprint(fingerprint, changes["added_ids"], changes["removed_ids"])
+    elapsed = time.perf_counter() - start
+
+    changed = len(changes["added_ids"]) + len(changes["removed_ids"])
+    # 每个变化的片段在全局索引和所属分片中各分词一次
+    if tokenize.call_count > 2 * changed:
+        raise AssertionError(f"增量添加重建了关键词索引 / 主题分片：{changed} 个片段变化，分词 {tokenize.call_count} 次")
+    if fingerprint != index_fingerprint(updated):
+        raise AssertionError("增量更新的指纹与重新计算的不一致")
+    return {"chunks": changed, "update_s": elapsed, "tokenized": tokenize.call_count}
+
+
+# === 单个规模的测量（在子进程中运行） ===
+
+def run_scale(scale: int, embeddings_kind: str, repeats: int) -> Dict[str, Any]:
+    from chat import _generate_rag_answer
+    from document_loaders import load_sources
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+    from kb_builder import KnowledgeBaseBuilder
+    from retrieval import get_lexical_index, prepare_topic_shards, routed_search
+
+    result: Dict[str, Any] = {"scale": scale}
+
+    with tempfile.TemporaryDirectory(prefix="ntu_bench_") as tmp_dir:
+        paths = make_synthetic_corpus(scale, tmp_dir)
+        sources = [
+            {"kind": "text", "location": p, "name": os.path.basename(p), "source": p, "type": "bench"}
+            for p in paths
+        ]
+
+        start = time.perf_counter()
+        loaded = load_sources(sources)
+        result["load_s"] = time.perf_counter() - start
+
+        documents = []
+        for item in loaded:
+            for doc in item["docs"]:
+                doc.metadata["source"] = item["spec"]["source"]
+                documents.append(doc)
+        result["files"] = len(paths)
+        result["chars"] = sum(len(d.page_content) for d in documents)
+
+        # 与应用相同的构建流程（切分 → 近似去重 → 向量化 → 建索引），经过片段级向量缓存；
+        # 缓存放在临时目录中且初始为空，测的是首次构建的真实向量化成本，也不会污染应用的缓存
+        cache = EmbeddingCache(
+            os.path.join(tmp_dir, "embeddings.sqlite"),
+            EMBEDDING_MODEL if embeddings_kind == "model" else "hash",
+        )
+        embeddings = CachedEmbeddings(_make_embeddings(embeddings_kind), cache)
+        builder = KnowledgeBaseBuilder(embeddings, chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP)
+        builder.add_documents(documents)
+        del documents, loaded
+        build = builder.finish()
+
+    vectorstore = build["vectorstore"]
+    timings = build["timings"]
+    result["split_s"] = timings["split"]
+    result["dedup_s"] = timings["dedup"]
+    result["embed_s"] = timings["embed"]
+    result["chunks"] = build["chunks"]
+    result["dedup"] = build["dedup"]
+
+    start = time.perf_counter()
+    get_lexical_index(vectorstore)
+    prepare_topic_shards(vectorstore)
+    result["index_s"] = timings["index"] + time.perf_counter() - start
+    index_report = build["index_report"]
+    result["index"] = {
+        key: index_report.get(key)
+        for key in ("index_type", "quantization", "params", "recall", "index_bytes", "full_bytes")
+    }
+
+    # 检索延迟：主题路由 + 混合检索（含查询向量化），每个查询重复 repeats 次
+    retrieval_ms = []
+    for _ in range(repeats):
+        for query in BENCHMARK_QUERIES:
+            start = time.perf_counter()
+            routed_search(vectorstore, query, DEFAULT_RETRIEVAL_K)
+            retrieval_ms.append((time.perf_counter() - start) * 1000)
+    result["retrieval"] = _percentiles(retrieval_ms)
+
+    # 端到端回答延迟（检索 + 拼装 prompt + 桩 LLM 流式输出）
+    client = StubLLMClient()
+    answer_ms = []
+    for query in BENCHMARK_QUERIES:
+        start = time.perf_counter()
+        _generate_rag_answer(client, query, vectorstore=vectorstore)
+        answer_ms.append((time.perf_counter() - start) * 1000)
+    result["answer"] = _percentiles(answer_ms)
+
+    result["incremental"] = _measure_incremental_add(vectorstore, embeddings)
+
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+
+# === 汇总与对比 ===
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def _print_row(r: Dict[str, Any]) -> None:
+    print(
+        f"{r['scale']:>5}× | {r['chunks']:>8,} chunks | load {r['load_s']:7.2f}s | split {r['split_s']:6.2f}s | "
+        f"dedup {r.get('dedup_s', 0.0):6.2f}s | embed {r['embed_s']:8.2f}s | index {r['index_s']:6.2f}s | "
+        f"incr +{r['incremental']['chunks']} {r['incremental']['update_s'] * 1000:6.0f} ms | "
+        f"{r['index']['index_bytes'] / 1048576:8.1f} MB | RSS {r['peak_rss_mb']:7.0f} MB | "
+        f"retrieval p50 {r['retrieval']['p50_ms']:6.1f} / p95 {r['retrieval']['p95_ms']:6.1f} / "
+        f"p99 {r['retrieval']['p99_ms']:6.1f} ms"
+    )
+
+
+def compare(current: Dict[str, Any], baseline_path: str) -> None:
+    """按规模对比两次结果（正数表示变慢 / 变大）"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {r["scale"]: r for r in baseline["results"]}
+
+    print(f"\n📊 对比基线 {baseline.get('commit')} → {current['commit']}")
+    for r in current["results"]:
+        old = previous.get(r["scale"])
+        if old is None:
+            continue
+        deltas = []
+        for label, getter in (
+            ("embed", lambda x: x["embed_s"]),
+            ("index", lambda x: x["index_s"]),
+            ("RSS", lambda x: x["peak_rss_mb"]),
+            ("retrieval p95", lambda x: x["retrieval"]["p95_ms"]),
+        ):
+            before, after = getter(old), getter(r)
+            change = (after - before) / before if before else 0.0
+            deltas.append(f"{label} {change:+.0%}")
+        print(f"{r['scale']:>5}× | " + " | ".join(deltas))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline RAG pipeline benchmark")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--embeddings", choices=["model", "hash"], default="model",
+                        help="model: 实际使用的向量模型；hash: 哈希向量，只测流程开销")
+    parser.add_argument("--repeats", type=int, default=5, help="每个检索查询的重复次数")
+    parser.add_argument("--output", default=None, help="结果 JSON 路径（默认 benchmark_results/<commit>.json）")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 对比")
+    args = parser.parse_args()
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "embeddings": EMBEDDING_MODEL if args.embeddings == "model" else "hash",
+            "chunk_size": DEFAULT_CHUNK_SIZE,
+            "chunk_overlap": DEFAULT_CHUNK_OVERLAP,
+            "retrieval_k": DEFAULT_RETRIEVAL_K,
+            "index_type": VECTOR_INDEX_TYPE,
+            "quantization": VECTOR_QUANTIZATION,
+            "repeats": args.repeats,
+            "queries": len(BENCHMARK_QUERIES),
+        },
+        "results": [],
+    }
+
+    # 每个规模一个全新的子进程（spawn），峰值内存只反映该规模
+    for scale in args.scales:
+        print(f"⏱️ 运行 {scale}× ...", flush=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            result = pool.submit(run_scale, scale, args.embeddings, args.repeats).result()
+        report["results"].append(result)
+        _print_row(result)
+
+    output = args.output or str(RESULTS_DIR / f"{commit}.json")
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已写入: {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"\n❌ 基准测试失败: {e}")
+        sys.exit(1)
@@ -0,0 +1,42 @@
+"""
+下载向量模型并保存为本地模型包，部署后应用启动时直接从本地加载，不再联网下载
+
+安装依赖:
+pip install sentence-transformers
+
+使用方法（在项目根目录运行，部署前执行一次）:
+python scripts/download_embedding_model.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import EMBEDDING_MODEL, EMBEDDING_MODEL_DIR  # noqa: E402
+
+
+def download_model(model_name: str, target_dir: str) -> None:
+    """
+    下载模型并保存到目标目录
+
+    Args:
+        model_name: HuggingFace 模型名称
+        target_dir: 本地模型包目录
+    """
+    from sentence_transformers import SentenceTransformer
+
+    print(f"📥 下载模型: {model_name}")
+    model = SentenceTransformer(model_name)
+
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    model.save(target_dir)
+    print(f"✅ 模型已保存到: {target_dir}")
+
+
+if __name__ == "__main__":
+    try:
+        download_model(EMBEDDING_MODEL, EMBEDDING_MODEL_DIR)
+    except Exception as e:
+        print(f"\n❌ 下载失败: {e}")
+        sys.exit(1)
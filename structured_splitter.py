@@ -0,0 +1,195 @@
+"""
+Structure-aware splitter - keeps heading / FAQ sections of the knowledge files intact
+
+data/ 下的文件按标题组织：Markdown 的 #/##/###、"=== 第一部分 ===" 分区、"Q1:" / "**Q:**" 问答、
+"1. 标题" + "1 (EN):" 编号小节，以及 【小标题】 / **小标题**： 这类小标题。
+按标题建立层级后，整节不超过 STRUCTURED_CHUNK_SIZE 时作为一个片段（相邻的小节合并到同一片段），
+超出时再按子标题拆分，没有子标题的超长小节才退回 RecursiveCharacterTextSplitter。
+
+每个片段都是原文的连续子串（metadata["start_index"] 为其在原文中的位置），
+并带有 metadata["heading_path"]（如 "第一部分：宿舍类型与价格 > Q2: 哪种宿舍最划算？"）。
+识别不到标题结构的文档（PDF、网页等）仍使用原来的字符切分。
+"""
+import re
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from config import SPLITTER_MODE, STRUCTURED_CHUNK_SIZE, STRUCTURED_MIN_HEADINGS
+
+# (正则, 层级)：层级越小越靠上；问答 / 编号小节位于任何 Markdown 标题之下，小标题位于问答之下
+_FAQ_LEVEL = 7
+_LABEL_LEVEL = 8
+_HEADING_PATTERNS: List[Tuple[re.Pattern, Optional[int]]] = [
+    (re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$"), None),  # Markdown：层级 = # 的个数
+    (re.compile(r"^={2,}\s*([^=].*?)\s*={2,}\s*$"), 1),  # === 第一部分：选课与注册 ===
+    (re.compile(r"^(Q\d+\s*[:：].*)$"), _FAQ_LEVEL),  # Q1: ...（"Q1 (EN):" 属于问题正文）
+    (re.compile(r"^\*\*(Q\d*\s*[:：].*?)\*\*\s*$"), _FAQ_LEVEL),  # **Q: ...**
+    (re.compile(r"^【([^】]+)】"), _LABEL_LEVEL),  # 【选课时间 / Registration Timeline】
+    (re.compile(r"^\*\*([^*]+)\*\*\s*[:：]?\s*$"), _LABEL_LEVEL),  # **主要建筑**：
+]
+# "2. 申请流程" 紧跟 "2 (EN): ..." 时视为编号小节标题
+_NUMBERED = re.compile(r"^(\d+)\.\s+(.+)$")
+
+
+class _Section:
+    __slots__ = ("level", "title", "start", "end", "children")
+
+    def __init__(self, level: int, title: Optional[str], start: int):
+        self.level = level
+        self.title = title
+        self.start = start
+        self.end = start
+        self.children: List["_Section"] = []
+
+
+def _match_heading(line: str, next_line: str) -> Optional[Tuple[int, str]]:
+    stripped = line.strip()
+    if not stripped or line[:1].isspace():
+        return None
+    for pattern, level in _HEADING_PATTERNS:
+        match = pattern.match(stripped)
+        if match:
+            if level is None:
+                return len(match.group(1)), match.group(2).strip()
+            return level, match.group(1).strip()
+    match = _NUMBERED.match(stripped)
+    if match and next_line.strip().startswith(f"{match.group(1)} (EN)"):
+        return _FAQ_LEVEL, stripped
+    return None
+
+
+def _parse(text: str) -> Tuple[_Section, int]:
+    """按标题建立章节树；返回 (根节点, 标题数)"""
+    lines = text.splitlines(keepends=True)
+    root = _Section(0, None, 0)
+    stack = [root]
+    headings = 0
+    offset = 0
+    for i, line in enumerate(lines):
+        heading = _match_heading(line, lines[i + 1] if i + 1 < len(lines) else "")
+        if heading is not None:
+            level, title = heading
+            while stack[-1].level >= level:
+                stack.pop().end = offset
+            section = _Section(level, title, offset)
+            stack[-1].children.append(section)
+            stack.append(section)
+            headings += 1
+        offset += len(line)
+    for section in stack:
+        section.end = len(text)
+    return root, headings
+
+
+class _Emitter:
+    def __init__(self, text: str, metadata: dict, chunk_size: int, chunk_overlap: int):
+        self.text = text
+        self.metadata = metadata
+        self.chunk_size = chunk_size
+        self.fallback = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+        )
+        self.chunks: List[Document] = []
+
+    def add(self, start: int, end: int, path: List[str]) -> None:
+        raw = self.text[start:end]
+        content = raw.strip()
+        if not content:
+            return
+        self.chunks.append(Document(
+            page_content=content,
+            metadata={
+                **self.metadata,
+                "start_index": start + (len(raw) - len(raw.lstrip())),
+                "heading_path": " > ".join(path),
+            },
+        ))
+
+    def split_long(self, start: int, end: int, path: List[str]) -> None:
+        """没有子标题的超长小节：字符切分，位置换算回原文"""
+        for piece in self.fallback.create_documents([self.text[start:end]]):
+            self.chunks.append(Document(
+                page_content=piece.page_content,
+                metadata={
+                    **self.metadata,
+                    "start_index": start + piece.metadata["start_index"],
+                    "heading_path": " > ".join(path),
+                },
+            ))
+
+    def emit(self, sections: List[_Section], path: List[str]) -> None:
+        """依次输出同级章节：能放进一个片段的相邻章节合并，超长章节递归拆分"""
+        group: List[_Section] = []
+
+        def flush():
+            if not group:
+                return
+            # 以引言开头的片段归属上级章节；多个同级章节合并时，末级标题以 " | " 连接
+            titled = [s.title for s in group if s.title]
+            group_path = path + [" | ".join(titled)] if group[0].title else path
+            self.add(group[0].start, group[-1].end, group_path)
+            group.clear()
+
+        for section in sections:
+            if section.end - section.start <= self.chunk_size:
+                if group and section.end - group[0].start > self.chunk_size:
+                    flush()
+                group.append(section)
+                continue
+            flush()
+            child_path = path + [section.title] if section.title else path
+            if not section.children:
+                self.split_long(section.start, section.end, child_path)
+                continue
+            # 标题和引言部分作为无标题的首个子节，与后面较小的子节合并
+            intro = _Section(section.level, None, section.start)
+            intro.end = section.children[0].start
+            self.emit([intro] + section.children, child_path)
+        flush()
+
+
+def split_structured(doc: Document, chunk_size: int, chunk_overlap: int) -> Optional[List[Document]]:
+    """
+    按标题结构切分单个文档；标题少于 STRUCTURED_MIN_HEADINGS 时返回 None（由调用方退回字符切分）
+    """
+    root, headings = _parse(doc.page_content)
+    if headings < STRUCTURED_MIN_HEADINGS:
+        return None
+    emitter = _Emitter(doc.page_content, dict(doc.metadata or {}), chunk_size, chunk_overlap)
+    preamble = _Section(0, None, 0)
+    preamble.end = root.children[0].start if root.children else len(doc.page_content)
+    emitter.emit([preamble] + root.children, [])
+    return emitter.chunks
+
+
+def split_documents(
+    docs: List[Document],
+    chunk_size: int,
+    chunk_overlap: int,
+    mode: str = SPLITTER_MODE,
+    structured_chunk_size: int = STRUCTURED_CHUNK_SIZE,
+) -> List[Document]:
+    """
+    切分文档：mode 为 "structured" 时按标题结构切分，识别不到结构的文档及 "recursive" 模式使用字符切分
+
+    Args:
+        docs: 加载后的文档
+        chunk_size / chunk_overlap: 字符切分参数
+        mode: "structured" 或 "recursive"
+        structured_chunk_size: 结构化切分时单个片段的最大字符数
+
+    Returns:
+        片段列表，均带 metadata["start_index"]
+    """
+    recursive = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+    )
+    chunks: List[Document] = []
+    for doc in docs:
+        structured = None
+        if mode == "structured":
+            structured = split_structured(doc, structured_chunk_size, chunk_overlap)
+        chunks.extend(structured if structured is not None else recursive.split_documents([doc]))
+    return chunks
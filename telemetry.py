@@ -0,0 +1,210 @@
+"""
+Latency telemetry - per-stage timing spans with rolling p50 / p95 / p99
+
+每个阶段（如 build.embed、retrieval.search、chat.first_token）保留最近 TELEMETRY_WINDOW 次耗时，
+在 Diagnostics 中展示分位数；每条记录同时以 JSON Lines 写入 TELEMETRY_LOG_FILE，便于离线分析。
+日志由后台线程每隔 TELEMETRY_FLUSH_INTERVAL_SECONDS 批量追加，请求线程只把记录放入内存队列；
+文件超过 TELEMETRY_LOG_MAX_MB 后轮转为 .1 ... .TELEMETRY_LOG_BACKUPS。
+"""
+import atexit
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from config import (
+    TELEMETRY_ENABLED,
+    TELEMETRY_WINDOW,
+    TELEMETRY_LOG_FILE,
+    TELEMETRY_LOG_MAX_MB,
+    TELEMETRY_LOG_BACKUPS,
+    TELEMETRY_FLUSH_INTERVAL_SECONDS,
+)
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """最近秩法分位数（样本已排序）"""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values), max(1, math.ceil(q * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class LatencyStats:
+    """进程级滚动延迟统计，按阶段名聚合"""
+
+    def __init__(self, window: int, log_file: Optional[str], max_log_bytes: int, log_backups: int):
+        self.window = window
+        self.log_file = log_file
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._pending: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+    def record(self, stage: str, seconds: float, **attrs: Any) -> None:
+        """记录一次耗时；attrs 为附加字段（如片段数），只写入日志"""
+        if not TELEMETRY_ENABLED:
+            return
+        ms = seconds * 1000
+        with self._lock:
+            self._samples[stage].append(ms)
+            self._counts[stage] += 1
+        self._append_log({"ts": datetime.now().isoformat(timespec="milliseconds"), "stage": stage, "ms": round(ms, 3), **attrs})
+
+    def _append_log(self, entry: Dict[str, Any]) -> None:
+        """加入写入队列（不阻塞请求线程）；首次调用时启动后台写入线程"""
+        if not self.log_file:
+            return
+        self._pending.put(entry)
+        if self._writer is None:
+            with self._log_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="telemetry-writer", daemon=True)
+                    self._writer.start()
+                    atexit.register(self.flush)
+
+    def flush(self) -> None:
+        """把队列中的记录一次性追加到日志文件，必要时轮转"""
+        batch: List[Dict[str, Any]] = []
+        while True:
+            try:
+                batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not batch or not self.log_file:
+            return
+        lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+        with self._log_lock:
+            try:
+                with open(self.log_file, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    size = f.tell()
+                if size >= self.max_log_bytes:
+                    self._rotate()
+            except OSError:
+                # 日志写入失败不影响主流程，这一批记录直接丢弃
+                pass
+
+    def _rotate(self) -> None:
+        """log -> log.1 -> ... -> log.N，最旧的一份被覆盖（需持有 _log_lock）"""
+        if self.log_backups <= 0:
+            os.remove(self.log_file)
+            return
+        for i in range(self.log_backups - 1, 0, -1):
+            older = f"{self.log_file}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.log_file}.{i + 1}")
+        os.replace(self.log_file, f"{self.log_file}.1")
+
+    def _write_loop(self) -> None:
+        while True:
+            time.sleep(TELEMETRY_FLUSH_INTERVAL_SECONDS)
+            self.flush()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """各阶段的滚动分位数：[{"stage", "count", "p50_ms", "p95_ms", "p99_ms", "last_ms"}]，按阶段名排序"""
+        with self._lock:
+            items = [(stage, list(samples), self._counts[stage]) for stage, samples in self._samples.items()]
+
+        rows = []
+        for stage, samples, count in sorted(items):
+            ordered = sorted(samples)
+            rows.append({
+                "stage": stage,
+                "count": count,
+                "p50_ms": _percentile(ordered, 0.50),
+                "p95_ms": _percentile(ordered, 0.95),
+                "p99_ms": _percentile(ordered, 0.99),
+                "last_ms": samples[-1],
+            })
+        return rows
+
+
+latency = LatencyStats(
+    TELEMETRY_WINDOW, TELEMETRY_LOG_FILE, TELEMETRY_LOG_MAX_MB * 1024 * 1024, TELEMETRY_LOG_BACKUPS
+)
+
+
+@contextmanager
+def span(stage: str, **attrs: Any):
+    """计时上下文：with span("build.split"): ...（异常时同样记录耗时）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        latency.record(stage, time.perf_counter() - start, **attrs)
+
+
+class LLMStartMarker(BaseCallbackHandler):
+    """
+    LangChain 回调：记录 chain 真正调用 LLM 的时刻
+
+    用于把 stuff-documents chain 的耗时拆分为"拼装 prompt"和"LLM 生成"两段。
+    """
+
+    def __init__(self):
+        self.started_at: Optional[float] = None
+
+    def _mark(self) -> None:
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs) -> None:
+        self._mark()
+
+    def on_llm_start(self, serialized, prompts, **kwargs) -> None:
+        self._mark()
+
+
+def stream_with_spans(
+    chain, inputs: dict, stage_prefix: str, on_token: Optional[Callable[[str], None]] = None
+) -> str:
+    """
+    流式执行 chain 并记录三段耗时
+
+    - <prefix>.prompt：chain 开始 → 调用 LLM（检索结果拼装成 prompt）
+    - <prefix>.first_token：调用 LLM → 第一个 token
+    - <prefix>.llm：调用 LLM → 最后一个 token
+
+    Args:
+        chain: 输出文本片段的 Runnable（如 stuff-documents chain）
+        inputs: chain 输入
+        stage_prefix: 阶段名前缀，如 "chat" / "housing"
+        on_token: 每收到一个片段时回调当前累计的回答
+
+    Returns:
+        完整回答文本
+    """
+    marker = LLMStartMarker()
+    parts: List[str] = []
+    first_token_at: Optional[float] = None
+
+    start = time.perf_counter()
+    for chunk in chain.stream(inputs, config={"callbacks": [marker]}):
+        if not isinstance(chunk, str) or not chunk:
+            continue
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        parts.append(chunk)
+        if on_token is not None:
+            on_token("".join(parts))
+    end = time.perf_counter()
+
+    llm_start = marker.started_at or start
+    latency.record(f"{stage_prefix}.prompt", llm_start - start)
+    if first_token_at is not None:
+        latency.record(f"{stage_prefix}.first_token", first_token_at - llm_start)
+    latency.record(f"{stage_prefix}.llm", end - llm_start)
+    return "".join(parts)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 项目模块位于仓库根目录（没有包结构），测试从根目录导入
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,52 @@
+from langchain_core.documents import Document
+
+from context_packer import pack_context
+
+ORIGINAL = "Graduate Hall 1 offers single rooms. Rent is 500 dollars. Apply through the housing portal in May."
+
+
+def _words(text):
+    return len(text.split())
+
+
+def _piece(start, end, source="hall.txt", **meta):
+    return Document(page_content=ORIGINAL[start:end], metadata={"source": source, "start_index": start, **meta})
+
+
+def test_overlapping_chunks_of_one_source_are_merged():
+    docs = [_piece(37, 98), _piece(0, 57), Document(page_content="Shuttle buses run hourly.", metadata={"source": "bus.txt"})]
+    packed, stats = pack_context(docs, token_budget=100, token_counter=_words)
+
+    assert [d.page_content for d in packed] == [ORIGINAL, "Shuttle buses run hourly."]
+    assert packed[0].metadata["merged_chunks"] == 2
+    assert stats["chunks_in"] == 3 and stats["chunks_out"] == 2
+    assert stats["tokens_out"] == _words(ORIGINAL) + 4
+
+
+def test_low_similarity_hits_are_dropped_except_the_top_one():
+    # 相似度未知（None）的片段不参与过滤
+    docs = [Document(page_content=f"text {i}", metadata={"source": f"s{i}"}) for i in range(3)]
+    packed, _ = pack_context(docs, similarities=[0.1, 0.9, None], min_similarity=0.3, token_counter=_words)
+    assert [d.page_content for d in packed] == ["text 0", "text 1", "text 2"]
+
+    packed, _ = pack_context(docs, similarities=[0.9, 0.1, 0.2], min_similarity=0.3, token_counter=_words)
+    assert [d.page_content for d in packed] == ["text 0"]
+
+
+def test_budget_skips_blocks_that_do_not_fit():
+    docs = [
+        Document(page_content="one two three", metadata={"source": "a"}),
+        Document(page_content="four five six seven", metadata={"source": "b"}),
+        Document(page_content="eight", metadata={"source": "c"}),
+    ]
+    packed, stats = pack_context(docs, token_budget=5, token_counter=_words)
+    assert [d.page_content for d in packed] == ["one two three", "eight"]
+    assert stats["tokens_out"] == 4
+
+
+def test_oversized_top_block_is_truncated():
+    text = " ".join(["word"] * 50)
+    packed, stats = pack_context([Document(page_content=text, metadata={"source": "a"})], token_budget=10)
+    assert len(packed) == 1
+    assert stats["tokens_out"] <= 10
+    assert text.startswith(packed[0].page_content)
@@ -0,0 +1,49 @@
+import csv
+import io
+
+from feedback_store import FIELDNAMES, FeedbackStore
+
+
+def _store(tmp_path):
+    return FeedbackStore(str(tmp_path / "feedback.db"))
+
+
+def test_export_csv_returns_bytes_with_all_rows(tmp_path):
+    store = _store(tmp_path)
+    store.add({
+        "timestamp": "2024-06-01 10:00:00", "label": "👍", "question": '宿舍, "Hall 11"?',
+        "answer": "line one\nline two", "used_rag": True, "sources": "a.txt",
+    })
+    store.add({"timestamp": "2024-06-01 10:05:00", "label": "👎", "question": "visa", "used_rag": False})
+
+    data = store.export_csv()
+
+    assert isinstance(data, bytes)
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+    assert rows[0] == FIELDNAMES
+    assert rows[1] == ["2024-06-01 10:00:00", "👍", '宿舍, "Hall 11"?', "line one\nline two", "True", "a.txt"]
+    assert rows[2] == ["2024-06-01 10:05:00", "👎", "visa", "", "False", ""]
+
+
+def test_export_csv_spans_multiple_read_batches(tmp_path):
+    store = _store(tmp_path)
+    for i in range(12):
+        store.add({"timestamp": f"t{i:02d}", "label": "👍", "question": f"q{i}"})
+
+    chunks = list(store.iter_csv(batch_size=5))
+    rows = list(csv.reader(io.StringIO(store.export_csv().decode("utf-8"))))
+
+    assert len(chunks) == 3
+    assert [row[2] for row in rows[1:]] == [f"q{i}" for i in range(12)]
+
+
+def test_export_csv_is_accepted_by_download_button(tmp_path):
+    from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+    store = _store(tmp_path)
+    store.add({"timestamp": "t", "label": "👍", "question": "q"})
+
+    data, _ = convert_data_to_bytes_and_infer_mime(
+        store.export_csv(), unsupported_error=TypeError("unsupported")
+    )
+    assert data.startswith(b"timestamp,label")
@@ -0,0 +1,41 @@
+import os
+
+from housing import HousingPlanStore
+
+PREFS = {"budget": "Moderate", "privacy": "Nice to have", "stay_term": "One semester"}
+
+
+def test_set_current_removes_stale_plans(tmp_path):
+    store = HousingPlanStore(str(tmp_path))
+    store.set_current("old")
+    store.put("old", PREFS, "old plan")
+    (tmp_path / "leftover.tmp").write_text("{")
+
+    store.set_current("new")
+    store.put("new", PREFS, "new plan")
+
+    assert sorted(os.listdir(tmp_path)) == ["new.json"]
+    assert store.get("old", PREFS) is None
+    assert store.get("new", PREFS) == "new plan"
+    assert store.count("old") == 0
+
+
+def test_non_current_fingerprint_is_not_stored(tmp_path):
+    store = HousingPlanStore(str(tmp_path))
+    store.put("custom", PREFS, "plan")
+    assert not os.listdir(tmp_path)
+
+    store.set_current("default")
+    store.put("custom", PREFS, "plan")
+    assert store.get("custom", PREFS) is None
+    assert not os.listdir(tmp_path)
+
+
+def test_plans_survive_a_new_store(tmp_path):
+    first = HousingPlanStore(str(tmp_path))
+    first.set_current("default")
+    first.put("default", PREFS, "plan")
+
+    second = HousingPlanStore(str(tmp_path))
+    second.set_current("default")
+    assert second.get("default", PREFS) == "plan"
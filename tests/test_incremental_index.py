@@ -0,0 +1,98 @@
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from incremental_index import chunk_sources, delete_sources, index_fingerprint, source_manifest, update_fingerprint
+from kb_builder import KnowledgeBaseBuilder
+
+SHARED = "Graduate Hall 1 single rooms cost 500 dollars per month including utilities and internet access."
+A_ONLY = "Applicants must submit the housing form through the portal before the stated deadline each year."
+S_ONLY = "The Student's Pass application requires a passport photo, the IPA letter and a medical report."
+
+
+def _doc(text, source):
+    return Document(page_content=text, metadata={"source": source})
+
+
+def _build(docs, base=None):
+    builder = KnowledgeBaseBuilder(DeterministicFakeEmbedding(size=16), base_vectorstore=base)
+    builder.add_documents(docs)
+    return builder.finish()
+
+
+def _contents(vectorstore):
+    docs = (vectorstore.docstore.search(i) for i in vectorstore.index_to_docstore_id.values())
+    return sorted((d.page_content, tuple(chunk_sources(d))) for d in docs)
+
+
+@pytest.fixture
+def base():
+    # SHARED 同时出现在 A 和 S 中，合并为一个主来源为 A 的片段
+    result = _build([_doc(SHARED, "A"), _doc(A_ONLY, "A"), _doc(SHARED, "S"), _doc(S_ONLY, "S")])
+    return result["vectorstore"]
+
+
+def test_manifest_lists_every_source(base):
+    manifest = source_manifest(base)
+    assert len(manifest["A"]) == 2
+    assert len(manifest["S"]) == 2
+    assert set(manifest["A"]) & set(manifest["S"])
+
+
+def test_reupload_of_secondary_source_adds_nothing(base):
+    before = _contents(base)
+    result = _build([_doc(SHARED, "S"), _doc(S_ONLY, "S")], base)
+    assert result["changes"]["added"] == 0
+    assert result["changes"]["removed"] == 0
+    assert result["changes"]["unchanged"] == 2
+    assert _contents(result["vectorstore"]) == before
+    # 共享的原向量库保持不变
+    assert _contents(base) == before
+
+
+def test_content_dropped_from_secondary_source_is_released(base):
+    result = _build([_doc(S_ONLY, "S")], base)
+    assert result["changes"]["removed"] == 0
+    assert (SHARED, ("A",)) in _contents(result["vectorstore"])
+
+
+def test_edited_chunk_replaces_the_old_version(base):
+    edited = S_ONLY.replace("medical", "health")
+    result = _build([_doc(SHARED, "S"), _doc(edited, "S")], base)
+    assert result["changes"]["added"] == 1
+    assert result["changes"]["removed"] == 1
+    texts = [text for text, _ in _contents(result["vectorstore"])]
+    assert edited in texts and S_ONLY not in texts
+
+
+def test_rollback_restores_sources_of_existing_chunks(base):
+    builder = KnowledgeBaseBuilder(DeterministicFakeEmbedding(size=16), base_vectorstore=base)
+    builder.add_documents([_doc(A_ONLY, "T"), _doc("Shuttle buses run every fifteen minutes on weekdays.", "T")])
+    builder._rollback("T")
+    result = builder.finish()
+    assert result["changes"]["added"] == 0
+    assert _contents(result["vectorstore"]) == _contents(base)
+
+
+def test_delete_shared_source_keeps_other_owner(base):
+    vectorstore = _build([], base)["vectorstore"]
+    assert delete_sources(vectorstore, ["S"]) == 1
+    assert _contents(vectorstore) == [(A_ONLY, ("A",)), (SHARED, ("A",))]
+
+
+def test_update_fingerprint_matches_full_recompute(base):
+    ids = list(base.index_to_docstore_id.values())
+    empty = f"{0:016x}"
+    assert update_fingerprint(empty, ids, []) == index_fingerprint(base)
+    # 与顺序无关；增加再删除同一 ID 回到原指纹
+    assert update_fingerprint(empty, reversed(ids), []) == index_fingerprint(base)
+    assert update_fingerprint(index_fingerprint(base), ["x"], ["x"]) == index_fingerprint(base)
+    assert update_fingerprint(index_fingerprint(base), [], ids) == empty
+
+
+def test_fingerprint_after_incremental_update(base):
+    result = _build([_doc(S_ONLY.replace("medical", "health"), "S"), _doc(SHARED, "S")], base)
+    changes = result["changes"]
+    assert update_fingerprint(
+        index_fingerprint(base), changes["added_ids"], changes["removed_ids"]
+    ) == index_fingerprint(result["vectorstore"])
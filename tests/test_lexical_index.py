@@ -0,0 +1,37 @@
+from lexical_index import BM25Index, tokenize
+
+
+def test_tokenize_mixed_text():
+    tokens = tokenize("How do I get to Hall 11 from 南洋理工大学?")
+    assert "how" not in tokens and "to" not in tokens
+    assert "hall" in tokens and "11" in tokens
+    assert "hall#11" in tokens
+    assert ["南洋", "洋理", "理工", "工大", "大学"] == [t for t in tokens if not t.isascii()]
+
+
+def test_tokenize_single_cjk_character_and_joined_number():
+    assert tokenize("GH1 宿") == ["gh1", "gh#1", "宿"]
+
+
+def test_bm25_ranks_exact_term_matches_first():
+    index = BM25Index(
+        ["a", "b", "c"],
+        ["Hall 11 shuttle bus timetable", "Hall 2 laundry room", "Student's Pass 学生证 application"],
+    )
+    results = index.search("Hall 11 shuttle", k=2)
+    assert results[0][0] == "a"
+    assert results[0][2] == 1.0
+    assert index.search("学生证", k=3)[0][0] == "c"
+    assert index.search("unknownword", k=3) == []
+
+
+def test_bm25_updated_matches_a_fresh_index():
+    texts = {"a": "Hall 11 shuttle bus", "b": "laundry room", "c": "visa 签证 medical report"}
+    base = BM25Index(["a", "b"], [texts["a"], texts["b"]])
+    updated = base.updated(["c"], [texts["c"]], ["a"], [texts["a"]])
+    fresh = BM25Index(["b", "c"], [texts["b"], texts["c"]])
+
+    for query in ("签证 report", "laundry", "shuttle"):
+        assert updated.search(query, 3) == fresh.search(query, 3)
+    # 原索引保持不变
+    assert base.search("shuttle", 3)[0][0] == "a"
@@ -0,0 +1,35 @@
+from langchain_core.documents import Document
+
+from near_dedup import deduplicate_chunks
+
+PRICE = "Graduate Hall 1 single rooms cost 500 dollars per month including utilities and internet access."
+VISA = "The Student's Pass application requires a passport photo, the IPA letter and a medical report."
+
+
+def test_near_duplicates_merge_into_longest_chunk():
+    docs = [
+        Document(page_content=PRICE, metadata={"source": "housing.txt"}),
+        Document(page_content=VISA, metadata={"source": "visa.txt"}),
+        Document(page_content=PRICE + " OK", metadata={"source": "campus.txt"}),
+        Document(page_content=PRICE.upper(), metadata={"source": "faq.txt"}),
+    ]
+    kept, stats = deduplicate_chunks(docs)
+
+    assert [d.page_content for d in kept] == [PRICE + " OK", VISA]
+    assert kept[0].metadata["sources"] == ["housing.txt", "campus.txt", "faq.txt"]
+    assert kept[0].metadata["duplicates"] == 3
+    assert "sources" not in kept[1].metadata
+    assert stats == {"before": 4, "after": 2, "reduction": 0.5}
+
+
+def test_distinct_chunks_are_kept_in_order():
+    docs = [Document(page_content=text, metadata={"source": "a"}) for text in (VISA, PRICE)]
+    kept, stats = deduplicate_chunks(docs)
+    assert kept == docs
+    assert stats["reduction"] == 0.0
+
+
+def test_single_chunk_is_returned_unchanged():
+    kept, stats = deduplicate_chunks([Document(page_content=PRICE)])
+    assert len(kept) == 1
+    assert stats == {"before": 1, "after": 1, "reduction": 0.0}
@@ -0,0 +1,31 @@
+from rag_chain import _score_pairs
+
+
+class _StubRanker:
+    """按 passage 长度打分并按分数排序返回，与 Ranker.rerank 的输出格式相同"""
+
+    def __init__(self, with_scores=True):
+        self.with_scores = with_scores
+        self.calls = []
+
+    def rerank(self, request):
+        self.calls.append((request.query, [p["text"] for p in request.passages]))
+        passages = [dict(p, score=len(request.query) + len(p["text"])) for p in request.passages]
+        passages.sort(key=lambda p: p["score"], reverse=True)
+        if not self.with_scores:
+            for p in passages:
+                del p["score"]
+        return passages
+
+
+def test_scores_follow_input_order_with_one_call_per_query():
+    ranker = _StubRanker()
+    pairs = [("q", "aa"), ("query", "b"), ("q", "cccc"), ("query", "dd")]
+    assert _score_pairs(ranker, pairs) == [3.0, 6.0, 5.0, 7.0]
+    assert ranker.calls == [("q", ["aa", "cccc"]), ("query", ["b", "dd"])]
+
+
+def test_rank_based_scores_without_model_scores():
+    ranker = _StubRanker(with_scores=False)
+    scores = _score_pairs(ranker, [("q", "a"), ("q", "ccc"), ("q", "bb")])
+    assert scores[1] > scores[2] > scores[0] > 0
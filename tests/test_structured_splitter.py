@@ -0,0 +1,61 @@
+from langchain_core.documents import Document
+
+from structured_splitter import split_structured
+
+TEXT = """NTU housing guide
+
+# Housing
+Overview of graduate housing.
+
+## Graduate Hall 1
+Single rooms cost 500 dollars per month.
+
+## Graduate Hall 2
+Twin rooms cost 300 dollars per month.
+
+# Visa
+Apply for the Student's Pass online.
+"""
+
+
+def test_sections_become_chunks_with_heading_paths():
+    doc = Document(page_content=TEXT, metadata={"source": "guide.md"})
+    chunks = split_structured(doc, chunk_size=60, chunk_overlap=0)
+
+    assert [c.metadata["heading_path"] for c in chunks] == [
+        "",
+        "Housing",
+        "Housing > Graduate Hall 1",
+        "Housing > Graduate Hall 2",
+        "Visa",
+    ]
+    for chunk in chunks:
+        assert chunk.metadata["source"] == "guide.md"
+        start = chunk.metadata["start_index"]
+        assert TEXT[start:start + len(chunk.page_content)] == chunk.page_content
+
+
+def test_section_intro_merges_with_a_small_subsection():
+    chunks = split_structured(Document(page_content=TEXT), chunk_size=120, chunk_overlap=0)
+    housing = [c for c in chunks if c.metadata["heading_path"] == "Housing"]
+    assert len(housing) == 1
+    assert "Overview" in housing[0].page_content and "Graduate Hall 1" in housing[0].page_content
+
+
+def test_document_that_fits_is_one_chunk():
+    chunks = split_structured(Document(page_content=TEXT), chunk_size=1000, chunk_overlap=0)
+    assert [c.page_content for c in chunks] == [TEXT.strip()]
+
+
+def test_long_section_without_subheadings_falls_back_to_character_split():
+    body = " ".join(f"Sentence number {i} about hostel fees." for i in range(40))
+    text = f"# A\nshort\n# B\n{body}\n# C\nshort\n"
+    chunks = split_structured(Document(page_content=text), chunk_size=200, chunk_overlap=0)
+    b_chunks = [c for c in chunks if c.metadata["heading_path"] == "B"]
+    assert len(b_chunks) > 1
+    assert all(len(c.page_content) <= 200 for c in b_chunks)
+
+
+def test_unstructured_text_returns_none():
+    doc = Document(page_content="Plain page text without any headings.\nSecond line.")
+    assert split_structured(doc, chunk_size=100, chunk_overlap=0) is None
@@ -0,0 +1,28 @@
+import faiss
+import numpy as np
+
+from vector_index import _probe_queries, build_index, tune_and_report
+
+
+def _corpus(n=2000, d=32):
+    vectors = np.random.default_rng(1).normal(size=(n, d)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_probe_queries_do_not_match_corpus_vectors():
+    vectors = _corpus()
+    queries = _probe_queries(vectors, 50, np.random.default_rng(0))
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    distances, _ = exact.search(queries, 1)
+    assert queries.shape == (50, vectors.shape[1])
+    assert distances.min() > 1e-3
+
+
+def test_tune_and_report_measures_ann_recall():
+    vectors = _corpus()
+    index, _ = build_index(vectors, faiss.METRIC_INNER_PRODUCT, "hnsw")
+    report = tune_and_report(index, vectors, faiss.METRIC_INNER_PRODUCT, k=5)
+    assert report["curve"]
+    assert 0.0 <= report["recall"] <= 1.0
+    assert report["eval_queries"] > 0
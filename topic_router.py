@@ -0,0 +1,332 @@
+"""
+Topic routing - per-topic sub-indexes (housing / visa / academics / transport / campus life)
+
+每个片段按所在章节（heading_path）、来源文件名或正文关键词归入一个主题（metadata["topic"]），
+每个主题一个分片：分片不复制向量，而是在原索引上按片段位置过滤检索（FAISS IDSelector），
+并配有自己的 BM25 索引。查询时先用关键词路由，
+没有关键词命中时用查询向量与各分片质心的余弦相似度路由；路由不确定、分片太小
+或分片内最佳命中相关度过低时，退回全局检索。
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import weakref
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import (
+    TOPICS,
+    TOPIC_ROUTER_MAX_SHARDS,
+    TOPIC_CENTROID_MARGIN,
+)
+from lexical_index import BM25Index
+from vector_index import id_selector, id_selector_bytes, iter_vectors, positions_of
+
+GENERAL_TOPIC = "general"  # 无法归类的片段：不进入任何分片，只能通过全局检索找到
+
+# 主题关键词：英文按整词匹配，中文按子串匹配
+TOPIC_KEYWORDS: Dict[str, List[str]] = {
+    "housing": [
+        "housing", "hall", "halls", "accommodation", "dorm", "dormitory", "hostel", "room", "rooms",
+        "rent", "roommate", "north hill", "crescent", "move-in", "check-in",
+        "宿舍", "住宿", "住房", "租房", "房间", "单人间", "双人间", "入住", "退宿", "押金", "房租", "室友",
+    ],
+    "visa": [
+        "visa", "student's pass", "student pass", "stp", "solar", "ica", "ipa", "medical check",
+        "form 16", "v36", "immigration", "passport",
+        "签证", "学生准证", "准证", "体检", "移民局", "入境", "护照",
+    ],
+    "academics": [
+        "course", "courses", "module", "modules", "exam", "exams", "grade", "grades", "grading", "gpa",
+        "library", "libraries", "thesis", "supervisor", "scholarship", "graduation", "lecture",
+        "credit", "credits", "research",
+        "选课", "课程", "考试", "成绩", "评分", "图书馆", "论文", "导师", "奖学金", "毕业", "学分", "学术",
+    ],
+    "transport": [
+        "bus", "buses", "shuttle", "mrt", "taxi", "grab", "campus loop", "commute", "airport",
+        "bike", "bicycle", "ez-link", "transport", "transportation", "route", "routes",
+        "交通", "巴士", "校车", "地铁", "打车", "出租车", "机场", "自行车", "路线", "出行", "怎么去",
+    ],
+    "campus_life": [
+        "canteen", "canteens", "food", "halal", "vegetarian", "supermarket", "shopping", "sim",
+        "bank", "wifi", "wi-fi", "emergency", "clinic", "gym", "sports", "app", "apps", "campus map",
+        "食堂", "饮食", "餐", "超市", "购物", "手机卡", "银行", "医疗", "诊所", "体育", "紧急", "校园", "生活",
+    ],
+}
+
+# 来源文件名中的提示词（章节标题无法判断时使用）
+SOURCE_HINTS: Dict[str, List[str]] = {
+    "housing": ["housing", "hall", "hostel", "accommodation"],
+    "visa": ["visa", "stp", "pass"],
+    "academics": ["academic", "course", "library"],
+    "transport": ["shuttle", "bus", "transport"],
+    "campus_life": ["campus"],
+}
+
+
+def topic_config_digest() -> str:
+    """主题配置（主题列表、关键词表、文件名提示词）的哈希；片段的 topic 标签随之变化，计入索引缓存键"""
+    payload = {"topics": TOPICS, "keywords": TOPIC_KEYWORDS, "source_hints": SOURCE_HINTS}
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+def _compile(keywords: List[str]) -> re.Pattern:
+    parts = []
+    for keyword in keywords:
+        escaped = re.escape(keyword)
+        parts.append(rf"(?<![a-z0-9]){escaped}(?![a-z0-9])" if keyword.isascii() else escaped)
+    return re.compile("|".join(parts))
+
+
+_PATTERNS: Dict[str, re.Pattern] = {
+    topic: _compile(TOPIC_KEYWORDS[topic]) for topic in TOPICS if topic in TOPIC_KEYWORDS
+}
+
+
+def keyword_scores(text: str) -> Dict[str, int]:
+    """各主题关键词在文本中的命中次数（只含命中的主题）"""
+    text = text.lower()
+    scores = {}
+    for topic, pattern in _PATTERNS.items():
+        hits = len(pattern.findall(text))
+        if hits:
+            scores[topic] = hits
+    return scores
+
+
+def _unique_best(scores: Dict[str, int]) -> Optional[str]:
+    if not scores:
+        return None
+    ranked = sorted(scores.values(), reverse=True)
+    if len(ranked) > 1 and ranked[0] == ranked[1]:
+        return None
+    return max(scores, key=scores.get)
+
+
+def chunk_topic(doc) -> str:
+    """
+    片段所属主题：从最上层章节标题往下找第一个能唯一判定的标题，其次看来源文件名，
+    最后看正文关键词；都无法判定时为 GENERAL_TOPIC
+    """
+    meta = getattr(doc, "metadata", {}) or {}
+    for heading in (meta.get("heading_path") or "").split(" > "):
+        topic = _unique_best(keyword_scores(heading))
+        if topic is not None:
+            return topic
+
+    name = os.path.basename(str(meta.get("source") or "")).lower()
+    for topic in TOPICS:
+        if any(hint in name for hint in SOURCE_HINTS.get(topic, [])):
+            return topic
+
+    scores = keyword_scores(doc.page_content)
+    return max(scores, key=scores.get) if scores else GENERAL_TOPIC
+
+
+def tag_topics(docs: list) -> Dict[str, int]:
+    """为片段写入 metadata["topic"]；返回各主题的片段数"""
+    counts: Dict[str, int] = {}
+    for doc in docs:
+        topic = chunk_topic(doc)
+        doc.metadata["topic"] = topic
+        counts[topic] = counts.get(topic, 0) + 1
+    return counts
+
+
+class TopicShard:
+    """一个主题分片：原向量库上按片段位置过滤的只读视图（不复制向量），配有自己的 BM25 索引"""
+
+    def __init__(self, vectorstore, doc_ids: List[str], lexical_index: Optional[BM25Index] = None):
+        self.doc_ids = doc_ids
+        self.positions = positions_of(vectorstore, doc_ids)
+        self.selector = id_selector(self.positions)
+        if lexical_index is None:
+            texts = [vectorstore.docstore.search(doc_id).page_content for doc_id in doc_ids]
+            lexical_index = BM25Index(doc_ids, texts)
+        self.lexical_index = lexical_index
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def memory_bytes(self) -> int:
+        """位置数组 + 过滤器 + BM25 索引的内存估算"""
+        return self.positions.nbytes + id_selector_bytes(len(self.positions)) + self.lexical_index.memory_bytes()
+
+    def updated(self, vectorstore, added: list, removed: list) -> "TopicShard":
+        """
+        增删片段后在新向量库上的分片（本分片保持不变）：BM25 索引只处理增删的片段
+
+        Args:
+            vectorstore: 更新后的向量库（删除会使片段位置变化，按 ID 重新定位）
+            added / removed: 该主题新增 / 删除的 Document（metadata 含 chunk_id）
+        """
+        removed_ids = [doc.metadata["chunk_id"] for doc in removed]
+        added_ids = [doc.metadata["chunk_id"] for doc in added]
+        removed_set = set(removed_ids)
+        doc_ids = [doc_id for doc_id in self.doc_ids if doc_id not in removed_set] + added_ids
+        lexical_index = self.lexical_index.updated(
+            added_ids, [doc.page_content for doc in added],
+            removed_ids, [doc.page_content for doc in removed],
+        )
+        return TopicShard(vectorstore, doc_ids, lexical_index)
+
+
+def _vector_sum(vectorstore, positions: np.ndarray) -> np.ndarray:
+    """指定位置的向量（先归一化）之和，按批读取向量"""
+    total = np.zeros(int(vectorstore.index.d), dtype=np.float64)
+    for batch in iter_vectors(vectorstore, positions):
+        total += (batch / np.maximum(np.linalg.norm(batch, axis=1, keepdims=True), 1e-12)).sum(axis=0)
+    return total
+
+
+def _centroid(total: np.ndarray) -> np.ndarray:
+    """分片质心：归一化向量之和的方向（即平均方向）"""
+    centroid = total.astype(np.float32)
+    return centroid / (float(np.linalg.norm(centroid)) or 1.0)
+
+
+def _doc_topic(doc) -> str:
+    return (doc.metadata or {}).get("topic") or chunk_topic(doc)
+
+
+class TopicShards:
+    """一个向量库的全部主题分片及其质心（只读，可跨会话共享）"""
+
+    def __init__(self, vectorstore):
+        doc_ids: Dict[str, List[str]] = {}
+        for doc_id in vectorstore.index_to_docstore_id.values():
+            doc_ids.setdefault(_doc_topic(vectorstore.docstore.search(doc_id)), []).append(doc_id)
+
+        self.shards: Dict[str, TopicShard] = {}
+        self.centroids: Dict[str, np.ndarray] = {}
+        # 质心对应的向量和：增删片段时只加减变化的向量
+        self._sums: Dict[str, np.ndarray] = {}
+        for topic in TOPICS:
+            ids = doc_ids.get(topic)
+            if not ids:
+                continue
+            shard = TopicShard(vectorstore, ids)
+            self._set(topic, shard, _vector_sum(vectorstore, shard.positions))
+        self.sizes = {topic: len(ids) for topic, ids in doc_ids.items()}
+
+    def _set(self, topic: str, shard: TopicShard, total: np.ndarray) -> None:
+        self.shards[topic] = shard
+        self._sums[topic] = total
+        self.centroids[topic] = _centroid(total)
+
+    def updated(self, base_vectorstore, vectorstore, added_ids: List[str], removed_ids: List[str]) -> "TopicShards":
+        """
+        增量更新后新向量库的分片（本对象保持不变）：只读取、分词增删的片段
+
+        Args:
+            base_vectorstore: 本对象所属的原向量库（取删除片段的文本和向量）
+            vectorstore: 更新后的向量库
+            added_ids / removed_ids: 新增 / 删除的 chunk ID
+        """
+        added: Dict[str, list] = {}
+        removed: Dict[str, list] = {}
+        for doc_id in added_ids:
+            doc = vectorstore.docstore.search(doc_id)
+            added.setdefault(_doc_topic(doc), []).append(doc)
+        for doc_id in removed_ids:
+            doc = base_vectorstore.docstore.search(doc_id)
+            removed.setdefault(_doc_topic(doc), []).append(doc)
+
+        new = object.__new__(TopicShards)
+        new.shards, new.centroids, new._sums = {}, {}, {}
+        new.sizes = {}
+        for topic in set(self.sizes) | set(added):
+            size = self.sizes.get(topic, 0) + len(added.get(topic, [])) - len(removed.get(topic, []))
+            if size > 0:
+                new.sizes[topic] = size
+
+        for topic in TOPICS:
+            topic_added, topic_removed = added.get(topic, []), removed.get(topic, [])
+            shard = self.shards.get(topic)
+            if shard is None:
+                if topic_added:
+                    shard = TopicShard(vectorstore, [doc.metadata["chunk_id"] for doc in topic_added])
+                    new._set(topic, shard, _vector_sum(vectorstore, shard.positions))
+                continue
+            if not removed_ids and not topic_added:
+                # 没有删除时其他片段的位置不变，未变化的分片直接共用
+                new._set(topic, shard, self._sums[topic])
+                continue
+            total = self._sums[topic].copy()
+            if topic_removed:
+                total -= _vector_sum(base_vectorstore, positions_of(
+                    base_vectorstore, [doc.metadata["chunk_id"] for doc in topic_removed]
+                ))
+            if topic_added:
+                total += _vector_sum(vectorstore, positions_of(
+                    vectorstore, [doc.metadata["chunk_id"] for doc in topic_added]
+                ))
+            shard = shard.updated(vectorstore, topic_added, topic_removed)
+            if len(shard):
+                new._set(topic, shard, total)
+        return new
+
+    def memory_bytes(self) -> int:
+        """全部分片及质心的内存估算"""
+        return sum(shard.memory_bytes() for shard in self.shards.values()) + \
+            sum(int(c.nbytes) for c in self.centroids.values())
+
+    def route(self, query: str, query_vector: Optional[list] = None) -> List[str]:
+        """
+        选择要检索的分片
+
+        关键词路由：取命中次数不低于最高分一半的主题；超过 TOPIC_ROUTER_MAX_SHARDS 个视为不确定。
+        没有关键词命中时，若最接近的质心比第二名高出 TOPIC_CENTROID_MARGIN 则选它。
+
+        Returns:
+            主题列表；空列表表示使用全局检索
+        """
+        scores = {t: s for t, s in keyword_scores(query).items() if t in self.shards}
+        if scores:
+            top = max(scores.values())
+            chosen = sorted((t for t, s in scores.items() if s * 2 >= top), key=scores.get, reverse=True)
+            return chosen if len(chosen) <= TOPIC_ROUTER_MAX_SHARDS else []
+
+        if query_vector is None or not self.centroids:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (float(np.linalg.norm(query)) or 1.0)
+        ranked = sorted(((float(c @ query), t) for t, c in self.centroids.items()), reverse=True)
+        if len(ranked) == 1 or ranked[0][0] - ranked[1][0] >= TOPIC_CENTROID_MARGIN:
+            return [ranked[0][1]]
+        return []
+
+
+# 每个向量库对象对应一组分片；向量库被回收后自动释放
+_topic_shards: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_topic_lock = threading.Lock()
+
+
+def derive_topic_shards(base_vectorstore, vectorstore, added_ids: List[str], removed_ids: List[str]) -> None:
+    """
+    增量更新后，由原向量库已建好的分片推导出新向量库的分片（只处理增删的片段）
+
+    原向量库还没有分片时不做任何事，新向量库的分片之后按需全量构建。
+    """
+    with _topic_lock:
+        base = _topic_shards.get(base_vectorstore)
+        if base is not None and vectorstore not in _topic_shards:
+            _topic_shards[vectorstore] = base.updated(base_vectorstore, vectorstore, added_ids, removed_ids)
+
+
+def get_topic_shards(vectorstore) -> TopicShards:
+    """
+    获取（必要时构建）向量库的主题分片
+
+    构建知识库时调用一次即可预先建好；与关键词索引一样随向量库共享。
+    """
+    with _topic_lock:
+        shards = _topic_shards.get(vectorstore)
+        if shards is None:
+            shards = TopicShards(vectorstore)
+            _topic_shards[vectorstore] = shards
+        return shards
@@ -2,16 +2,16 @@
 工具函数 - 通用辅助功能
 """
 import os
-import csv
 import datetime
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 from typing import Dict, Any, Optional
-from config import FEEDBACK_LOG_FILE
+from feedback_store import get_feedback_store
 
 
 def log_feedback(label: str, interaction: Optional[Dict[str, Any]]) -> bool:
     """
-    记录用户反馈到 CSV 文件
+    记录用户反馈（批量写入 SQLite 反馈库）
 
     Args:
         label: "up" 或 "down"
@@ -33,14 +33,7 @@ def log_feedback(label: str, interaction: Optional[Dict[str, Any]]) -> bool:
             "sources": "|".join(interaction.get("sources") or []),
         }
 
-        file_exists = os.path.exists(FEEDBACK_LOG_FILE)
-        fieldnames = list(row.keys())
-
-        with open(FEEDBACK_LOG_FILE, "a", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+        get_feedback_store().add(row)
         return True
     except Exception as e:
         st.warning(f"⚠️ 反馈记录失败: {e}")
@@ -49,34 +42,20 @@ def log_feedback(label: str, interaction: Optional[Dict[str, Any]]) -> bool:
 
 def get_feedback_stats() -> Dict[str, Any]:
     """
-    获取反馈统计数据
+    获取反馈统计数据（读取计数表和最近 5 条，耗时与反馈总数无关）
 
     Returns:
         包含统计信息的字典
     """
-    if not os.path.exists(FEEDBACK_LOG_FILE):
-        return {
-            "total": 0,
-            "ups": 0,
-            "downs": 0,
-            "recent": []
-        }
-
     try:
-        rows = []
-        with open(FEEDBACK_LOG_FILE, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-
-        total = len(rows)
-        ups = sum(1 for r in rows if r.get("label") == "up")
-        downs = sum(1 for r in rows if r.get("label") == "down")
+        store = get_feedback_store()
+        counts = store.counts()
 
         return {
-            "total": total,
-            "ups": ups,
-            "downs": downs,
-            "recent": rows[-5:]  # 最近 5 条
+            "total": sum(counts.values()),
+            "ups": counts.get("up", 0),
+            "downs": counts.get("down", 0),
+            "recent": store.recent(5)  # 最近 5 条
         }
     except Exception as e:
         st.warning(f"⚠️ 读取反馈数据失败: {e}")
@@ -143,3 +122,17 @@ def get_unique_button_key(prefix: str) -> str:
     """
     import time
     return f"{prefix}_{int(time.time() * 1000000)}"
+
+
+def rerun_region() -> None:
+    """
+    重跑当前 fragment（聊天区 / 住房向导），不重跑整个 app.py
+
+    Streamlit 只允许在 fragment 自身触发的重跑中使用 scope="fragment"；
+    在整页运行中（如首次加载时处理遗留的待答问题）退回整页重跑。
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
@@ -0,0 +1,534 @@
+"""
+Vector index selection - flat / HNSW / IVF FAISS indexes chosen by corpus size
+
+FAISS.from_documents 总是构建精确的 IndexFlat，检索耗时随片段数线性增长。
+这里在构建完成后按配置（或按语料规模自动）换成近似最近邻索引，
+并用精确索引做对照，自动调节检索参数（HNSW efSearch / IVF nprobe），
+生成"召回率 - 延迟"报告。
+
+可选标量量化（VECTOR_QUANTIZATION = "fp16" / "int8"）：索引中只保存压缩后的向量，
+全精度向量写入磁盘并以内存映射方式打开；检索时先在压缩索引中取候选，
+再用全精度向量对少量候选重新打分。
+"""
+import math
+import os
+import threading
+import time
+import uuid
+import weakref
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    VECTOR_INDEX_TYPE,
+    VECTOR_QUANTIZATION,
+    VECTOR_STORE_DIR,
+    RESCORE_CANDIDATES_FACTOR,
+    ANN_AUTO_FLAT_MAX,
+    ANN_AUTO_HNSW_MAX,
+    ANN_TARGET_RECALL,
+    ANN_EVAL_QUERIES,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    DEFAULT_RETRIEVAL_K,
+)
+
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+QUANTIZATIONS = ("none", "fp16", "int8")
+
+# 量化索引对应的全精度向量（内存映射），向量库被回收后自动释放
+_full_precision: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_full_precision_lock = threading.Lock()
+
+# docstore id → 索引位置，按向量库缓存（供按片段取向量）
+_positions: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_positions_lock = threading.Lock()
+
+
+def _quantizer_type(quantization: str):
+    import faiss
+
+    return {
+        "fp16": faiss.ScalarQuantizer.QT_fp16,
+        "int8": faiss.ScalarQuantizer.QT_8bit,
+    }[quantization]
+
+
+def choose_index_type(n_vectors: int, index_type: str = VECTOR_INDEX_TYPE) -> str:
+    """
+    确定索引类型："auto" 时小语料用精确检索，中等规模用 HNSW，超大规模用 IVF
+    """
+    if index_type in INDEX_TYPES:
+        return index_type
+    if n_vectors <= ANN_AUTO_FLAT_MAX:
+        return "flat"
+    if n_vectors <= ANN_AUTO_HNSW_MAX:
+        return "hnsw"
+    return "ivf"
+
+
+def _ivf_nlist(n_vectors: int) -> int:
+    """IVF 聚类数：约 4·√N，且保证每个聚类至少有 39 个训练样本"""
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def build_index(vectors: np.ndarray, metric_type: int, index_type: str, quantization: str = "none"):
+    """
+    用给定向量构建指定类型的索引（向量按顺序添加，位置与原索引一致）
+
+    Args:
+        vectors: 全精度向量
+        metric_type: FAISS 距离类型
+        index_type: "flat" / "hnsw" / "ivf"
+        quantization: "none" / "fp16" / "int8"（标量量化，索引中只保存压缩向量）
+
+    Returns:
+        (faiss index, 构建参数 dict)
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    quantized = quantization != "none"
+    qtype = _quantizer_type(quantization) if quantized else None
+
+    if index_type == "hnsw":
+        if quantized:
+            index = faiss.IndexHNSWSQ(d, qtype, HNSW_M, metric_type)
+        else:
+            index = faiss.IndexHNSWFlat(d, HNSW_M, metric_type)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        params = {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION}
+    elif index_type == "ivf":
+        nlist = _ivf_nlist(n)
+        coarse = faiss.IndexFlat(d, metric_type)
+        if quantized:
+            index = faiss.IndexIVFScalarQuantizer(coarse, d, nlist, qtype, metric_type)
+        else:
+            index = faiss.IndexIVFFlat(coarse, d, nlist, metric_type)
+        params = {"nlist": nlist}
+    elif quantized:
+        index = faiss.IndexScalarQuantizer(d, qtype, metric_type)
+        params = {}
+    else:
+        index = faiss.IndexFlat(d, metric_type)
+        params = {}
+
+    if quantized:
+        params["quantization"] = quantization
+    if n:
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+    if index_type == "ivf":
+        # 哈希表形式的 direct map 同时支持 reconstruct 和 remove_ids（增量更新需要）；
+        # 必须在添加向量之后设置，之前设置时映射为空，reconstruct 会找不到向量
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index, params
+
+
+def _search_param(index) -> Optional[Tuple[str, List[int]]]:
+    """可调的检索参数名及候选值（从快到准）"""
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        return "efSearch", [16, 32, 64, 128, 256, 512]
+    if isinstance(index, faiss.IndexIVF):
+        return "nprobe", [p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p <= index.nlist] or [1]
+    return None
+
+
+def _set_search_param(index, name: str, value: int) -> None:
+    if name == "efSearch":
+        index.hnsw.efSearch = value
+    else:
+        index.nprobe = value
+
+
+def _timed_search(search: Callable, queries: np.ndarray, k: int) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    ids = search(queries, k)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+    return ids, elapsed_ms
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t[t >= 0])) for f, t in zip(found, truth))
+    total = sum(int((t >= 0).sum()) for t in truth)
+    return hits / total if total else 1.0
+
+
+def _index_search(index) -> Callable:
+    return lambda queries, k: index.search(queries, k)[1]
+
+
+def _rescored_search(index, full_vectors: np.ndarray, metric_type: int) -> Callable:
+    def search(queries, k):
+        return np.vstack([
+            rescore(index, full_vectors, metric_type, q, k)[1][None, :] for q in queries
+        ])
+    return search
+
+
+def _probe_queries(vectors: np.ndarray, count: int, rng) -> np.ndarray:
+    """
+    召回率评估查询：两个随机语料向量的中点，再加上高斯噪声
+
+    直接用语料向量做查询时，每个查询的第一个结果就是它自己，召回率偏高；
+    扰动后的查询不与任何片段重合，更接近真实提问的分布。
+    """
+    n, d = vectors.shape
+    a = vectors[rng.integers(n, size=count)]
+    b = vectors[rng.integers(n, size=count)]
+    # 每维噪声的标准差按向量长度缩放，噪声总长度约为向量长度的一半
+    scale = np.linalg.norm(a, axis=1, keepdims=True) / math.sqrt(d)
+    queries = (a + b) / 2 + rng.normal(size=(count, d)) * scale * 0.5
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def tune_and_report(
+    index, vectors: np.ndarray, metric_type: int, k: int = DEFAULT_RETRIEVAL_K, rescore_vectors: bool = False
+) -> Dict[str, Any]:
+    """
+    以精确索引为基准评估召回率和单次查询延迟，并把检索参数调到满足 ANN_TARGET_RECALL 的最小值
+
+    评估查询由语料向量扰动生成（见 _probe_queries）。rescore_vectors 为 True 时，评估的是"压缩索引取候选 +
+    全精度重打分"的完整检索流程，并额外报告不重打分时的召回率。
+    """
+    import faiss
+
+    n = len(vectors)
+    k = max(1, min(k, n))
+    rng = np.random.default_rng(0)
+    queries = _probe_queries(np.asarray(vectors, dtype=np.float32), ANN_EVAL_QUERIES, rng)
+
+    exact = faiss.IndexFlat(vectors.shape[1], metric_type)
+    exact.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    truth, exact_ms = _timed_search(_index_search(exact), queries, k)
+
+    search = _rescored_search(index, vectors, metric_type) if rescore_vectors else _index_search(index)
+    report: Dict[str, Any] = {"k": k, "eval_queries": len(queries), "exact_ms": exact_ms, "curve": []}
+    tunable = _search_param(index)
+    if tunable is None:
+        found, ann_ms = _timed_search(search, queries, k)
+        report.update({"recall": _recall(found, truth), "ann_ms": ann_ms})
+        if rescore_vectors:
+            report["recall_no_rescore"] = _recall(_index_search(index)(queries, k), truth)
+        return report
+
+    name, candidates = tunable
+    chosen = None
+    for value in candidates:
+        _set_search_param(index, name, value)
+        found, ann_ms = _timed_search(search, queries, k)
+        point = {name: value, "recall": _recall(found, truth), "ann_ms": ann_ms}
+        report["curve"].append(point)
+        if point["recall"] >= ANN_TARGET_RECALL:
+            chosen = point
+            break
+
+    # 达不到目标召回率时使用最准的一档
+    chosen = chosen or report["curve"][-1]
+    _set_search_param(index, name, chosen[name])
+    report.update({"recall": chosen["recall"], "ann_ms": chosen["ann_ms"], name: chosen[name]})
+    if rescore_vectors:
+        report["recall_no_rescore"] = _recall(_index_search(index)(queries, k), truth)
+    return report
+
+
+def stored_vectors(index) -> np.ndarray:
+    """按位置取出索引中保存的全部向量（量化索引返回的是解码后的近似值）"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    try:
+        return np.asarray(index.reconstruct_n(0, index.ntotal), dtype=np.float32)
+    except RuntimeError:
+        return np.vstack([index.reconstruct(int(i)) for i in range(index.ntotal)]).astype(np.float32)
+
+
+def full_precision_vectors(vectorstore) -> Optional[np.ndarray]:
+    """量化向量库对应的全精度向量（内存映射）；未量化时返回 None"""
+    with _full_precision_lock:
+        return _full_precision.get(vectorstore)
+
+
+def attach_full_precision(vectorstore, path: str, owned: bool = False) -> None:
+    """
+    以只读内存映射方式打开全精度向量文件，并与向量库关联
+
+    Args:
+        path: float32 原始向量文件（形状为 ntotal × d）
+        owned: 为 True 时，向量库被回收后删除该文件（构建时生成的临时文件）
+    """
+    index = vectorstore.index
+    vectors = np.memmap(path, dtype=np.float32, mode="r", shape=(int(index.ntotal), int(index.d)))
+    with _full_precision_lock:
+        _full_precision[vectorstore] = vectors
+    if owned:
+        weakref.finalize(vectorstore, _remove_file, path)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _write_full_precision(vectors: np.ndarray) -> str:
+    os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
+    path = os.path.join(VECTOR_STORE_DIR, f"{uuid.uuid4().hex}.f32")
+    np.ascontiguousarray(vectors, dtype=np.float32).tofile(path)
+    return path
+
+
+def all_vectors(vectorstore) -> np.ndarray:
+    """按位置取出全部向量：量化索引优先使用全精度副本"""
+    full = full_precision_vectors(vectorstore)
+    if full is not None:
+        return np.asarray(full, dtype=np.float32)
+    return stored_vectors(vectorstore.index)
+
+
+def _position_map(vectorstore) -> Dict[str, int]:
+    with _positions_lock:
+        positions = _positions.get(vectorstore)
+        if positions is None or len(positions) != len(vectorstore.index_to_docstore_id):
+            positions = {doc_id: pos for pos, doc_id in vectorstore.index_to_docstore_id.items()}
+            _positions[vectorstore] = positions
+        return positions
+
+
+def cosine_similarities(vectorstore, query_vector: list, doc_ids: List[str]) -> List[Optional[float]]:
+    """
+    查询向量与指定片段向量的余弦相似度（与索引的距离度量无关）
+
+    量化索引使用全精度副本；片段不在索引中或无法取回向量时对应位置为 None。
+    """
+    positions = _position_map(vectorstore)
+    full = full_precision_vectors(vectorstore)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query_norm = float(np.linalg.norm(query)) or 1.0
+
+    sims: List[Optional[float]] = []
+    for doc_id in doc_ids:
+        position = positions.get(doc_id)
+        if position is None:
+            sims.append(None)
+            continue
+        try:
+            vector = full[position] if full is not None else vectorstore.index.reconstruct(int(position))
+        except RuntimeError:
+            sims.append(None)
+            continue
+        vector = np.asarray(vector, dtype=np.float32)
+        sims.append(float(vector @ query) / ((float(np.linalg.norm(vector)) or 1.0) * query_norm))
+    return sims
+
+
+def positions_of(vectorstore, doc_ids: List[str]) -> np.ndarray:
+    """片段 ID 对应的索引位置（不在索引中的忽略）"""
+    positions = _position_map(vectorstore)
+    return np.array([positions[doc_id] for doc_id in doc_ids if doc_id in positions], dtype=np.int64)
+
+
+def iter_vectors(vectorstore, positions: np.ndarray, batch_size: int = 1024) -> Iterator[np.ndarray]:
+    """按批取出指定位置的向量（量化索引优先使用全精度副本），不一次性复制全部向量"""
+    full = full_precision_vectors(vectorstore)
+    for i in range(0, len(positions), batch_size):
+        batch = np.sort(positions[i:i + batch_size])
+        if full is not None:
+            yield np.asarray(full[batch], dtype=np.float32)
+        else:
+            yield np.asarray(vectorstore.index.reconstruct_batch(batch), dtype=np.float32)
+
+
+def id_selector(positions: np.ndarray):
+    """只检索指定位置的 FAISS 过滤器（主题分片等：在原索引上过滤，不复制向量）"""
+    import faiss
+
+    return faiss.IDSelectorBatch(np.ascontiguousarray(positions, dtype=np.int64))
+
+
+def id_selector_bytes(n_ids: int) -> int:
+    """IDSelectorBatch 的内存估算：哈希集合每项约 40 字节 + 布隆过滤位图"""
+    return n_ids * 41
+
+
+def _filtered_params(index, selector, k: int):
+    """带过滤器的检索参数，沿用索引调好的 efSearch / nprobe"""
+    import faiss
+
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=max(int(index.hnsw.efSearch), k))
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=int(index.nprobe))
+    return faiss.SearchParameters(sel=selector)
+
+
+def rescore(
+    index, full_vectors: np.ndarray, metric_type: int, query: np.ndarray, k: int, selector=None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    先在（压缩）索引中取 k × RESCORE_CANDIDATES_FACTOR 个候选，再用全精度向量重新打分
+
+    selector 不为空时只在其允许的位置中取候选（见 id_selector）。
+
+    Returns:
+        (scores, positions)，长度为 k，不足时位置以 -1 补齐（与 faiss.search 约定一致）
+    """
+    import faiss
+
+    query = np.ascontiguousarray(query, dtype=np.float32).reshape(1, -1)
+    fetch_k = k * RESCORE_CANDIDATES_FACTOR
+    params = _filtered_params(index, selector, fetch_k) if selector is not None else None
+    _, candidates = index.search(query, fetch_k, params=params)
+    # 按位置排序后读取，内存映射文件上的访问更连续
+    positions = np.sort(candidates[0][candidates[0] >= 0])
+    exact = np.asarray(full_vectors[positions], dtype=np.float32)
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        scores = exact @ query[0]
+        order = np.argsort(-scores)[:k]
+    else:
+        scores = ((exact - query[0]) ** 2).sum(axis=1)
+        order = np.argsort(scores)[:k]
+
+    out_scores = np.full(k, np.nan, dtype=np.float32)
+    out_positions = np.full(k, -1, dtype=np.int64)
+    out_scores[:len(order)] = scores[order]
+    out_positions[:len(order)] = positions[order]
+    return out_scores, out_positions
+
+
+def vector_search(vectorstore, query_vector: list, k: int, selector=None) -> list:
+    """
+    向量检索：未量化时等同于 similarity_search_by_vector；量化索引会用全精度向量对候选重新打分
+
+    Args:
+        selector: 只检索部分片段时的过滤器（见 id_selector），在原索引上过滤
+
+    Returns:
+        Document 列表
+    """
+    full = full_precision_vectors(vectorstore)
+    if full is None and selector is None:
+        return vectorstore.similarity_search_by_vector(query_vector, k=k)
+
+    import faiss
+
+    index = vectorstore.index
+    query = np.array([query_vector], dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(query)
+    if full is not None:
+        _, positions = rescore(index, full, index.metric_type, query[0], k, selector=selector)
+    else:
+        _, found = index.search(query, k, params=_filtered_params(index, selector, k))
+        positions = found[0]
+
+    docs = []
+    for position in positions:
+        if position < 0:
+            continue
+        doc_id = vectorstore.index_to_docstore_id.get(int(position))
+        if doc_id is not None:
+            docs.append(vectorstore.docstore.search(doc_id))
+    return docs
+
+
+def apply_index_type(
+    vectorstore, index_type: str = VECTOR_INDEX_TYPE, quantization: str = VECTOR_QUANTIZATION
+) -> Dict[str, Any]:
+    """
+    把向量库的精确索引替换为配置的索引类型 / 量化方式（原地修改，须在登记到共享注册表之前调用）
+
+    Returns:
+        构建报告：{"index_type", "quantization", "ntotal", "params", "build_s", "recall", "ann_ms",
+        "exact_ms", "curve", "full_bytes", "index_bytes", ...}
+    """
+    index = vectorstore.index
+    vectors = all_vectors(vectorstore)
+    chosen = choose_index_type(len(vectors), index_type)
+    quantized = quantization != "none" and len(vectors) > 0
+
+    start = time.perf_counter()
+    if chosen == "flat" and not quantized:
+        new_index, params = index, {}
+    else:
+        new_index, params = build_index(vectors, index.metric_type, chosen, quantization if quantized else "none")
+    build_s = time.perf_counter() - start
+
+    report = {
+        "index_type": chosen,
+        "quantization": quantization if quantized else "none",
+        "ntotal": int(new_index.ntotal),
+        "params": params,
+        "build_s": build_s,
+        "full_bytes": int(len(vectors)) * int(index.d) * 4,
+        "index_bytes": index_bytes(new_index),
+    }
+    if chosen == "flat" and not quantized:
+        report["recall"] = 1.0
+    elif len(vectors):
+        report.update(tune_and_report(new_index, vectors, index.metric_type, rescore_vectors=quantized))
+
+    vectorstore.index = new_index
+    if quantized:
+        # 全精度向量只留在磁盘上，检索时按需读取少量候选
+        attach_full_precision(vectorstore, _write_full_precision(vectors), owned=True)
+    return report
+
+
+def make_mutable(vectorstore, source=None) -> None:
+    """
+    增删片段前换回未量化的精确索引（"压缩索引"时再按配置重建）
+
+    HNSW 不支持删除向量；IVF 删除后标签不再连续，而 LangChain 的 FAISS.delete 假定标签即位置；
+    量化索引增删后全精度副本会与之错位。
+
+    Args:
+        vectorstore: 要修改的向量库
+        source: vectorstore 是其副本时传入原向量库，以便取回全精度向量
+    """
+    import faiss
+
+    if not isinstance(vectorstore.index, faiss.IndexFlat):
+        vectors = all_vectors(source if source is not None else vectorstore)
+        vectorstore.index, _ = build_index(vectors, vectorstore.index.metric_type, "flat")
+        with _full_precision_lock:
+            _full_precision.pop(vectorstore, None)
+
+
+def index_bytes(index) -> int:
+    """估算索引占用的内存（向量 + HNSW 图 / IVF 倒排表开销）"""
+    import faiss
+
+    n, d = int(index.ntotal), int(index.d)
+    if isinstance(index, faiss.IndexHNSW):
+        # 底层每个节点 2M 个邻居（int32），上层节点很少，忽略
+        code_size = faiss.downcast_index(index.storage).code_size
+        return n * (code_size + index.hnsw.nb_neighbors(0) * 4)
+    if isinstance(index, faiss.IndexIVF):
+        return n * (int(index.code_size) + 8) + int(index.nlist) * d * 4
+    return n * int(getattr(index, "code_size", d * 4))
+
+
+def describe_index(index) -> Dict[str, Any]:
+    """当前索引的类型与检索参数（用于 Diagnostics 展示）"""
+    import faiss
+
+    info: Dict[str, Any] = {"index_type": "flat", "ntotal": int(index.ntotal)}
+    if isinstance(index, faiss.IndexHNSW):
+        info.update({"index_type": "hnsw", "efSearch": int(index.hnsw.efSearch)})
+        storage = faiss.downcast_index(index.storage)
+    elif isinstance(index, faiss.IndexIVF):
+        info.update({"index_type": "ivf", "nlist": int(index.nlist), "nprobe": int(index.nprobe)})
+        storage = index
+    else:
+        storage = index
+    sq = getattr(storage, "sq", None)
+    if sq is not None:
+        info["quantization"] = "fp16" if sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    info["mb"] = index_bytes(index) / (1024 * 1024)
+    return info